@@ -1,30 +1,155 @@
 import csv
 import logging
-from io import StringIO
-from flask import Flask, request, render_template
-from sentence_transformers import SentenceTransformer
-from sklearn.cluster import AgglomerativeClustering
-from sklearn.metrics import pairwise_distances
+import os
+import tempfile
+import threading
+import time
+from io import StringIO, TextIOWrapper
 import numpy as np
+from flask import Flask, Response, request, render_template, send_file
+from sklearn.cluster import AgglomerativeClustering
+from embedding_cache import EmbeddingCache
+from encoder_backends import encoder_id
+from model_registry import ModelRegistry
+from streaming import stream_embeddings
+from coherence import cluster_coherences
+from jobs import JobManager
+from report import write_reports
+from instrumentation import metrics, set_verbosity, vprint
+from vector_index import VectorIndex
+from file_store import FileStore
+from columnar import is_columnar, table_rows
 
 app = Flask(__name__, template_folder='.')
 logger = logging.getLogger(__name__)
-
-# In-memory store for uploaded CSV data
-# Key: filename
-# Value: {
-#     "column_names": [col1, col2, ...],
-#     "data": [  # list of rows
-#         {col1: val1, col2: val2, ...},
-#         ...
-#     ]
-# }
-files_data = {}
+# VERBOSITY=2 prints every line and cluster of clustering requests for debugging
+set_verbosity(int(os.environ.get('VERBOSITY', '0')))
+
+model_name = 'all-mpnet-base-v2'
+# Model is loaded and warmed up once per process, requests only pay for inference
+model_registry = ModelRegistry()
+model_registry.load(model_name)
+# Persistent embedding cache shared by all clustering requests
+embedding_cache = EmbeddingCache('data/embedding_cache', encoder_id(model_name, model_registry.backend))
+# Background clustering jobs, state is kept in data/jobs/jobs.db
+job_manager = JobManager('data/jobs')
+# Nearest neighbour index of all uploaded issues for /api/similar, SIMILAR_PROBES trades speed for recall
+vector_index = VectorIndex('data/vector_index', n_probe=int(os.environ.get('SIMILAR_PROBES', '8')))
+
+# In-memory columnar store for uploaded CSV data, keyed by filename.
+# Least recently used files are spilled to disk above UPLOADS_MEMORY_MB.
+files_data = FileStore(max_bytes=int(os.environ.get('UPLOADS_MEMORY_MB', '512')) * 2 ** 20)
+# upper bound of rows returned by one /api/files/<filename>/rows request
+MAX_PAGE_ROWS = 1000
+# rows of an uploaded file encoded at once for the vector index, a cancelled job stops between chunks
+INDEX_CHUNK_SIZE = 1024
+# startup time is exposed on /metrics as jira_clustering_startup_milestone_seconds
+metrics.milestone('ready')
+# removal of an earlier upload and adding the new one are not interleaved with other uploads
+index_lock = threading.Lock()
+
+
+def index_issues(filename, column_names, rows, progress=None):
+    # Adds rows of an uploaded file to the vector index, replacing rows of an earlier upload
+    # of the same file. Rows are encoded by Summary like in clustering, or by all columns.
+    # progress(phase, rows_encoded) is called like in cluster_csv.
+    if progress is None:
+        progress = lambda phase, rows_encoded=None: None
+    if 'Summary' in column_names:
+        col_nums = [column_names.index('Summary')]
+    else:
+        col_nums = list(range(len(column_names)))
+    key_col = column_names.index('Issue key') if 'Issue key' in column_names else None
+    rows = [row for row in rows if row]
+    lines = [''.join((row[col_num] if col_num < len(row) else '') + ';' for col_num in col_nums) for row in rows]
+
+    with metrics.stage('index', rows=len(lines)):
+        if lines:
+            progress('encoding', 0)
+            model = model_registry.get(model_name)
+            chunks = []
+            for start in range(0, len(lines), INDEX_CHUNK_SIZE):
+                chunks.append(embedding_cache.encode(model, lines[start:start + INDEX_CHUNK_SIZE]))
+                progress('encoding', min(start + INDEX_CHUNK_SIZE, len(lines)))
+            embeddings = np.concatenate(chunks)
+            embedding_cache.save()
+            progress('indexing', len(lines))
+        with index_lock:
+            vector_index.remove(lambda item: item['file'] == filename)
+            if lines:
+                vector_index.add(embeddings, [
+                    {
+                        'file': filename,
+                        'row': row_num,
+                        'issue_key': row[key_col] if key_col is not None and key_col < len(row) else None,
+                        'text': line[:-1],
+                    }
+                    for row_num, (row, line) in enumerate(zip(rows, lines))
+                ])
+            vector_index.save()
+    return {'file': filename, 'indexed': len(lines)}
+
+def submit_indexing(filename, column_names, rows):
+    # Uploads only store the file, its issues are encoded and indexed by a background job.
+    # Returns the job id.
+    job = job_manager.create({'index': filename})
+    job_manager.submit(job, lambda job: index_issues(filename, column_names, rows, progress=job.progress))
+    return job.id
 
 @app.route('/api/files', methods=['GET'])
 def get_files():
+    # metadata only (column names, number of rows, size), rows are read page by page
+    return {
+      'files': files_data.metadata()
+    }
+
+def parse_column_list(value):
+    return [col for col in value.split(';') if col] if value else None
+
+def read_upload(file, columns=None):
+    # Rows of an uploaded file, the first one is the column names. Semicolon csv files are
+    # read whole, of parquet and arrow files only the given columns (all if None).
+    if is_columnar(file.filename):
+        return list(table_rows(file.stream, file.filename, columns))
+    file_contents = file.read().decode("utf-8", errors="replace")
+    return list(csv.reader(StringIO(file_contents), delimiter=';'))
+
+@app.route('/api/files/<path:filename>/rows', methods=['GET'])
+def get_file_rows(filename):
+    # Window offset..offset+limit of the rows, optionally sorted by one column (order asc or desc),
+    # only rows containing filter text (in filter_columns or any column) and only the given columns.
+    # Column lists are semicolon separated. total is the number of rows matching the filter.
+    file = files_data.get(filename)
+    if file is None:
+        return {'error': 'File not found'}, 404
+    try:
+        offset = max(0, int(request.args.get('offset', 0)))
+        limit = min(MAX_PAGE_ROWS, max(0, int(request.args.get('limit', 100))))
+    except ValueError:
+        return {'error': 'Parameters offset and limit must be integers'}, 400
+    order = request.args.get('order', 'asc')
+    if order not in ['asc', 'desc']:
+        return {'error': "Parameter order must be either 'asc' or 'desc'"}, 400
+    columns = parse_column_list(request.args.get('columns'))
+    try:
+        row_numbers = file.query(
+            sort=request.args.get('sort') or None,
+            descending=order == 'desc',
+            text=request.args.get('filter'),
+            filter_columns=parse_column_list(request.args.get('filter_columns')),
+        )
+        window = row_numbers[offset:offset + limit]
+        rows = file.rows_at(window, columns)
+    except KeyError as e:
+        return {'error': e.args[0]}, 400
     return {
-      'files': files_data
+      'column_names': columns or file.column_names,
+      'rows': rows,
+      'row_numbers': window.tolist(),
+      'offset': offset,
+      'limit': limit,
+      'total': len(row_numbers),
+      'file_rows': file.n_rows,
     }
 
 @app.route('/api/table', methods=['GET'])
@@ -37,94 +162,71 @@ def get_table():
 
 @app.route('/api/upload', methods=['POST'])
 def post_upload():
+    # optional columns field (semicolon separated) selects the columns read from parquet and arrow files
     file = request.files.get("file")
-    file_contents = file.read().decode("utf-8", errors="replace")
-    csv_reader = csv.reader(StringIO(file_contents), delimiter=';')
-    rows = list(csv_reader)
+    rows = read_upload(file, parse_column_list(request.form.get('columns')))
+    index_job = None
     if len(rows) > 0:
                     # First row is the column names
                     column_names = rows[0]
-                    data = []
-
-                    # Build a list of dicts for each subsequent row
-                    for row in rows[1:]:
-                        row_dict = {}
-                        for col_name, cell_value in zip(column_names, row):
-                            row_dict[col_name] = cell_value
-                        data.append(row_dict)
-
-                    # Store in dictionary
-                    files_data[file.filename] = {
-                        "column_names": column_names,
-                        "data": data
-                    }
-    return {'file': files_data[file.filename]}
+
+                    # Store columns of the remaining rows
+                    files_data.put(file.filename, column_names, rows[1:])
+                    index_job = submit_indexing(file.filename, column_names, rows[1:])
+    if file.filename not in files_data:
+        return {'error': 'Empty file'}, 400
+    # the file is in /api/similar results once the index job is done
+    return {'file': files_data.get(file.filename).metadata(), 'index_job': index_job}
 
 
 @app.route("/", methods=["GET", "POST"])
 def index():
-    global files_data, column_names, data
+    global column_names
 
     # Handle file upload if it's a POST request
     if request.method == "POST":
         uploaded_file = request.files.get("csv_file")
         if uploaded_file:
-            file_contents = uploaded_file.read().decode("utf-8", errors="replace")
-
-            # Parse the CSV using ';' as delimiter
-            csv_reader = csv.reader(StringIO(file_contents), delimiter=';')
-            rows = list(csv_reader)
+            # Parse the CSV using ';' as delimiter, or the parquet or arrow file
+            rows = read_upload(uploaded_file)
 
             if len(rows) > 0:
                 # First row is the column names
                 column_names = rows[0]
-                data = []
-
-                # Build a list of dicts for each subsequent row
-                for row in rows[1:]:
-                    row_dict = {}
-                    for col_name, cell_value in zip(column_names, row):
-                        row_dict[col_name] = cell_value
-                    data.append(row_dict)
-
-                # Store in dictionary
-                files_data[uploaded_file.filename] = {
-                    "column_names": column_names,
-                    "data": data
-                }
-
-    # Check if the user wants to view a specific file
+
+                # Store columns of the remaining rows
+                files_data.put(uploaded_file.filename, column_names, rows[1:])
+                submit_indexing(uploaded_file.filename, column_names, rows[1:])
+
+    # Check if the user wants to view a specific file, its rows are fetched by the page while scrolling
     selected_file = request.args.get("file")
-    selected_data = None
     column_names = None
+    n_rows = 0
 
     if selected_file and selected_file in files_data:
-        column_names = files_data[selected_file]["column_names"]
-        selected_data = files_data[selected_file]["data"]
+        file = files_data.get(selected_file)
+        column_names = file.column_names
+        n_rows = file.n_rows
 
     return render_template(
         "layout.html",
-        files=list(files_data.keys()),
+        files=files_data.names(),
         selected_file=selected_file,
-        data=selected_data,
+        n_rows=n_rows,
         column_names=column_names
     )
 # 150 embeding
-@app.route('/api/clustering', methods=['POST'])
-def post_clustering():
-    # summary column + thdreashold input (float 0.2-0.7)
+def cluster_csv(text_file, output_filename, columns=['Summary'], distance_threshold=0.2, sorting='coherence', progress=None):
+    # Clusters csv rows read from text_file and writes the clustered csv to output_filename.
+    # progress(phase, rows_encoded) is called between stages, jobs use it to report and cancel.
     all_key = "_all"
-    columns = ['Summary']
-    sorting = 'coherence'
+    if progress is None:
+        progress = lambda phase, rows_encoded=None: None
 
-    file = request.files.get("file")
-    file_contents = file.read().decode("utf-8", errors="replace")
-    csv_reader = csv.reader(StringIO(file_contents), delimiter=';')
-    rows = list(csv_reader)
+    csv_reader = csv.reader(text_file, delimiter=';')
 
-    lines = []
-    # select first row and let rows array hold the rest
-    header = rows[0]
+    # select first row and let csv_reader hold the rest
+    header = next(csv_reader)
 
     if all_key in columns:
       columns = []
@@ -135,40 +237,38 @@ def post_clustering():
       missing_columns = [col for col in columns if col not in header]
       if missing_columns:
         print(f"Error: The following columns are missing in the CSV header: {', '.join(missing_columns)}")
-        sys.exit(1)
+        raise ValueError(f"Columns missing in the CSV header: {', '.join(missing_columns)}")
       else:
         print("All specified columns are present in the CSV header.")
 
-      rows = rows[1:]
-      # Create a mapping from column names to their indices
-      header_dict = {col_name: idx for idx, col_name in enumerate(header)}
-
-      for row in rows:
-          if len(row) > 0:
-            line = ''
-            print('row =', row)
-
-            for header_item in header_dict:
-                print('header_item =', header_item)
-                if header_item in columns:
-                  col_num = header_dict[header_item]
-                  print('col_num =', col_num)
-                  print('line =', line)
-                  line += row[col_num] + ';'
-            lines.append(line)
-    model = SentenceTransformer('all-mpnet-base-v2')
-    embeddings = model.encode(lines)
-    embeddings = np.array(embeddings)
-
-
+    # rows and embeddings are spilled to disk chunk by chunk
+    progress('encoding', 0)
+    model = model_registry.get(model_name)
+    spill_dir = tempfile.TemporaryDirectory(prefix='clustering_')
+
+    def encode(lines):
+        metrics.observe_batch(len(lines))
+        return embedding_cache.encode(model, lines)
+
+    with metrics.stage('encode') as stage:
+        rows, embeddings = stream_embeddings(
+            csv_reader, header, columns, encode, spill_dir.name,
+            progress=lambda count: progress('encoding', count)
+        )
+        stage['rows'] = len(rows)
+    embedding_cache.save()
+    print(embedding_cache.summary())
+
+    progress('clustering')
     clustering_model = AgglomerativeClustering(
                 n_clusters=None,
-                distance_threshold=0.2,       # TODO Adjust this threshold based on your data
+                distance_threshold=distance_threshold,       # TODO Adjust this threshold based on your data
                 metric='cosine',              # Use 'cosine' if you prefer cosine distance
                 linkage='complete',               # 'ward' linkage works well with euclidean distance
             )
 
-    clustering_model.fit(embeddings)
+    with metrics.stage('cluster', rows=len(rows)):
+        clustering_model.fit(embeddings)
     cluster_assignment = clustering_model.labels_
 
     # Mapping from cluster ID to list of sentence indices
@@ -176,92 +276,156 @@ def post_clustering():
     for sentence_id, cluster_id in enumerate(cluster_assignment):
         cluster_indices.setdefault(cluster_id, []).append(sentence_id)
 
-    # Compute coherence for each cluster
-    coherences = {}
-    for cluster_id, indices in cluster_indices.items():
-        if len(indices) < 2:
-            coherence = 0.0  # Coherence is zero if there's only one sentence in the cluster
-        else:
-            cluster_embeddings = embeddings[indices]
-            distances = pairwise_distances(cluster_embeddings, metric='cosine')
-            n = distances.shape[0]
-            triu_indices = np.triu_indices(n, k=1)
-            upper_tri_distances = distances[triu_indices]
-            coherence = upper_tri_distances.mean()
-        coherences[cluster_id] = coherence
-
-    # Organize sentences by clusters and sort them
-    clustered_sentences = {}
-    for sentence_id, cluster_id in enumerate(cluster_assignment):
-        clustered_sentences.setdefault(cluster_id, []).append(lines[sentence_id])
-
+    # Compute coherence for all clusters at once, indexed by cluster ID
+    with metrics.stage('coherence', rows=len(rows)):
+        coherences = cluster_coherences(embeddings, cluster_assignment)
 
     # Sort the clusters by size
     if sorting == 'size':
-        sorting_set = True
-        sorted_clusters = sorted(clustered_sentences.items(), key=lambda item: len(item[1]), reverse=True)
-        max_clusters = len(sorted_clusters)
-
         sorted_cluster_ids = sorted(cluster_indices.keys(), key=lambda cid: len(cluster_indices[cid]), reverse=True)
 
     if sorting == 'coherence':
-        sorted_clusters = sorted(clustered_sentences.items(), key=lambda item: coherences[item[0]])
-        max_clusters = len(sorted_clusters)
-
         sorted_cluster_ids = sorted(cluster_indices.keys(), key=lambda cid: coherences[cid])
 
-    large_clusters_count = 0
-    print('sorted_clusters =', sorted_clusters)
+    vprint(2, 'sorted_cluster_ids =', sorted_cluster_ids)
+
+    progress('writing')
+    with metrics.stage('report', rows=len(rows)):
+        large_clusters_count = write_reports(
+            output_filename, None, header, rows, cluster_indices, sorted_cluster_ids, coherences
+        )
+    rows.close()
 
-    success = False
+    return {
+        'rows': len(rows),
+        'clusters': len(sorted_cluster_ids),
+        'large_clusters': large_clusters_count,
+    }
+
+
+@app.route('/api/clustering', methods=['POST'])
+def post_clustering():
+    # summary column + thdreashold input (float 0.2-0.7)
+    file = request.files.get("file")
     filename = 'temps'
-    file
-    while not success:
-        try:
-            # Open the CSV file for writing
-            with open(filename, 'w', newline='',  encoding='utf-8') as csvfile:
-                writer = csv.writer(csvfile, delimiter=';')
-
-                # Write the header
-                writer.writerow(header)
-                large_clusters_count = 0
-                # Write clusters to the CSV file
-                for cluster_id in sorted_cluster_ids:
-                    indices = cluster_indices[cluster_id]
-
-                    if len(indices) > 1:
-                        writer.writerow([ f'Cluster items distance: {coherences[cluster_id]:.4f}'])
-
-                    for idx in indices:
-                        if len(indices) > 1:
-                            writer.writerow(rows[idx])
-                    # Write empty lines to separate clusters
-                    if len(indices) > 1:
-                        large_clusters_count = large_clusters_count + 1
-                        writer.writerow([])
-                        writer.writerow([])
-                        writer.writerow([])
-                        writer.writerow([])
-
-                # write miscelaneous cluster
-                writer.writerow([ f'Miscelaneous cluster'])
-                for cluster_id in sorted_cluster_ids:
-                    indices = cluster_indices[cluster_id]
-
-                    if len(indices) == 1:
-                        for idx in indices:
-                            writer.writerow(rows[idx])
-
-            print('csv: ', csvfile)
-            success = True  # Writing succeeded, exit the loop
-        except Exception as e:
-            print(e)
-            print("--------------------------------------------------------------------------------------------------------------")
-            print(f"Error: Writing to {'temp'} threw an exception. Make sure you don't have your file opened and locked for writing. Please resolve the problem and press any key to write the file again.")
-            input()
-    #file = open(filename, 'r')
-
-    return {'sorted_clusters': open(filename, 'r')}
+    # upload is decoded and parsed while it is read, never held as one string
+    try:
+        cluster_csv(TextIOWrapper(file.stream, encoding="utf-8", errors="replace", newline=''), filename)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+
+    with open(filename, 'r', encoding='utf-8') as csvfile:
+        return {'sorted_clusters': csvfile.read()}
+
+
+def parse_job_params(form):
+    # same defaults as /api/clustering, Summary column is always added like in clustering.py
+    all_key = "_all"
+    columns = [col for col in form.get('columns', '').split(';') if col]
+    if all_key not in columns:
+        columns = ['Summary'] + [col for col in columns if col != 'Summary']
+    sorting = form.get('sorting', 'coherence')
+    if sorting not in ['size', 'coherence']:
+        raise ValueError("Sorting parameter must be either 'size' or 'coherence'.")
+    return {
+        'columns': columns,
+        'distance_threshold': float(form.get('distance_threshold', 0.2)),
+        'sorting': sorting,
+    }
+
+
+def run_clustering_job(job):
+    with open(job.path('input.csv'), 'r', encoding='utf-8', errors='replace', newline='') as file:
+        return cluster_csv(file, job.path('clustered.csv'), progress=job.progress, **job.params)
+
+
+@app.route('/api/jobs', methods=['POST'])
+def post_job():
+    # Submits clustering of the uploaded csv file as a background job
+    file = request.files.get("file")
+    if file is None:
+        return {'error': 'No file uploaded'}, 400
+    try:
+        params = parse_job_params(request.form)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+
+    job = job_manager.create(params)
+    file.save(job.path('input.csv'))
+    job_manager.submit(job, run_clustering_job)
+    return job_manager.get(job.id), 202
+
+
+@app.route('/api/jobs', methods=['GET'])
+def get_jobs():
+    return {'jobs': job_manager.store.list()}
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return {'error': 'Job not found'}, 404
+    return job
+
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+def delete_job(job_id):
+    job = job_manager.cancel(job_id)
+    if job is None:
+        return {'error': 'Job not found'}, 404
+    return job
+
+
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return {'error': 'Job not found'}, 404
+    if job['status'] != 'done':
+        return {'error': f"Job is {job['status']}"}, 409
+    result_path = os.path.join(job_manager.jobs_dir, job_id, 'clustered.csv')
+    if not os.path.exists(result_path):
+        # indexing jobs of uploads have no result file
+        return {'error': 'Job has no result file'}, 404
+    return send_file(
+        result_path,
+        mimetype='text/csv',
+        as_attachment=True,
+        download_name=f'{job_id}_clustered.csv',
+    )
+
+
+@app.route('/api/similar', methods=['GET'])
+def get_similar():
+    # Top k uploaded issues nearest to text, e.g. to find duplicates of a new issue
+    text = request.args.get('text', '')
+    if not text:
+        return {'error': 'Parameter text is required'}, 400
+    try:
+        k = int(request.args.get('k', 10))
+        n_probe = int(request.args['n_probe']) if 'n_probe' in request.args else None
+    except ValueError:
+        return {'error': 'Parameters k and n_probe must be integers'}, 400
+    if k < 1 or (n_probe is not None and n_probe < 1):
+        return {'error': 'Parameters k and n_probe must be at least 1'}, 400
+
+    start = time.perf_counter()
+    model = model_registry.get(model_name)
+    # same line format as the indexed Summary lines, queries are not stored in the embedding cache
+    query = model.encode([text + ';'])[0]
+    results = vector_index.search(query, k=k, n_probe=n_probe)
+    return {
+        'results': [dict(item, distance=distance) for distance, item in results],
+        'indexed': len(vector_index),
+        'took_ms': round((time.perf_counter() - start) * 1000, 2),
+    }
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Stage timings, throughput, peak memory and encode batch sizes in Prometheus text format
+    return Response(metrics.prometheus(), mimetype='text/plain; version=0.0.4')
 
 if __name__ == "__main__":
     app.run(debug=True, port=4400)
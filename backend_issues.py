@@ -1,79 +1,284 @@
+import argparse
 import csv
+import os
 import sys
-input_file = 'issues_bugs.csv'
+
+from llm_results import ResultStore, prompt_hash, text_hash
+
+parser = argparse.ArgumentParser(description='Asks LLM whether jira issues from csv file (separated by semicolon) describe backend rather than frontend issues.')
+parser.add_argument(
+    '-f',
+    '--input_file',
+    type=str,
+    default='issues_bugs.csv',
+    help='Name of the csv input file in data folder.'
+)
+parser.add_argument(
+    '-m',
+    '--model',
+    type=str,
+    default='mistral:instruct',
+    help='Ollama model name.'
+)
+parser.add_argument(
+    '--host',
+    type=str,
+    default=os.environ.get('OLLAMA_HOST', 'http://localhost:11434'),
+    help='Ollama server url. Use url of ollama_stub.py to test without a model.'
+)
+parser.add_argument(
+    '-n',
+    '--concurrency',
+    type=int,
+    default=4,
+    help='Number of issues classified at once (requests in flight).'
+)
+parser.add_argument(
+    '--retries',
+    type=int,
+    default=3,
+    help='Number of retries of a failed request, with exponential backoff.'
+)
+parser.add_argument(
+    '--timeout',
+    type=float,
+    default=300,
+    help='Time limit in seconds for classification of one issue (both requests including retries).'
+)
+parser.add_argument(
+    '--results',
+    type=str,
+    default='data/backend_issues.db',
+    help='Result store. Issues already classified with the same prompt and model are skipped, so interrupted runs continue where they stopped.'
+)
+parser.add_argument(
+    '--rerun',
+    action='store_true',
+    help='Classify all issues again, ignoring results in the result store.'
+)
+parser.add_argument(
+    '--triage',
+    action='store_true',
+    help='Cluster the issues first and classify only a few representatives of every tight cluster, the other members take their verdict. Verdicts are written to data/backend_issues_triage.csv.'
+)
+parser.add_argument(
+    '-c',
+    '--columns',
+    type=str,
+    default='Summary',
+    help='Columns the issues are clustered by in --triage mode, separated by semicolon. All columns if none of them is in the file.'
+)
+parser.add_argument(
+    '-d',
+    '--distance_threshold',
+    type=float,
+    default=0.3,
+    help='Cluster distance threshold of --triage, lower gives smaller and tighter clusters.'
+)
+parser.add_argument(
+    '--representatives',
+    type=int,
+    default=2,
+    help='Maximum number of representatives of a cluster classified by the LLM in --triage mode.'
+)
+parser.add_argument(
+    '--similarity_cutoff',
+    type=float,
+    default=0.85,
+    help='Minimum cosine similarity of an issue to a representative to take its verdict, other issues are classified one by one.'
+)
+parser.add_argument(
+    '--max_coherence',
+    type=float,
+    default=0.25,
+    help='Clusters with mean pairwise cosine distance above this are classified issue by issue.'
+)
+parser.add_argument(
+    '--agreement_sample',
+    type=int,
+    default=50,
+    help='Number of issues with a propagated verdict also classified one by one, to report agreement of triage with per-issue classification. 0 disables the check.'
+)
+parser.add_argument(
+    '--cache_dir',
+    type=str,
+    default='data/embedding_cache',
+    help='Embedding cache shared with clustering.py, used by --triage.'
+)
+args = parser.parse_args()
+
+input_file = args.input_file
+model = args.model
+# sentence transformer used to cluster issues in --triage mode, same as clustering.py
+embedding_model_name = 'all-mpnet-base-v2'
 
 lines = []
+keys = []
 
 with open('data/' + input_file, 'r',  encoding='utf-8') as file:
     reader = csv.reader(file, delimiter=';')
     rows = list(reader)        # Convert to list of rows
-    
+
     for row in rows:
         line = ''
         for cell in row:
             line += cell + ';'
         lines.append(line)
 
-# skip first line
+# skip first line, issues are identified by Issue key column (or by their text if there is none)
+header = rows[0]
+key_column = header.index('Issue key') if 'Issue key' in header else None
 lines = lines[1:]
+for row, line in zip(rows[1:], lines):
+    if key_column is not None and key_column < len(row) and row[key_column]:
+        keys.append(row[key_column])
+    else:
+        keys.append(text_hash(line))
 
 import ollama
+from llm_classification import IssueClassifier, REASONING_QUESTION, VERDICT_QUESTION
 
 yes_count = 0
 no_count = 0
 
-model = 'mistral:instruct'
-for line in lines:
+store = ResultStore(args.results)
+current_prompt_hash = prompt_hash(model, REASONING_QUESTION, VERDICT_QUESTION)
+completed = {} if args.rerun else store.completed(current_prompt_hash)
 
-    print('-------------------------------------------------------------------------------------------------------')
-    
-
-    question = f"issue:\n {line}\n \n Is this jira issues describe UI issue that can be potentialy backend issue? Use reasoning and chain of thoughts."
-    
-    print(question)
-    response = ollama.chat(
-        model=model,
-        messages=[
-            {'role': 'user', 'content': question}
-        ]
-    )
-    #print(response['message']['content'])
-    res_text = response['message']['content']
-
-    question = res_text + "\n Is this describing rather backend issue than frontend issue? Start with Yes, if you think so."
-    response = ollama.chat(
-        model=model,
-        messages=[
-            {'role': 'user', 'content': question}
-        ]
-    )
-    print(question)
-    print('****************************************************************')
-    res = response['message']['content']
-    print(res)
-    if res.startswith(' Yes') or res.startswith('Yes'):
-        yes_count += 1
+# issues classified before with the same prompt, model and text are only counted
+pending = []
+for i, (key, line) in enumerate(zip(keys, lines)):
+    done = completed.get(key)
+    if done is not None and done[0] == text_hash(line):
+        if done[1]:
+            yes_count += 1
+        else:
+            no_count += 1
     else:
-        no_count += 1
+        pending.append(i)
+print(f'{len(lines) - len(pending)} issues already classified, {len(pending)} to go. Yes: {yes_count}, No: {no_count}')
+sys.stdout.flush()
 
-    print(f'Yes: {yes_count}, No: {no_count}')
-    print('\n')
-    print('\n')
-    print('\n')
-    print('\n')
-    print('\n')
-    print('\n')
+# one client per worker thread, the timeout of a request is the time left until the deadline of the issue
+connect = lambda: ollama.Client(host=args.host)
+classifier = IssueClassifier(connect, model, retries=args.retries, timeout=args.timeout)
+
+
+def handle_result(key, result):
+    # Prints and stores the result of one issue classified by the LLM
+    print(result['question'])
+    print(result['verdict_question'])
+    print('****************************************************************')
+    print(result['response'])
+    store.save(key, current_prompt_hash, model, result['line'], result)
 
     sys.stdout.flush()
     print('Appending results to file')
     with open('data/' + 'backend_issues.txt', 'a',  encoding='utf-8') as file:
         file.write('*'*20)
-        file.write(line)
+        file.write(result['line'])
         file.write('\n')
         file.write('\n')
         file.write('\n')
-    sys.stdout.flush()
     print('Results appended to file')
     #flush
     sys.stdout.flush()
-    
\ No newline at end of file
+
+
+def classify(indices):
+    # Classifies the issues with the given indices one by one, yields (index, verdict) of those that succeeded
+    for position, result, error in classifier.classify_all([lines[i] for i in indices], concurrency=args.concurrency):
+        index = indices[position]
+        print('-------------------------------------------------------------------------------------------------------')
+        if error is not None:
+            print(f'Issue {keys[index]} failed: {error!r}')
+            print(lines[index])
+            sys.stdout.flush()
+            continue
+        handle_result(keys[index], result)
+        yield index, result['backend']
+
+
+if args.triage:
+    from cluster_tree import ClusterTree
+    from embedding_cache import EmbeddingCache
+    from encoder_backends import LazyEncoder, encoder_id, load_encoder
+    from llm_triage import TriagePlan, agreement_report, agreement_sample
+    from streaming import line_column_indices
+
+    # issues are clustered by the selected columns like in clustering.py
+    col_nums = line_column_indices(header, args.columns.split(';')) or list(range(len(header)))
+    texts = [''.join((row[col_num] if col_num < len(row) else '') + ';' for col_num in col_nums) for row in rows[1:]]
+    print(f'Clustering {len(texts)} issues by {[header[col_num] for col_num in col_nums]}')
+    sys.stdout.flush()
+    embedding_cache = EmbeddingCache(args.cache_dir, encoder_id(embedding_model_name, 'torch'))
+    embeddings = embedding_cache.encode(LazyEncoder(lambda: load_encoder(embedding_model_name)), texts)
+    embedding_cache.save()
+    labels, coherences = ClusterTree(embeddings).cut(args.distance_threshold)
+    plan = TriagePlan(embeddings, labels, coherences, representatives=args.representatives,
+                      similarity_cutoff=args.similarity_cutoff, max_coherence=args.max_coherence)
+    print(plan.summary())
+    sys.stdout.flush()
+
+    # verdicts of the LLM for single issues, classified before with the same prompt, model and text or now
+    direct = {i: completed[key][1] for i, (key, line) in enumerate(zip(keys, lines))
+              if key in completed and completed[key][0] == text_hash(line)}
+    direct.update(classify([i for i in plan.direct() if i not in direct]))
+    # members of representatives that failed are classified themselves
+    direct.update(classify([i for i in plan.propagated() if i not in direct and plan.representative_of[i] not in direct]))
+
+    # a sample of propagated verdicts is checked against classification of the single issues
+    propagated = [i for i in plan.propagated() if plan.representative_of[i] in direct]
+    sample = agreement_sample(propagated, args.agreement_sample)
+    if sample:
+        print(f'Classifying {len(sample)} issues with propagated verdicts one by one to check agreement')
+        direct.update(classify([i for i in sample if i not in direct]))
+
+    triage_prompt_hash = prompt_hash(model, REASONING_QUESTION, VERDICT_QUESTION, 'propagated')
+    yes_count = 0
+    no_count = 0
+    with open('data/backend_issues_triage.csv', 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file, delimiter=';')
+        writer.writerow(['Issue key', 'Backend', 'Source', 'Triage', 'Representative', 'Similarity'])
+        for i, key in enumerate(keys):
+            rep = int(plan.representative_of[i])
+            if i in direct:
+                verdict, source = direct[i], 'llm'
+            elif rep >= 0 and rep in direct:
+                verdict, source = direct[rep], 'propagated'
+                store.save(key, triage_prompt_hash, model, lines[i], {
+                    'backend': verdict,
+                    'reasoning': '',
+                    'response': f'Propagated from {keys[rep]} (similarity {plan.similarity[i]:.3f})',
+                })
+            else:
+                verdict, source = None, 'failed'
+            if verdict is not None:
+                yes_count, no_count = (yes_count + 1, no_count) if verdict else (yes_count, no_count + 1)
+            writer.writerow([key, '' if verdict is None else ('Yes' if verdict else 'No'), source, plan.kinds[i],
+                             keys[rep] if rep >= 0 else '', f'{plan.similarity[i]:.4f}' if rep >= 0 else ''])
+
+    print('-------------------------------------------------------------------------------------------------------')
+    print(f'Yes: {yes_count}, No: {no_count}')
+    print(plan.summary())
+    print(agreement_report([(direct[int(plan.representative_of[i])], direct[i]) for i in sample if i in direct]))
+    print('Verdicts written to data/backend_issues_triage.csv')
+    print(classifier.stats.summary())
+    store.close()
+    sys.exit(0)
+
+# Results arrive in completion order, printing and storing results is done here only
+for index, backend in classify(pending):
+    if backend:
+        yes_count += 1
+    else:
+        no_count += 1
+
+    print(f'Yes: {yes_count}, No: {no_count}')
+    print('\n')
+    sys.stdout.flush()
+
+print('-------------------------------------------------------------------------------------------------------')
+print(f'Yes: {yes_count}, No: {no_count}')
+print(classifier.stats.summary())
+store.close()
@@ -0,0 +1,145 @@
+import argparse
+import csv
+import filecmp
+import html
+import os
+import random
+import tempfile
+import time
+
+from report import write_reports
+
+# Benchmark of report.write_reports against the original per-cell csv/html writers of
+# clustering.py on synthetic clusters. Also checks that both produce identical files.
+#
+# Example:
+#   python bench_report.py --rows 50000 --columns 30
+
+parser = argparse.ArgumentParser(description='Benchmark of the clustered csv/html report writer.')
+parser.add_argument('--rows', type=int, default=50000, help='Number of rows.')
+parser.add_argument('--columns', type=int, default=30, help='Number of columns, first one is Issue key.')
+parser.add_argument('--clusters', type=int, default=5000, help='Number of clusters.')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--repeat', type=int, default=3, help='Runs per writer, best time is reported.')
+
+
+def legacy_write_reports(output_file, html_output_file, header, rows, cluster_indices, sorted_cluster_ids, coherences):
+    # original writers from clustering.py, kept for comparison
+    with open(output_file, 'w', newline='',  encoding='utf-8') as csvfile:
+        writer = csv.writer(csvfile, delimiter=';')
+        writer.writerow(header)
+        for cluster_id in sorted_cluster_ids:
+            indices = cluster_indices[cluster_id]
+            if len(indices) > 1:
+                writer.writerow([ f'Cluster items distance: {coherences[cluster_id]:.4f}'])
+            for idx in indices:
+                if len(indices) > 1:
+                    writer.writerow(rows[idx])
+            if len(indices) > 1:
+                writer.writerow([])
+                writer.writerow([])
+                writer.writerow([])
+                writer.writerow([])
+        writer.writerow([ f'Miscelaneous cluster'])
+        for cluster_id in sorted_cluster_ids:
+            indices = cluster_indices[cluster_id]
+            if len(indices) == 1:
+                for idx in indices:
+                    writer.writerow(rows[idx])
+
+    with open(html_output_file, 'w', encoding='utf-8') as htmlfile:
+        htmlfile.write('<html>\n<head>\n<meta charset="UTF-8">\n<title>Clusters</title>\n')
+        htmlfile.write('<style>\n')
+        htmlfile.write('table {border-collapse: collapse; width: 100%; }\n')
+        htmlfile.write('th, td {border: 1px solid black; padding: 8px; text-align: left;}\n')
+        htmlfile.write('.cluster-header {background-color: #f2f2f2; font-weight: bold;}\n')
+        htmlfile.write('</style>\n')
+        htmlfile.write('</head>\n<body>\n')
+        htmlfile.write('<table>\n')
+        for cluster_id in sorted_cluster_ids:
+            indices = cluster_indices[cluster_id]
+            if len(indices) > 1:
+                htmlfile.write(f'<tr class="cluster-header"><td colspan="{len(header)}">Cluster items distance: {coherences[cluster_id]:.4f}</td></tr>\n')
+                htmlfile.write('<tr>')
+                for col_name in header:
+                    htmlfile.write(f'<th>{html.escape(col_name)}</th>')
+                htmlfile.write('</tr>\n')
+                for idx in indices:
+                    htmlfile.write('<tr>')
+                    cell_id = -1
+                    for cell in rows[idx]:
+                        cell_id += 1
+                        if header[cell_id] == "Issue key":
+                            htmlfile.write(f'<td><a href="https://issues.redhat.com/browse/{cell}">{html.escape(cell)}</a></td>')
+                        else:
+                            htmlfile.write(f'<td>{html.escape(cell)}</td>')
+                    htmlfile.write('</tr>\n')
+                htmlfile.write(f'<tr><td colspan="{len(header)}">&nbsp;</td></tr>\n' * 2)
+        htmlfile.write(f'<tr class="cluster-header"><td colspan="{len(header)}">Miscellaneous cluster</td></tr>\n')
+        htmlfile.write('<tr>')
+        for col_name in header:
+            htmlfile.write(f'<th>{html.escape(col_name)}</th>')
+        htmlfile.write('</tr>\n')
+        for cluster_id in sorted_cluster_ids:
+            indices = cluster_indices[cluster_id]
+            if len(indices) == 1:
+                for idx in indices:
+                    htmlfile.write('<tr>')
+                    cell_id = -1
+                    for cell in rows[idx]:
+                        cell_id += 1
+                        if header[cell_id] == "Issue key":
+                            htmlfile.write(f'<td><a href="https://issues.redhat.com/browse/{cell}">{html.escape(cell)}</a></td>')
+                        else:
+                            htmlfile.write(f'<td>{html.escape(cell)}</td>')
+                    htmlfile.write('</tr>\n')
+        htmlfile.write('</table>\n</body>\n</html>\n')
+
+
+def synthetic_clusters(n_rows, n_columns, n_clusters, seed):
+    rng = random.Random(seed)
+    header = ['Issue key'] + [f'Column {i}' for i in range(1, n_columns)]
+    words = ['order', 'table', 'customer', 'form', 'date', 'sorting', 'item', 'detail', 'link', 'error',
+             'broken', 'column', 'edit', 'name', 'access', 'rights', 'image', 'cancel', 'page', 'list']
+    # html and csv special characters show up in a few cells
+    special_words = ['<b>form</b>', 'a & b', '"quoted"', 'error;', 'line\nbreak']
+
+    def cell():
+        return ' '.join(rng.choice(special_words) if rng.random() < 0.01 else rng.choice(words)
+                        for _ in range(rng.randint(1, 8)))
+
+    rows = [[f'AAP-{i}'] + [cell() for _ in range(1, n_columns)] for i in range(n_rows)]
+    cluster_indices = {}
+    for idx in range(n_rows):
+        # skewed sizes: many single item clusters and a few big ones
+        cluster_id = int(rng.paretovariate(1.2)) % n_clusters if rng.random() < 0.7 else n_clusters + idx
+        cluster_indices.setdefault(cluster_id, []).append(idx)
+    coherences = {cluster_id: rng.random() for cluster_id in cluster_indices}
+    sorted_cluster_ids = sorted(cluster_indices, key=lambda cid: len(cluster_indices[cid]), reverse=True)
+    return header, rows, cluster_indices, sorted_cluster_ids, coherences
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    data = synthetic_clusters(args.rows, args.columns, args.clusters, args.seed)
+    out_dir = tempfile.mkdtemp(prefix='bench_report_')
+    paths = {name: (os.path.join(out_dir, f'{name}.csv'), os.path.join(out_dir, f'{name}.html'))
+             for name in ['legacy', 'report']}
+
+    def best_time(writer, paths):
+        times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            writer(*paths, *data)
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    legacy_time = best_time(legacy_write_reports, paths['legacy'])
+    report_time = best_time(write_reports, paths['report'])
+
+    identical = all(filecmp.cmp(legacy, new, shallow=False) for legacy, new in zip(paths['legacy'], paths['report']))
+    print(f'{args.rows} rows x {args.columns} columns, {len(data[2])} clusters')
+    print(f'legacy writers: {legacy_time:.3f}s')
+    print(f'write_reports:  {report_time:.3f}s ({legacy_time / report_time:.1f}x faster)')
+    print(f'outputs identical: {identical}')
+    print(f'files in {out_dir}')
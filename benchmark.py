@@ -0,0 +1,299 @@
+import argparse
+import csv
+import hashlib
+import importlib
+import json
+import os
+import platform
+import random
+import re
+import sys
+import tempfile
+import time
+from multiprocessing import get_context
+
+# Benchmark of the embedding -> clustering -> report pipeline of clustering.py.
+#
+# Synthetic semicolon separated jira exports of any size are generated from
+# data/example.csv. Every stage (csv parsing, encoding, clustering, coherence, report
+# writing) runs in its own process with inputs read from the previous stage's files,
+# so its wall time and peak RSS are measured in isolation. The whole pipeline is then
+# run once more end to end in a single process. Results go to a JSON file, and
+# --compare flags stages that got slower or bigger between two results files.
+#
+# --encoder stub uses a hashed bag of words encoder, so the benchmark runs offline.
+# Any other value is loaded as SentenceTransformer (model name or local directory).
+#
+# Example:
+#   python benchmark.py --rows 1000,5000,20000 --encoder stub -o data/bench_new.json
+#   python benchmark.py --compare data/bench_old.json data/bench_new.json
+
+STAGES = ['parse', 'encode', 'cluster', 'coherence', 'report']
+# modules of every stage, imported before its timer starts (ClusterTree imports sklearn.cluster lazily)
+STAGE_MODULES = {
+    'parse': ['streaming'],
+    'encode': [],
+    'cluster': ['cluster_tree', 'knn_clustering', 'sklearn.cluster'],
+    'coherence': ['coherence'],
+    'report': ['report'],
+}
+STUB_DIM = 768
+
+parser = argparse.ArgumentParser(description='Benchmark of the clustering pipeline on synthetic jira exports.')
+parser.add_argument('--rows', type=str, default='1000,5000', help='Comma separated list of export sizes.')
+parser.add_argument('--source', type=str, default='data/example.csv', help='Export used as template for synthetic rows.')
+parser.add_argument('--encoder', type=str, default='stub', help='stub (offline hashed bag of words) or SentenceTransformer model name/path.')
+parser.add_argument('-d', '--distance_threshold', type=float, default=0.5)
+parser.add_argument('-e', '--engine', type=str, default='sklearn', help='Clustering engine, sklearn or knn.')
+parser.add_argument('-o', '--output', type=str, default='benchmark_results.json', help='Results file.')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--keep', action='store_true', help='Keep the generated exports and intermediate files.')
+parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CANDIDATE'), help='Compare two results files instead of running.')
+parser.add_argument('--tolerance', type=float, default=0.10, help='Relative slowdown or memory growth reported as regression.')
+
+
+def generate_export(path, n_rows, source, seed=0):
+    # Jira-like rows: summaries from the source export with mixed in words, plus a few
+    # typical columns. Issue keys are unique.
+    rng = random.Random(seed)
+    with open(source, 'r', encoding='utf-8') as file:
+        reader = csv.reader(file, delimiter=';')
+        header = next(reader)
+        summaries = [row[header.index('Summary')] for row in reader if row]
+    vocabulary = sorted({word for summary in summaries for word in summary.split()})
+    issue_types = ['Bug', 'Story', 'Task', 'Epic']
+    priorities = ['Blocker', 'Critical', 'Major', 'Normal', 'Minor']
+
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file, delimiter=';')
+        writer.writerow(['Summary', 'Issue key', 'Issue Type', 'Priority', 'Description'])
+        for i in range(n_rows):
+            words = rng.choice(summaries).split()
+            for _ in range(rng.randint(0, 3)):
+                words.insert(rng.randint(0, len(words)), rng.choice(vocabulary))
+            description = ' '.join(rng.choice(summaries) for _ in range(rng.randint(1, 4)))
+            writer.writerow([' '.join(words), f'SYN-{i + 1}', rng.choice(issue_types), rng.choice(priorities), description])
+
+
+class StubEncoder:
+    # Hashed bag of words, similar texts get similar vectors. Same encode() interface as SentenceTransformer.
+    def encode(self, lines, **kwargs):
+        import numpy as np
+        embeddings = np.zeros((len(lines), STUB_DIM), dtype=np.float32)
+        for i, line in enumerate(lines):
+            for word in re.findall(r'\w+', line.lower()):
+                digest = hashlib.blake2b(word.encode('utf-8'), digest_size=4).digest()
+                bucket = int.from_bytes(digest[:3], 'little') % STUB_DIM
+                embeddings[i, bucket] += 1.0 if digest[3] & 1 else -1.0
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.maximum(norms, 1e-12)
+
+
+def load_encoder(name):
+    if name == 'stub':
+        return StubEncoder()
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(name)
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        # not available on Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def read_export(csv_path):
+    with open(csv_path, 'r', encoding='utf-8') as file:
+        reader = csv.reader(file, delimiter=';')
+        header = next(reader)
+        rows = list(reader)
+    return header, rows
+
+
+def stage_parse(config):
+    from streaming import line_column_indices
+    header, rows = read_export(config['csv'])
+    col_nums = line_column_indices(header, ['Summary'])
+    lines = [''.join(row[col_num] + ';' for col_num in col_nums) for row in rows]
+    return lines
+
+
+def stage_encode(config, lines):
+    import numpy as np
+    encoder = load_encoder(config['encoder'])
+    start = time.perf_counter()
+    embeddings = np.asarray(encoder.encode(lines), dtype=np.float32)
+    # model loading is not part of the measured encoding time
+    return embeddings, time.perf_counter() - start
+
+
+def stage_cluster(config, embeddings):
+    if config['engine'] == 'knn':
+        from knn_clustering import KnnClusterGraph
+        engine = KnnClusterGraph(embeddings)
+    else:
+        from cluster_tree import ClusterTree
+        engine = ClusterTree(embeddings)
+    labels, _ = engine.cut(config['distance_threshold'])
+    return labels
+
+
+def stage_coherence(embeddings, labels):
+    from coherence import cluster_coherences
+    return cluster_coherences(embeddings, labels)
+
+
+def stage_report(work_dir, config, labels, coherences):
+    from report import write_reports
+    header, rows = read_export(config['csv'])
+    cluster_indices = {}
+    for sentence_id, cluster_id in enumerate(labels):
+        cluster_indices.setdefault(cluster_id, []).append(sentence_id)
+    sorted_cluster_ids = sorted(cluster_indices.keys(), key=lambda cid: len(cluster_indices[cid]), reverse=True)
+    write_reports(os.path.join(work_dir, 'clustered.csv'), os.path.join(work_dir, 'clustered.html'),
+                  header, rows, cluster_indices, sorted_cluster_ids, coherences)
+
+
+def run_stage(stage, work_dir, config):
+    # Runs one stage in this (child) process, inputs and outputs are files in work_dir
+    import numpy as np
+    path = lambda name: os.path.join(work_dir, name)
+    # import time would dominate small runs, it is not part of the measured stage
+    for module in STAGE_MODULES[stage]:
+        importlib.import_module(module)
+    elapsed = None
+    start = time.perf_counter()
+    if stage == 'parse':
+        lines = stage_parse(config)
+        elapsed = time.perf_counter() - start
+        with open(path('lines.json'), 'w', encoding='utf-8') as file:
+            json.dump(lines, file)
+    elif stage == 'encode':
+        with open(path('lines.json'), 'r', encoding='utf-8') as file:
+            lines = json.load(file)
+        embeddings, elapsed = stage_encode(config, lines)
+        np.save(path('embeddings.npy'), embeddings)
+    elif stage == 'cluster':
+        embeddings = np.load(path('embeddings.npy'))
+        start = time.perf_counter()
+        labels = stage_cluster(config, embeddings)
+        elapsed = time.perf_counter() - start
+        np.save(path('labels.npy'), labels)
+    elif stage == 'coherence':
+        embeddings = np.load(path('embeddings.npy'))
+        labels = np.load(path('labels.npy'))
+        start = time.perf_counter()
+        coherences = stage_coherence(embeddings, labels)
+        elapsed = time.perf_counter() - start
+        np.save(path('coherences.npy'), coherences)
+    elif stage == 'report':
+        labels = np.load(path('labels.npy'))
+        coherences = np.load(path('coherences.npy'))
+        start = time.perf_counter()
+        stage_report(work_dir, config, labels, coherences)
+        elapsed = time.perf_counter() - start
+    return {'seconds': elapsed, 'peak_rss_mb': peak_rss_mb()}
+
+
+def run_end_to_end(work_dir, config):
+    start = time.perf_counter()
+    lines = stage_parse(config)
+    embeddings, _ = stage_encode(config, lines)
+    labels = stage_cluster(config, embeddings)
+    coherences = stage_coherence(embeddings, labels)
+    stage_report(work_dir, config, labels, coherences)
+    return {'seconds': time.perf_counter() - start, 'peak_rss_mb': peak_rss_mb(), 'clusters': int(labels.max()) + 1}
+
+
+def in_child(func, *args):
+    # fresh interpreter per measurement, so peak RSS of one stage does not leak into the next
+    with get_context('spawn').Pool(1) as pool:
+        return pool.apply(func, args)
+
+
+def run_benchmark(args):
+    sizes = [int(size) for size in args.rows.split(',') if size]
+    results = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'encoder': args.encoder,
+        'engine': args.engine,
+        'distance_threshold': args.distance_threshold,
+        'runs': [],
+    }
+    for n_rows in sizes:
+        work_dir = tempfile.mkdtemp(prefix=f'benchmark_{n_rows}_')
+        config = {
+            'csv': os.path.join(work_dir, 'export.csv'),
+            'encoder': args.encoder,
+            'engine': args.engine,
+            'distance_threshold': args.distance_threshold,
+        }
+        generate_export(config['csv'], n_rows, args.source, seed=args.seed)
+        print(f'{n_rows} rows ({work_dir})')
+
+        run = {'rows': n_rows, 'stages': {}}
+        for stage in STAGES:
+            measurement = in_child(run_stage, stage, work_dir, config)
+            measurement['rows_per_second'] = n_rows / measurement['seconds'] if measurement['seconds'] else None
+            run['stages'][stage] = measurement
+            print_measurement(stage, measurement)
+        measurement = in_child(run_end_to_end, work_dir, config)
+        measurement['rows_per_second'] = n_rows / measurement['seconds'] if measurement['seconds'] else None
+        run['stages']['end_to_end'] = measurement
+        print_measurement('end_to_end', measurement)
+        results['runs'].append(run)
+
+        if not args.keep:
+            for name in os.listdir(work_dir):
+                os.remove(os.path.join(work_dir, name))
+            os.rmdir(work_dir)
+
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump(results, file, indent=2)
+    print(f'Results written to {args.output}')
+
+
+def print_measurement(stage, measurement):
+    rss = measurement['peak_rss_mb']
+    rss_text = f'{rss:8.1f} MB' if rss is not None else '     n/a'
+    print(f'  {stage:<11} {measurement["seconds"]:9.3f}s  {measurement["rows_per_second"] or 0:11.1f} rows/s  peak RSS {rss_text}')
+
+
+def compare(baseline_path, candidate_path, tolerance):
+    # Returns number of regressions: stages slower or with higher peak RSS than tolerance allows
+    with open(baseline_path, 'r', encoding='utf-8') as file:
+        baseline = {run['rows']: run for run in json.load(file)['runs']}
+    with open(candidate_path, 'r', encoding='utf-8') as file:
+        candidate = {run['rows']: run for run in json.load(file)['runs']}
+
+    regressions = 0
+    for n_rows in sorted(set(baseline) & set(candidate)):
+        print(f'{n_rows} rows')
+        for stage, new in candidate[n_rows]['stages'].items():
+            old = baseline[n_rows]['stages'].get(stage)
+            if old is None:
+                continue
+            flags = []
+            for metric in ['seconds', 'peak_rss_mb']:
+                if old.get(metric) and new.get(metric) is not None and new[metric] > old[metric] * (1 + tolerance):
+                    flags.append(f'{metric} +{(new[metric] / old[metric] - 1) * 100:.0f}%')
+            regressions += len(flags)
+            status = 'REGRESSION ' + ', '.join(flags) if flags else 'ok'
+            print(f'  {stage:<11} {old["seconds"]:9.3f}s -> {new["seconds"]:9.3f}s  {status}')
+    return regressions
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.compare:
+        regressions = compare(args.compare[0], args.compare[1], args.tolerance)
+        print(f'{regressions} regressions (tolerance {args.tolerance * 100:.0f}%)')
+        sys.exit(1 if regressions else 0)
+    run_benchmark(args)
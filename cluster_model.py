@@ -0,0 +1,367 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from collections import Counter
+
+import numpy as np
+
+from knn_clustering import normalize
+from llm_results import text_hash
+from streaming import ROWS_FILE, ROWS_INDEX_FILE, RowStore, line_column_indices
+from text_prep import TextPreparer
+
+# Persisted cluster model for incremental clustering.
+#
+# A full run of clustering.py saves its clusters: header, columns, text preparation
+# settings and distance threshold used, every row with its issue key, its normalized embedding and a stable cluster id.
+# In assign mode only rows with unknown issue keys are encoded. A new row joins the
+# cluster whose farthest member is nearest, if that distance is below the threshold
+# (the complete linkage criterion of the full run), otherwise it starts a new cluster.
+#
+# Once the rows assigned since the last full fit exceed a given ratio of the model,
+# the model is reconsolidated: all rows are clustered again from their stored vectors
+# and new clusters take over the id of the old cluster they share most members with,
+# so cluster ids stay stable between runs.
+#
+# Rows are not loaded into memory: the model refers to them by position in the rows of
+# the run (a list, or the on-disk RowStore of a --streaming run) or in its saved rows,
+# only rows added or replaced since are held in memory. Hashes of the clustered line and
+# of the whole row are saved per row, --diff compares them without reading saved rows.
+#
+# Saved rows, embeddings and hashes are append-only files addressed by the row positions
+# in model.json. Saving a loaded model again appends only rows added or replaced since
+# and writes model.json, all files are written anew after a full run or once rows no
+# longer in the model take up more than half of the saved rows.
+
+MODEL_FILE = 'model.json'
+# float32 embedding and two uint64 hashes per saved row
+VECTORS_FILE = 'embeddings.f32'
+HASHES_FILE = 'hashes.u64'
+# rows are saved in the RowStore format, rows.jsonl and its offsets in rows.idx
+ROWS_TMP_DIR = 'rows.tmp'
+
+# upper bound of similarity block entries (new rows x members) computed at once
+BLOCK_ENTRIES = 2 ** 25
+
+
+def issue_keys(header, rows, columns):
+    # Issue key column identifies rows, hash of the clustered line is used if there is none
+    key_column = header.index('Issue key') if 'Issue key' in header else None
+    col_nums = line_column_indices(header, columns)
+    keys = []
+    for row in rows:
+        if key_column is not None and key_column < len(row) and row[key_column]:
+            keys.append(row[key_column])
+        else:
+            keys.append(text_hash(''.join(row[col_num] + ';' for col_num in col_nums)))
+    return keys
+
+
+def _hash64(text):
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def line_hash(col_nums, row):
+    # hash of the clustered columns of a row
+    return _hash64(''.join(row[col_num] + ';' for col_num in col_nums))
+
+
+def row_hash(row):
+    return _hash64(json.dumps(row, ensure_ascii=False))
+
+
+def _read_rows(filename, dtype, width, positions):
+    # Rows at positions of a raw matrix file, a partly written last row is ignored
+    data = np.fromfile(filename, dtype=dtype)
+    return data[:len(data) // width * width].reshape(-1, width)[positions]
+
+
+def _write_rows(filename, start, matrix):
+    # Writes matrix at row start of a raw matrix file, rows after it are dropped
+    mode = 'r+b' if os.path.exists(filename) else 'wb'
+    with open(filename, mode) as file:
+        file.truncate(start * matrix.shape[1] * matrix.itemsize)
+        file.seek(start * matrix.shape[1] * matrix.itemsize)
+        file.write(np.ascontiguousarray(matrix).tobytes())
+
+
+def stable_cluster_ids(keys, labels, previous_ids, next_id):
+    # Maps labels of a new clustering to cluster ids of a previous one (dict key -> id).
+    # Pairs of (old id, label) sharing most rows are matched first, every old id and
+    # label is matched at most once. Unmatched labels get new ids from next_id.
+    # Returns (id per row, next_id).
+    overlaps = Counter(
+        (previous_ids[key], label) for key, label in zip(keys, labels) if key in previous_ids
+    )
+    label_ids = {}
+    used_ids = set()
+    for (old_id, label), _ in sorted(overlaps.items(), key=lambda item: (-item[1], item[0])):
+        if label not in label_ids and old_id not in used_ids:
+            label_ids[label] = old_id
+            used_ids.add(old_id)
+    for label in sorted(set(labels) - set(label_ids)):
+        label_ids[label] = next_id
+        next_id += 1
+    return np.array([label_ids[label] for label in labels], dtype=np.int64), next_id
+
+
+class ModelRows:
+    # Rows of the model: positions in store (a list or streaming.RowStore), -1 for rows
+    # added or replaced in memory, which are kept in changed (row number -> row)
+    def __init__(self, store, positions=None, changed=None):
+        self.store = store
+        self.positions = np.arange(len(store), dtype=np.int64) if positions is None else positions
+        self.changed = changed or {}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, idx):
+        row = self.changed.get(idx)
+        if row is None:
+            row = self.store[int(self.positions[idx])]
+        return row
+
+    def __setitem__(self, idx, row):
+        self.changed[idx] = row
+
+    def __iter__(self):
+        for idx in range(len(self.positions)):
+            yield self[idx]
+
+    def extend(self, rows):
+        start = len(self.positions)
+        rows = list(rows)
+        self.positions = np.concatenate([self.positions, np.full(len(rows), -1, dtype=np.int64)])
+        self.changed.update((start + i, row) for i, row in enumerate(rows))
+
+    def take(self, indices):
+        # Rows at the given row numbers, numbered from 0
+        changed = {i: self.changed[idx] for i, idx in enumerate(indices.tolist()) if idx in self.changed}
+        return ModelRows(self.store, self.positions[indices], changed)
+
+
+class ClusterModel:
+    def __init__(self, model_name, distance_threshold, header, columns, keys, rows, embeddings, cluster_ids,
+                 next_id, fitted_rows=None, created_at=None, reconsolidated_at=None, prepare=None, hashes=None):
+        self.model_name = model_name
+        self.distance_threshold = distance_threshold
+        self.header = header
+        self.columns = columns
+        # {'column_weights': ..., 'token_budget': ...} of --prepare, None without it
+        self.prepare = prepare
+        self.keys = list(keys)
+        self.rows = rows if isinstance(rows, ModelRows) else ModelRows(rows)
+        self.embeddings = normalize(embeddings)
+        self.cluster_ids = np.asarray(cluster_ids, dtype=np.int64)
+        # line_hash and row_hash of every row, computed when the row is saved
+        self.hashes = np.zeros((len(self.keys), 2), dtype=np.uint64) if hashes is None else hashes
+        self.next_id = next_id
+        # number of rows at the last full fit, assigned rows are the rest
+        self.fitted_rows = len(self.keys) if fitted_rows is None else fitted_rows
+        self.created_at = created_at or time.time()
+        self.reconsolidated_at = reconsolidated_at or self.created_at
+        self.key_index = {key: i for i, key in enumerate(self.keys)}
+
+    @classmethod
+    def from_clustering(cls, model_name, distance_threshold, header, columns, keys, rows, embeddings, labels,
+                        previous=None, prepare=None):
+        # Model of a full run. Ids of a previous model are kept for clusters it shares rows with.
+        previous_ids = {}
+        next_id = 0
+        if previous is not None:
+            previous_ids = dict(zip(previous.keys, previous.cluster_ids.tolist()))
+            next_id = previous.next_id
+        cluster_ids, next_id = stable_cluster_ids(keys, np.asarray(labels).tolist(), previous_ids, next_id)
+        return cls(model_name, distance_threshold, header, columns, keys, rows, embeddings, cluster_ids, next_id,
+                   prepare=prepare)
+
+    @classmethod
+    def load(cls, directory):
+        with open(os.path.join(directory, MODEL_FILE), 'r', encoding='utf-8') as file:
+            meta = json.load(file)
+        positions = np.asarray(meta['positions'], dtype=np.int64)
+        rows = ModelRows(RowStore(directory, existing=True), positions)
+        embeddings = _read_rows(os.path.join(directory, VECTORS_FILE), np.float32, meta['dim'], positions)
+        hashes = _read_rows(os.path.join(directory, HASHES_FILE), np.uint64, 2, positions)
+        return cls(
+            meta['model_name'], meta['distance_threshold'], meta['header'], meta['columns'], meta['keys'], rows,
+            embeddings, meta['cluster_ids'], meta['next_id'], fitted_rows=meta['fitted_rows'],
+            created_at=meta['created_at'], reconsolidated_at=meta['reconsolidated_at'], prepare=meta['prepare'],
+            hashes=hashes,
+        )
+
+    @staticmethod
+    def exists(directory):
+        return os.path.exists(os.path.join(directory, MODEL_FILE))
+
+    def save(self, directory):
+        # model.json is written last, a failed save leaves the old model intact
+        os.makedirs(directory, exist_ok=True)
+        path = lambda name: os.path.join(directory, name)
+        store = self.rows.store
+        saved = isinstance(store, RowStore) and os.path.abspath(store.data_path) == os.path.abspath(path(ROWS_FILE))
+        if saved and len(store) - np.count_nonzero(self.rows.positions >= 0) <= len(self):
+            positions = self._append(store, path)
+        else:
+            positions = self._write(path)
+            store = None
+
+        with open(path(MODEL_FILE + '.tmp'), 'w', encoding='utf-8') as file:
+            json.dump({
+                'model_name': self.model_name,
+                'distance_threshold': self.distance_threshold,
+                'header': self.header,
+                'columns': self.columns,
+                'keys': self.keys,
+                'positions': positions.tolist(),
+                'dim': self.embeddings.shape[1],
+                'cluster_ids': self.cluster_ids.tolist(),
+                'next_id': self.next_id,
+                'fitted_rows': self.fitted_rows,
+                'created_at': self.created_at,
+                'reconsolidated_at': self.reconsolidated_at,
+                'prepare': self.prepare,
+            }, file)
+        os.replace(path(MODEL_FILE + '.tmp'), path(MODEL_FILE))
+        # rows are read from the saved files from now on
+        self.rows = ModelRows(store or RowStore(directory, existing=True), positions)
+
+    def _append(self, store, path):
+        # Appends rows added or replaced since the model was loaded, returns the positions of all rows
+        changed = np.array(sorted(self.rows.changed), dtype=np.int64)
+        start = len(store)
+        col_nums = line_column_indices(self.header, self.columns)
+        rows = [self.rows[i] for i in changed.tolist()]
+        for i, row in zip(changed.tolist(), rows):
+            self.hashes[i] = line_hash(col_nums, row), row_hash(row)
+        store.extend(rows)
+        _write_rows(path(VECTORS_FILE), start, self.embeddings[changed])
+        _write_rows(path(HASHES_FILE), start, self.hashes[changed])
+        positions = self.rows.positions.copy()
+        positions[changed] = np.arange(start, start + len(changed), dtype=np.int64)
+        return positions
+
+    def _write(self, path):
+        # Writes all rows to .tmp files first. Rows are copied one by one, the old rows file
+        # stays readable by this model after it is replaced. Returns the positions of all rows.
+        shutil.rmtree(path(ROWS_TMP_DIR), ignore_errors=True)
+        os.makedirs(path(ROWS_TMP_DIR))
+        rows_store = RowStore(path(ROWS_TMP_DIR))
+        col_nums = line_column_indices(self.header, self.columns)
+        for i, row in enumerate(self.rows):
+            rows_store.append(row)
+            self.hashes[i] = line_hash(col_nums, row), row_hash(row)
+        rows_store.finish()
+        rows_store.close()
+        _write_rows(path(VECTORS_FILE + '.tmp'), 0, self.embeddings)
+        _write_rows(path(HASHES_FILE + '.tmp'), 0, self.hashes)
+        os.replace(os.path.join(path(ROWS_TMP_DIR), ROWS_FILE), path(ROWS_FILE))
+        os.replace(os.path.join(path(ROWS_TMP_DIR), ROWS_INDEX_FILE), path(ROWS_INDEX_FILE))
+        os.rmdir(path(ROWS_TMP_DIR))
+        os.replace(path(VECTORS_FILE + '.tmp'), path(VECTORS_FILE))
+        os.replace(path(HASHES_FILE + '.tmp'), path(HASHES_FILE))
+        return np.arange(len(self), dtype=np.int64)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def line_function(self):
+        # Returns function(row) -> line to encode, prepared like in the run that built the model
+        if self.prepare is not None:
+            return TextPreparer(self.header, self.columns, weights=self.prepare['column_weights'],
+                                token_budget=self.prepare['token_budget']).line
+        col_nums = line_column_indices(self.header, self.columns)
+        return lambda row: ''.join(row[col_num] + ';' for col_num in col_nums)
+
+    def __contains__(self, key):
+        return key in self.key_index
+
+    def assign(self, keys, rows, embeddings):
+        # Adds new rows to the nearest cluster within the distance threshold or to new clusters.
+        # Rows are assigned one after another, later rows see clusters grown by earlier ones.
+        # Returns list of (key, cluster id, max distance to the cluster or None for a new cluster).
+        new = normalize(embeddings)
+        n_new = len(new)
+        if n_new == 0:
+            return []
+
+        # max distance of every new row to every existing cluster, clusters ordered by id
+        order = np.argsort(self.cluster_ids, kind='stable')
+        cluster_list, starts = np.unique(self.cluster_ids[order], return_index=True)
+        members = self.embeddings[order]
+        n_clusters = len(cluster_list)
+        # room for one new cluster per new row
+        max_distances = np.full((n_new, n_clusters + n_new), np.inf, dtype=np.float32)
+        if n_clusters:
+            block = max(1, BLOCK_ENTRIES // len(members))
+            for start in range(0, n_new, block):
+                similarities = new[start:start + block] @ members.T
+                max_distances[start:start + block, :n_clusters] = 1.0 - np.minimum.reduceat(similarities, starts, axis=1)
+        new_distances = 1.0 - new @ new.T
+
+        column_ids = cluster_list.tolist()
+        assigned_ids = np.empty(n_new, dtype=np.int64)
+        results = []
+        for i in range(n_new):
+            column = int(np.argmin(max_distances[i, :len(column_ids)])) if column_ids else 0
+            if column_ids and max_distances[i, column] < self.distance_threshold:
+                distance = float(max_distances[i, column])
+            else:
+                column = len(column_ids)
+                column_ids.append(self.next_id)
+                self.next_id += 1
+                distance = None
+                max_distances[i + 1:, column] = -np.inf
+            # farthest member of the cluster can only get farther for the remaining rows
+            max_distances[i + 1:, column] = np.maximum(max_distances[i + 1:, column], new_distances[i + 1:, i])
+            assigned_ids[i] = column_ids[column]
+            results.append((keys[i], column_ids[column], distance))
+
+        for key in keys:
+            self.key_index[key] = len(self.keys)
+            self.keys.append(key)
+        self.rows.extend(rows)
+        self.embeddings = np.concatenate([self.embeddings, new])
+        self.cluster_ids = np.concatenate([self.cluster_ids, assigned_ids])
+        self.hashes = np.concatenate([self.hashes, np.zeros((n_new, 2), dtype=np.uint64)])
+        return results
+
+    def remove(self, keys):
+        # Drops rows by key, the other rows keep their cluster ids. Returns number of rows removed.
+        removed = {self.key_index[key] for key in keys if key in self.key_index}
+        if not removed:
+            return 0
+        keep = np.array([i for i in range(len(self.keys)) if i not in removed], dtype=np.int64)
+        # fitted rows come first, assigned rows are appended after them
+        self.fitted_rows = int(np.count_nonzero(keep < self.fitted_rows))
+        self.keys = [self.keys[i] for i in keep]
+        self.rows = self.rows.take(keep)
+        self.embeddings = self.embeddings[keep]
+        self.cluster_ids = self.cluster_ids[keep]
+        self.hashes = self.hashes[keep]
+        self.key_index = {key: i for i, key in enumerate(self.keys)}
+        return len(removed)
+
+    def needs_reconsolidation(self, ratio):
+        # True once rows assigned since the last full fit exceed ratio of the fitted rows
+        return len(self.keys) - self.fitted_rows > ratio * max(self.fitted_rows, 1)
+
+    def reconsolidate(self, cluster):
+        # Full refit of all rows, cluster(embeddings, distance_threshold) returns labels.
+        # Returns number of rows that changed cluster id.
+        labels = cluster(self.embeddings, self.distance_threshold)
+        previous_ids = dict(zip(self.keys, self.cluster_ids.tolist()))
+        cluster_ids, self.next_id = stable_cluster_ids(self.keys, np.asarray(labels).tolist(), previous_ids, self.next_id)
+        moved = int(np.count_nonzero(cluster_ids != self.cluster_ids))
+        self.cluster_ids = cluster_ids
+        self.fitted_rows = len(self.keys)
+        self.reconsolidated_at = time.time()
+        return moved
+
+    def labels(self):
+        # Dense labels 0..k-1 for reports and coherence, and the cluster id of every label
+        cluster_list, labels = np.unique(self.cluster_ids, return_inverse=True)
+        return labels, cluster_list
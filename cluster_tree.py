@@ -0,0 +1,77 @@
+import numpy as np
+
+from coherence import coherence_from_sums
+
+# Full agglomerative linkage tree that can be cut at any distance threshold.
+#
+# The tree is fitted once. Cutting it at a new threshold only walks the merges,
+# so the interactive loop in clustering.py does not refit the model for every
+# threshold the user tries.
+#
+# Coherence (mean pairwise cosine distance inside a cluster) is precomputed for
+# every node of the tree from the sum of its normalized member vectors:
+#   sum_{i<j} cos(u_i, u_j) = (|sum u|^2 - m) / 2
+# A cluster produced by any cut is a node of the tree, so its coherence is a lookup.
+
+
+class ClusterTree:
+    def __init__(self, embeddings, linkage='complete'):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        n = len(embeddings)
+        self.n_leaves = n
+
+        if n < 2:
+            self.children = np.empty((0, 2), dtype=np.intp)
+            self.distances = np.empty(0)
+        else:
+            # imported when a tree is built, scripts that do not build one start faster
+            from sklearn.cluster import AgglomerativeClustering
+
+            model = AgglomerativeClustering(
+                n_clusters=1,
+                metric='cosine',
+                linkage=linkage,
+                compute_full_tree=True,
+                compute_distances=True,
+            )
+            model.fit(embeddings)
+            self.children = model.children_
+            self.distances = model.distances_
+            # complete/average/single linkage merge in order of distance, the cut relies on it
+            if np.any(np.diff(self.distances) < 0):
+                raise ValueError(f'Linkage {linkage} does not produce monotonic merge distances')
+
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        normalized = embeddings / np.maximum(norms, 1e-12)
+
+        # node ids follow sklearn: leaves are 0..n-1, merge i creates node n+i
+        n_nodes = n + len(self.children)
+        self.sizes = np.ones(n_nodes, dtype=np.int64)
+        self.sq_norms = np.ones(n_nodes, dtype=np.float64)
+        sums = {}
+        for i, (a, b) in enumerate(self.children):
+            sum_a = normalized[a] if a < n else sums.pop(a)
+            sum_b = normalized[b] if b < n else sums.pop(b)
+            node_sum = sum_a.astype(np.float64) + sum_b
+            sums[n + i] = node_sum
+            self.sizes[n + i] = self.sizes[a] + self.sizes[b]
+            self.sq_norms[n + i] = node_sum @ node_sum
+
+        self.node_coherences = coherence_from_sums(self.sq_norms, self.sizes)
+
+    def cut(self, distance_threshold):
+        # Same semantics as AgglomerativeClustering(distance_threshold=...): merges at or
+        # above the threshold are not applied.
+        # Returns labels per leaf and coherence per label.
+        n = self.n_leaves
+        merges = int(np.searchsorted(self.distances, distance_threshold, side='left'))
+
+        root = np.arange(n + merges)
+        # walk merges top-down, every node inherits the root of its parent
+        for i in range(merges - 1, -1, -1):
+            a, b = self.children[i]
+            root[a] = root[n + i]
+            root[b] = root[n + i]
+
+        cluster_roots, labels = np.unique(root[:n], return_inverse=True)
+        return labels, self.node_coherences[cluster_roots]
@@ -1,7 +1,10 @@
 import sys
 import csv
 import os
-import html
+import atexit
+import tempfile
+from contextlib import closing
+from instrumentation import metrics, set_verbosity, vprint
 
 print("Current Working Directory:", os.getcwd())
 
@@ -14,6 +17,7 @@ def create_output_filename(input_filename, suffix='_clustered'):
 
 linkeage = 'complete'
 all_key = "_all"
+model_name = 'all-mpnet-base-v2'
 
 import argparse
 
@@ -47,7 +51,7 @@ parser.add_argument(
     '--input_file',
     type=str,
     default='issues.csv',
-    help='Name of the csv input file. Output file will be: {input_file}_clustered.csv. Unless output file is specified.'
+    help='Name of the csv input file, or of a .parquet, .arrow or .feather file of which only the selected columns and Issue key are read. Output file will be: {input_file}_clustered.csv. Unless output file is specified.'
 )
 
 # Add the -fo (output file) argument
@@ -67,15 +71,245 @@ parser.add_argument(
     help='Possible values: size (sorts from largest), coherence (sorts clusters with items with smallest distances - thus most coherent clusters first). Default is cluster_size.'
 )
 
+parser.add_argument(
+    '--cache_dir',
+    type=str,
+    default='data/embedding_cache',
+    help='Directory of the persistent embedding cache. Only new or edited issues are encoded, the rest is loaded from the cache. Empty string disables the cache.'
+)
+
+parser.add_argument(
+    '--cache_size',
+    type=int,
+    default=100000,
+    help='Maximum number of embeddings kept in the cache. Least recently used entries are evicted first.'
+)
+
+parser.add_argument(
+    '--streaming',
+    action='store_true',
+    help='Read and encode the csv file in chunks. Rows and embeddings are kept on disk instead of memory, for exports larger than RAM.'
+)
+
+parser.add_argument(
+    '--chunk_size',
+    type=int,
+    default=1024,
+    help='Number of rows read and encoded at once in --streaming mode.'
+)
+
+parser.add_argument(
+    '--prepare',
+    action='store_true',
+    help='Clean texts before encoding: strip markup, urls and stack traces, collapse whitespace and cut every line to --token_budget, shared by columns by --column_weights. The settings are saved in --cluster_model, --assign and --diff use those.'
+)
+
+parser.add_argument(
+    '--column_weights',
+    type=str,
+    default='',
+    help='Share of the token budget per column for --prepare, columns not listed have weight 1. Example: "Summary=3;Description=1"'
+)
+
+parser.add_argument(
+    '--token_budget',
+    type=int,
+    default=None,
+    help='Approximate number of tokens (words) per line for --prepare. Default is 256.'
+)
+
+parser.add_argument(
+    '--backend',
+    type=str,
+    default='torch',
+    help='Encoder backend. Possible values: torch (sentence transformer), onnx (exported model run by ONNX Runtime), onnx_int8 (exported model with int8 weights, fastest, small deviation). Export the model first with: python encoder_backends.py export. Default is torch.'
+)
+
+parser.add_argument(
+    '--onnx_dir',
+    type=str,
+    default='',
+    help='Directory of the exported model for --backend onnx and onnx_int8. Default is data/onnx/all-mpnet-base-v2.'
+)
+
+parser.add_argument(
+    '--encode_workers',
+    type=int,
+    default=0,
+    help='Number of worker processes encoding shards of lines in parallel, each with its own model copy. For CPU-only hosts with many cores. 0 encodes in this process.'
+)
+
+parser.add_argument(
+    '--encode_threads',
+    type=int,
+    default=0,
+    help='Torch threads per encoding worker. 0 divides the cores evenly between --encode_workers.'
+)
+
+parser.add_argument(
+    '--shard_size',
+    type=int,
+    default=256,
+    help='Number of lines of similar length encoded by a worker at once.'
+)
+
+parser.add_argument(
+    '-e',
+    '--engine',
+    type=str,
+    default='sklearn',
+    help='Clustering engine. Possible values: sklearn (exact agglomerative clustering, needs n*n distance matrix), knn (sparse k-nearest-neighbour graph, for 100k+ issues). Default is sklearn.'
+)
+
+parser.add_argument(
+    '--knn_k',
+    type=int,
+    default=30,
+    help='Number of nearest neighbours per issue for --engine knn.'
+)
+
+parser.add_argument(
+    '--knn_sample',
+    type=int,
+    default=2000,
+    help='Size of the random sample used to compare --engine knn with exact clustering. 0 disables the comparison.'
+)
+
+parser.add_argument(
+    '--precision',
+    type=str,
+    default='float32',
+    help='Precision of the embeddings clustered. Possible values: float32, float16 (2x less memory), int8 (4x less memory, one scale per issue). Reduced precision needs --engine knn, the sklearn engine clusters float32 vectors. Default is float32.'
+)
+
+parser.add_argument(
+    '--pca_dims',
+    type=int,
+    default=0,
+    help='Project the embeddings to this many principal dimensions before clustering, faster and smaller at some loss of accuracy. 0 keeps all dimensions.'
+)
+
+parser.add_argument(
+    '--precision_sample',
+    type=int,
+    default=2000,
+    help='Size of the random sample used to compare reduced --precision or --pca_dims with full precision clustering. 0 disables the comparison.'
+)
+
+parser.add_argument(
+    '--cluster_model',
+    type=str,
+    default='',
+    help='Directory of the persisted cluster model. A full run saves its clusters there, --assign adds new issues to them. Cluster ids stay stable between runs.'
+)
+
+parser.add_argument(
+    '--assign',
+    action='store_true',
+    help='Encode only issues that are not in --cluster_model yet and add them to the nearest cluster within its distance threshold, or to new clusters. Not interactive.'
+)
+
+parser.add_argument(
+    '--diff',
+    action='store_true',
+    help='Compare the input file with the issues of --cluster_model by Issue key and text: encode only added and modified issues, drop removed ones and write new clusters, grown clusters and moved issues to {output}_diff.csv and .html. Not interactive.'
+)
+
+parser.add_argument(
+    '--reconsolidate',
+    type=float,
+    default=0.25,
+    help='In --assign and --diff mode, all issues are clustered again once issues assigned since the last full clustering exceed this ratio of the model. 0 reconsolidates on every run.'
+)
+
+parser.add_argument(
+    '--sweep',
+    type=str,
+    default='',
+    help='Cut the clustering at every threshold of the list "0.3,0.4,0.5" or range "0.2:0.6:0.05" and write a summary of cluster counts, sizes and coherences to {output}_sweep.csv. Embeddings and the cluster tree are computed once. Not interactive.'
+)
+
+parser.add_argument(
+    '--sweep_reports',
+    type=int,
+    default=0,
+    help='With --sweep, also write csv and html reports of every threshold ({output}_d0.45.csv) using this many processes in parallel. 0 writes only the summary.'
+)
+
+parser.add_argument(
+    '--columnar_output',
+    type=str,
+    default='',
+    help='Also write Issue key, cluster id and cluster coherence of every issue to this .parquet or .arrow file for analytics. Cluster ids are the stable ids of --cluster_model if it is used.'
+)
+
+parser.add_argument(
+    '--columnar_embeddings',
+    action='store_true',
+    help='With --columnar_output, also write the embedding vector of every issue.'
+)
+
+parser.add_argument(
+    '-v',
+    '--verbose',
+    action='count',
+    default=0,
+    help='Verbosity level. -v prints stage timings as they finish, -vv also prints every line and cluster for debugging.'
+)
+
 # Parse the arguments
 args = parser.parse_args()
 
+# Modules are imported after parsing, so --help and argument errors return at once
+from text_prep import DEFAULT_TOKEN_BUDGET, parse_weights
+from sweep import parse_thresholds
+from columnar import is_columnar
+
+try:
+    column_weights = parse_weights(args.column_weights)
+except ValueError as e:
+    parser.error(f'argument --column_weights: {e}')
+try:
+    sweep_thresholds = parse_thresholds(args.sweep) if args.sweep else None
+except ValueError as e:
+    parser.error(f'argument --sweep: {e}')
+
 # Access the parsed arguments
 distance_threshold = args.distance_threshold
 columns = args.columns
 input_file = args.input_file
-output_file = args.output_file or create_output_filename(input_file)
+# reports of a parquet or arrow input are csv files as well
+output_file = args.output_file or create_output_filename(
+    os.path.splitext(input_file)[0] + '.csv' if is_columnar(input_file) else input_file
+)
 sorting = args.sorting
+cache_dir = args.cache_dir
+cache_size = args.cache_size
+streaming = args.streaming
+chunk_size = args.chunk_size
+prepare = args.prepare
+token_budget = DEFAULT_TOKEN_BUDGET if args.token_budget is None else args.token_budget
+# stored in the cluster model, --assign and --diff prepare lines like the run that built it
+prepare_settings = {'column_weights': column_weights, 'token_budget': token_budget} if prepare else None
+backend = args.backend
+onnx_dir = args.onnx_dir or None
+encode_workers = args.encode_workers
+encode_threads = args.encode_threads or None
+shard_size = args.shard_size
+engine = args.engine
+knn_k = args.knn_k
+knn_sample = args.knn_sample
+precision = args.precision
+pca_dims = args.pca_dims
+precision_sample = args.precision_sample
+verbose = args.verbose
+cluster_model_dir = args.cluster_model
+assign = args.assign
+diff = args.diff
+reconsolidate_ratio = args.reconsolidate
+sweep_reports = args.sweep_reports
+columnar_output = args.columnar_output
+columnar_embeddings = args.columnar_embeddings
 
 columns_tooltip = "(Note that Summary is added as mandatory column)"
 if not (all_key in columns):
@@ -89,6 +323,23 @@ print(f'columns = {columns}   {columns_tooltip}  ')
 print('input_file =', input_file)
 print('output_file =', output_file)
 print('sorting =', sorting)
+print('cache_dir =', cache_dir)
+print('streaming =', streaming)
+if prepare:
+    print(f'prepare = token budget {token_budget}, column weights {column_weights}')
+if backend != 'torch':
+    print('backend =', backend)
+if encode_workers:
+    print('encode_workers =', encode_workers)
+print('engine =', engine)
+if precision != 'float32' or pca_dims:
+    print(f'precision = {precision}' + (f', {pca_dims} dims' if pca_dims else ''))
+if sweep_thresholds:
+    print('sweep =', sweep_thresholds)
+if columnar_output:
+    print('columnar_output =', columnar_output, '(with embeddings)' if columnar_embeddings else '')
+if cluster_model_dir:
+    print('cluster_model =', cluster_model_dir, '(assign)' if assign else '(diff)' if diff else '')
 
 print('-----------------------------');
 print('Note that csv file must use semicollon(;) separator.')
@@ -99,22 +350,252 @@ if sorting not in ['size', 'coherence']:
     print(f"Error: Sorting parameter must be either 'size' or 'coherence'.")
     sys.exit(1)
 
+if engine not in ['sklearn', 'knn']:
+    print(f"Error: Engine parameter must be either 'sklearn' or 'knn'.")
+    sys.exit(1)
+
+if precision not in ['float32', 'float16', 'int8']:
+    print(f"Error: Precision parameter must be one of float32, float16 or int8.")
+    sys.exit(1)
+
+if backend not in ['torch', 'onnx', 'onnx_int8']:
+    print(f"Error: Backend parameter must be one of torch, onnx or onnx_int8.")
+    sys.exit(1)
+
+if precision != 'float32' and engine != 'knn':
+    print(f"Error: --precision {precision} needs --engine knn, the sklearn engine clusters float32 embeddings. --pca_dims works with both engines.")
+    sys.exit(1)
+
+if (assign or diff) and not cluster_model_dir:
+    print(f"Error: --{'assign' if assign else 'diff'} needs the cluster model directory (--cluster_model) saved by a full run.")
+    sys.exit(1)
+
+if columnar_output and not is_columnar(columnar_output):
+    print(f"Error: --columnar_output must be a .parquet, .arrow or .feather file.")
+    sys.exit(1)
 
-from sentence_transformers import SentenceTransformer
-from sklearn.cluster import AgglomerativeClustering
-from sklearn.metrics import pairwise_distances
+if assign and diff:
+    print(f"Error: --assign and --diff can not be used together.")
+    sys.exit(1)
+
+
+from encoder_backends import LazyEncoder, encoder_id, load_encoder
+from sharded_encoder import ShardedEncoder
+from embedding_cache import EmbeddingCache
+from cluster_tree import ClusterTree
+from knn_clustering import KnnClusterGraph, SampleComparison
+from streaming import stream_embeddings
+from text_prep import TextPreparer, encode_unique
+from report import write_reports
+from cluster_model import ClusterModel, issue_keys
+from snapshot_diff import SnapshotDiff
+from coherence import cluster_coherences
+from compact_embeddings import CompactEmbeddings, PrecisionComparison
+from columnar import input_rows, write_clusters
+from sweep import cut_statistics, summary_table, sweep_filename, write_summary, write_sweep_reports
 import numpy as np
+metrics.milestone('imports')
 
 print('-----------------------------');
 sys.stdout.flush()
 
+set_verbosity(verbose)
+# Stage timings and peak memory are printed as a table when the script ends
+atexit.register(lambda: print(metrics.summary_table()))
+
+def load_model():
+    with metrics.stage('model_load'):
+        loaded_model = load_encoder(model_name, backend, onnx_dir)
+    metrics.milestone('model_loaded')
+    return loaded_model
+
+# Embedding model, used either per chunk while streaming or once for all lines
+if encode_workers:
+    # workers load their model copies in the background while the csv file is read
+    with metrics.stage('model_load'):
+        model = ShardedEncoder(model_name, encode_workers, threads_per_worker=encode_threads, shard_size=shard_size,
+                               backend=backend, onnx_dir=onnx_dir)
+    atexit.register(model.close)
+    atexit.register(lambda: print(model.summary()))
+else:
+    # torch and the model are loaded by the first encode call, a run with all lines cached never loads them
+    model = LazyEncoder(load_model)
+if cache_dir:
+    # embeddings of other backends are cached under their own keys
+    embedding_cache = EmbeddingCache(cache_dir, encoder_id(model_name, backend), max_entries=cache_size)
+    atexit.register(lambda: print(embedding_cache.summary()))
+
+# lines of the first encode call that are encoded on their own, for the first_row_encoded milestone
+FIRST_BATCH_SIZE = 32
+
+def encode_lines(lines):
+    if cache_dir:
+        return embedding_cache.encode(model, lines)
+    return model.encode(lines)
+
+def encode(lines):
+    metrics.observe_batch(len(lines))
+    if 'first_row_encoded' in metrics.milestones or len(lines) <= FIRST_BATCH_SIZE:
+        embeddings = encode_lines(lines)
+        metrics.milestone('first_row_encoded')
+        return embeddings
+    # without streaming all lines come in one call, the milestone is taken after the first batch
+    first = np.asarray(encode_lines(lines[:FIRST_BATCH_SIZE]))
+    metrics.milestone('first_row_encoded')
+    return np.concatenate([first, np.asarray(encode_lines(lines[FIRST_BATCH_SIZE:]))])
+
+def fit_labels(embeddings, distance_threshold):
+    if engine == 'knn':
+        return KnnClusterGraph(embeddings, k=knn_k).cut(distance_threshold)[0]
+    return ClusterTree(embeddings, linkage=linkeage).cut(distance_threshold)[0]
+
+def html_filename(output_file):
+    html_output_file = output_file.replace('.csv', '.html')
+    if html_output_file == output_file:
+        html_output_file = output_file + '.html'
+    return html_output_file
+
+def write_columnar(keys, cluster_ids, coherences, embeddings):
+    # coherences are per cluster label, cluster_ids are labels or stable ids of the cluster model
+    with metrics.stage('columnar', rows=len(keys)):
+        write_clusters(columnar_output, keys, cluster_ids, coherences, embeddings if columnar_embeddings else None,
+                       metadata={'model': model_name, 'distance_threshold': distance_threshold})
+    print(f'Issue keys, cluster ids and coherences written to {columnar_output}')
+
+def sort_clusters(cluster_indices, coherences):
+    # Sort the clusters by size
+    if sorting == 'size':
+        return sorted(cluster_indices.keys(), key=lambda cid: len(cluster_indices[cid]), reverse=True)
+    return sorted(cluster_indices.keys(), key=lambda cid: coherences[cid])
+
+# Saved cluster model, a full run keeps its cluster ids for clusters sharing issues with it
+cluster_model = None
+if cluster_model_dir and ClusterModel.exists(cluster_model_dir):
+    cluster_model = ClusterModel.load(cluster_model_dir)
+    if cluster_model.model_name != model_name:
+        print(f'Warning: cluster model was built with {cluster_model.model_name}, its embeddings are not comparable with {model_name}.')
+        if assign or diff:
+            sys.exit(1)
+
+if assign or diff:
+    if cluster_model is None:
+        print(f'Error: No cluster model in {cluster_model_dir}. Run a full clustering with --cluster_model first.')
+        sys.exit(1)
+    print(f'Cluster model: {len(cluster_model)} issues, distance threshold {cluster_model.distance_threshold}, columns {cluster_model.columns}')
+    if cluster_model.prepare is not None:
+        print(f"Cluster model prepares texts: token budget {cluster_model.prepare['token_budget']}, column weights {cluster_model.prepare['column_weights']}")
+    if prepare_settings is not None and prepare_settings != cluster_model.prepare:
+        print('Warning: --prepare, --column_weights and --token_budget are ignored, lines are prepared with the settings of the cluster model.')
+
+    # only columns of the model are read from parquet or arrow files
+    with closing(input_rows(input_file, cluster_model.header)) as reader:
+        header = next(reader)
+        missing_columns = [col for col in cluster_model.columns if col not in header]
+        if missing_columns:
+            print(f"Error: The following columns of the cluster model are missing in the CSV header: {', '.join(missing_columns)}")
+            sys.exit(1)
+        # rows are stored in the column order of the model
+        header_dict = {col_name: idx for idx, col_name in enumerate(header)}
+        col_nums = [header_dict.get(col_name) for col_name in cluster_model.header]
+        new_rows = []
+        new_keys = []
+        seen = set()
+        with metrics.stage('parse') as stage:
+            rows = [[row[col_num] if col_num is not None and col_num < len(row) else '' for col_num in col_nums]
+                    for row in reader if row]
+            keys = issue_keys(cluster_model.header, rows, cluster_model.columns)
+            if diff:
+                snapshot_diff = SnapshotDiff(cluster_model, keys, rows)
+            else:
+                for key, row in zip(keys, rows):
+                    if key not in cluster_model and key not in seen:
+                        seen.add(key)
+                        new_keys.append(key)
+                        new_rows.append(row)
+            stage['rows'] = len(rows)
+
+    if diff:
+        print(snapshot_diff.summary())
+        lines = snapshot_diff.lines
+    else:
+        print(f'{len(rows) - len(new_rows)} issues already clustered, {len(new_rows)} new.')
+        line = cluster_model.line_function()
+        lines = [line(row) for row in new_rows]
+    with metrics.stage('encode', rows=len(lines)):
+        new_embeddings = encode(lines) if lines else np.empty((0, 0))
+    if cache_dir:
+        embedding_cache.save()
+
+    with metrics.stage('assign', rows=len(lines)):
+        if diff:
+            assignments = snapshot_diff.apply(cluster_model, new_embeddings)
+        else:
+            assignments = cluster_model.assign(new_keys, new_rows, new_embeddings)
+    new_clusters = len({cluster_id for _, cluster_id, distance in assignments if distance is None})
+    print(f'{sum(1 for _, _, distance in assignments if distance is not None)} issues joined existing clusters, {new_clusters} new clusters.')
+
+    if cluster_model.needs_reconsolidation(reconsolidate_ratio):
+        print('Clustering all issues again (reconsolidation).')
+        sys.stdout.flush()
+        with metrics.stage('reconsolidate', rows=len(cluster_model)):
+            moved = cluster_model.reconsolidate(fit_labels)
+        print(f'{moved} issues changed cluster.')
+
+    if diff:
+        # only the changes are reported, the full reports are not written again
+        diff_file = create_output_filename(output_file, '_diff')
+        diff_html_file = html_filename(diff_file)
+        with metrics.stage('report', rows=len(lines) + len(snapshot_diff.removed)):
+            new_clusters, grown_clusters, moved = snapshot_diff.write_report(diff_file, diff_html_file, cluster_model)
+            metrics.milestone('first_report')
+        cluster_model.save(cluster_model_dir)
+
+        print('-------------------------------')
+        print(f'{len(new_clusters)} new clusters, {len(grown_clusters)} grown clusters, {len(moved)} moved issues, '
+              f'{len(snapshot_diff.removed)} removed issues')
+        print(f'Changes written to {diff_file} and {diff_html_file}')
+        print(f'Cluster model with {len(cluster_model)} issues saved to {cluster_model_dir}')
+        sys.exit(0)
+
+    labels, _ = cluster_model.labels()
+    coherences = cluster_coherences(cluster_model.embeddings, labels)
+    cluster_indices = {}
+    for sentence_id, cluster_id in enumerate(labels):
+        cluster_indices.setdefault(cluster_id, []).append(sentence_id)
+    sorted_cluster_ids = sort_clusters(cluster_indices, coherences)
+
+    html_output_file = html_filename(output_file)
+    assignments_file = create_output_filename(output_file, '_assignments')
+    with metrics.stage('report', rows=len(cluster_model)):
+        large_clusters_count = write_reports(
+            output_file, html_output_file, cluster_model.header, cluster_model.rows, cluster_indices, sorted_cluster_ids, coherences
+        )
+        metrics.milestone('first_report')
+        with open(assignments_file, 'w', newline='', encoding='utf-8') as csvfile:
+            writer = csv.writer(csvfile, delimiter=';')
+            writer.writerow(['Issue key', 'Cluster', 'New cluster', 'Distance'])
+            # ids may have changed by reconsolidation, current id is looked up
+            for key, _, distance in assignments:
+                writer.writerow([key, cluster_model.cluster_ids[cluster_model.key_index[key]],
+                                 'yes' if distance is None else 'no', '' if distance is None else f'{distance:.4f}'])
+    if columnar_output:
+        write_columnar(cluster_model.keys, cluster_model.cluster_ids, coherences[labels], cluster_model.embeddings)
+    cluster_model.save(cluster_model_dir)
+
+    print('-------------------------------')
+    print(f'Results written to {output_file} and {html_output_file}, new issues and their cluster ids to {assignments_file}')
+    print(f'Total number of clusters (including single item clusters) {len(sorted_cluster_ids)}')
+    print(f'Number of clusters (excluding single item clusters): {large_clusters_count}')
+    print(f'Cluster model with {len(cluster_model)} issues saved to {cluster_model_dir}')
+    sys.exit(0)
+
 lines = []
-with open(input_file, 'r',  encoding='utf-8') as file:
-    reader = csv.reader(file, delimiter=';')
-    rows = list(reader)        # Convert to list of rows
+# only the selected columns and Issue key are read from parquet or arrow files
+projection = None if all_key in columns else columns + ['Issue key']
+with closing(input_rows(input_file, projection)) as reader:
 
-    # select first row and let rows array hold the rest
-    header = rows[0]
+    # select first row and let reader hold the rest
+    header = next(reader)
 
     if all_key in columns:
         columns = []
@@ -129,215 +610,175 @@ with open(input_file, 'r',  encoding='utf-8') as file:
         else:
             print("All specified columns are present in the CSV header.")
 
-    rows = rows[1:]
-    # Create a mapping from column names to their indices
-    header_dict = {col_name: idx for idx, col_name in enumerate(header)}
-
-    for row in rows:
-        line = ''
-
-        for header_item in header_dict:
-            if header_item in columns:
-                col_num = header_dict[header_item]
-                line += row[col_num] + ';'
-        lines.append(line)
-
-
-print('Computing embeddings. This might take a while.')
-print('')
-sys.stdout.flush()
-
-# Embedding
-model = SentenceTransformer('all-mpnet-base-v2')
-embeddings = model.encode(lines)
-embeddings = np.array(embeddings)  # Ensure embeddings is a NumPy array
+    preparer = None
+    if prepare:
+        preparer = TextPreparer(header, columns, weights=column_weights, token_budget=token_budget)
+        atexit.register(lambda: print(preparer.summary()))
+
+    if streaming:
+        # rows and embeddings are spilled to disk chunk by chunk, nothing is held in lists
+        print(f'Computing embeddings in chunks of {chunk_size} rows. This might take a while.')
+        print('')
+        sys.stdout.flush()
+        spill_dir = tempfile.TemporaryDirectory(prefix='clustering_')
+        # parsing and encoding are interleaved, both are timed as one stage
+        with metrics.stage('encode') as stage:
+            rows, embeddings = stream_embeddings(
+                reader, header, columns, lambda lines: encode_unique(encode, lines), spill_dir.name, chunk_size=chunk_size,
+                progress=lambda count: print(f'Encoded {count} rows', flush=True),
+                make_line=preparer.line if preparer else None
+            )
+            stage['rows'] = len(rows)
+    else:
+        with metrics.stage('parse') as stage:
+            rows = list(reader)        # Convert to list of rows
+            # Create a mapping from column names to their indices
+            header_dict = {col_name: idx for idx, col_name in enumerate(header)}
+
+            for row in rows:
+                if preparer:
+                    line = preparer.line(row)
+                else:
+                    line = ''
+
+                    for header_item in header_dict:
+                        if header_item in columns:
+                            col_num = header_dict[header_item]
+                            line += row[col_num] + ';'
+                lines.append(line)
+                vprint(2, 'line =', line)
+            stage['rows'] = len(rows)
+
+if not streaming:
+    print('Computing embeddings. This might take a while.')
+    print('')
+    sys.stdout.flush()
+    with metrics.stage('encode', rows=len(lines)):
+        # identical texts are encoded once
+        embeddings = encode_unique(encode, lines)
+
+if cache_dir:
+    embedding_cache.save()
+embeddings = np.asarray(embeddings)  # Ensure embeddings is a NumPy array, memmap is not copied
 # line 155 not used in API
-while True:
-    clustering_model = AgglomerativeClustering(
-            n_clusters=None,
-            distance_threshold=distance_threshold,  # Adjust this threshold based on your data
-            metric='cosine',              # Use 'cosine' if you prefer cosine distance
-            linkage=linkeage,             # 'ward' linkage works well with euclidean distance
-        )
+# Clustering runs on reduced precision embeddings, reports and the cluster model keep full ones
+cluster_embeddings = embeddings
+precision_comparison = None
+if precision != 'float32' or pca_dims:
+    with metrics.stage('compact', rows=len(embeddings)):
+        cluster_embeddings = CompactEmbeddings(embeddings, precision, dims=pca_dims or None)
+    print(cluster_embeddings.summary())
+    if precision_sample > 0:
+        precision_comparison = PrecisionComparison(embeddings, cluster_embeddings, sample_size=precision_sample)
+
+# Full linkage tree (or kNN graph) is built once, each new threshold only cuts it
+comparison = None
+if engine == 'knn':
+    print(f'Building {knn_k}-nearest-neighbour graph.')
+    sys.stdout.flush()
+    with metrics.stage('build', rows=len(embeddings)):
+        cluster_engine = KnnClusterGraph(cluster_embeddings, k=knn_k)
+    if knn_sample > 0:
+        comparison = SampleComparison(embeddings, knn_k, sample_size=knn_sample)
+else:
+    print('Building cluster tree.')
+    sys.stdout.flush()
+    with metrics.stage('build', rows=len(embeddings)):
+        # the tree needs a float32 matrix, only --pca_dims reduces it
+        cluster_engine = ClusterTree(cluster_embeddings[:], linkage=linkeage)
+
+if sweep_thresholds:
+    # every threshold is a cut of the same tree, reports are written after all cuts
+    statistics = []
+    report_jobs = []
+    for threshold in sweep_thresholds:
+        with metrics.stage('cut', rows=len(embeddings)):
+            cluster_assignment, coherences = cluster_engine.cut(threshold)
+        statistics.append(cut_statistics(threshold, cluster_assignment, coherences))
+        if sweep_reports:
+            cluster_indices = {}
+            for sentence_id, cluster_id in enumerate(cluster_assignment):
+                cluster_indices.setdefault(cluster_id, []).append(sentence_id)
+            sweep_output_file = sweep_filename(output_file, threshold)
+            report_jobs.append((threshold, sweep_output_file, html_filename(sweep_output_file), cluster_indices,
+                                sort_clusters(cluster_indices, coherences), coherences))
+
+    summary_file = os.path.splitext(output_file)[0] + '_sweep.csv'
+    write_summary(summary_file, statistics)
+    print('-------------------------------')
+    print(summary_table(statistics))
+    print(f'Sweep summary written to {summary_file}')
+    metrics.milestone('first_report')
+    if comparison:
+        for threshold in sweep_thresholds:
+            print(comparison.report(threshold))
+    if precision_comparison:
+        for threshold in sweep_thresholds:
+            print(precision_comparison.report(threshold))
+
+    if report_jobs:
+        print(f'Writing reports of {len(report_jobs)} thresholds with {min(sweep_reports, len(report_jobs))} processes.')
+        sys.stdout.flush()
+        with metrics.stage('report', rows=len(rows) * len(report_jobs)):
+            for threshold, large_clusters_count in write_sweep_reports(header, rows, report_jobs, sweep_reports):
+                print(f'Threshold {threshold:g}: {large_clusters_count} clusters with more than one issue written to '
+                      f'{sweep_filename(output_file, threshold)}')
+    sys.exit(0)
 
-    clustering_model.fit(embeddings)
-    cluster_assignment = clustering_model.labels_
+while True:
+    # cut also computes the coherence of every cluster
+    with metrics.stage('cut', rows=len(embeddings)):
+        cluster_assignment, coherences = cluster_engine.cut(distance_threshold)
 
     # Mapping from cluster ID to list of sentence indices
     cluster_indices = {}
     for sentence_id, cluster_id in enumerate(cluster_assignment):
         cluster_indices.setdefault(cluster_id, []).append(sentence_id)
 
-    # Compute coherence for each cluster
-    coherences = {}
-    for cluster_id, indices in cluster_indices.items():
-        if len(indices) < 2:
-            coherence = 0.0  # Coherence is zero if there's only one sentence in the cluster
-        else:
-            cluster_embeddings = embeddings[indices]
-            distances = pairwise_distances(cluster_embeddings, metric='cosine')
-            n = distances.shape[0]
-            triu_indices = np.triu_indices(n, k=1)
-            upper_tri_distances = distances[triu_indices]
-            coherence = upper_tri_distances.mean()
-        coherences[cluster_id] = coherence
-
-    # Organize sentences by clusters and sort them
-    clustered_sentences = {}
-    for sentence_id, cluster_id in enumerate(cluster_assignment):
-        clustered_sentences.setdefault(cluster_id, []).append(lines[sentence_id])
+    sorted_cluster_ids = sort_clusters(cluster_indices, coherences)
 
-
-    # Sort the clusters by size
-    if sorting == 'size':
-        sorting_set = True
-        sorted_clusters = sorted(clustered_sentences.items(), key=lambda item: len(item[1]), reverse=True)
-        max_clusters = len(sorted_clusters)
-
-        sorted_cluster_ids = sorted(cluster_indices.keys(), key=lambda cid: len(cluster_indices[cid]), reverse=True)
-
-    if sorting == 'coherence':
-        sorted_clusters = sorted(clustered_sentences.items(), key=lambda item: coherences[item[0]])
-        max_clusters = len(sorted_clusters)
-
-        sorted_cluster_ids = sorted(cluster_indices.keys(), key=lambda cid: coherences[cid])
+    vprint(2, 'sorted_cluster_ids =', sorted_cluster_ids)
 
     large_clusters_count = 0
+    html_output_file = html_filename(output_file)
     success = False
     while not success:
         try:
-            # Open the CSV file for writing
-            with open(output_file, 'w', newline='',  encoding='utf-8') as csvfile:
-                writer = csv.writer(csvfile, delimiter=';')
-
-                # Write the header
-                writer.writerow(header)
-                large_clusters_count = 0
-                # Write clusters to the CSV file
-                for cluster_id in sorted_cluster_ids:
-                    indices = cluster_indices[cluster_id]
-
-                    if len(indices) > 1:
-                        writer.writerow([ f'Cluster items distance: {coherences[cluster_id]:.4f}'])
-
-                    for idx in indices:
-                        if len(indices) > 1:
-                            writer.writerow(rows[idx])
-                    # Write empty lines to separate clusters
-                    if len(indices) > 1:
-                        large_clusters_count = large_clusters_count + 1
-                        writer.writerow([])
-                        writer.writerow([])
-                        writer.writerow([])
-                        writer.writerow([])
-
-                # write miscelaneous cluster
-                writer.writerow([ f'Miscelaneous cluster'])
-                for cluster_id in sorted_cluster_ids:
-                    indices = cluster_indices[cluster_id]
-
-                    if len(indices) == 1:
-                        for idx in indices:
-                            writer.writerow(rows[idx])
-
-
+            # csv and html reports are written in one pass over the clusters
+            with metrics.stage('report', rows=len(rows)):
+                large_clusters_count = write_reports(
+                    output_file, html_output_file, header, rows, cluster_indices, sorted_cluster_ids, coherences
+                )
+            metrics.milestone('first_report')
             success = True  # Writing succeeded, exit the loop
         except Exception as e:
             print(e)
             print("--------------------------------------------------------------------------------------------------------------")
-            print(f"Error: Writing to {output_file} threw an exception. Make sure you don't have your file opened and locked for writing. Please resolve the problem and press any key to write the file again.")
-            input()
-
-    # now write it into html file
-    success = False
-    html_output_file = output_file.replace('.csv', '.html')
-    while not success:
-        try:
-            # Open the HTML file for writing
-            with open(html_output_file, 'w', encoding='utf-8') as htmlfile:
-                # Write the initial HTML structure
-                htmlfile.write('<html>\n<head>\n<meta charset="UTF-8">\n<title>Clusters</title>\n')
-                htmlfile.write('<style>\n')
-                # Add some CSS styles here if needed
-                htmlfile.write('table {border-collapse: collapse; width: 100%; }\n')
-                htmlfile.write('th, td {border: 1px solid black; padding: 8px; text-align: left;}\n')
-                htmlfile.write('.cluster-header {background-color: #f2f2f2; font-weight: bold;}\n')
-                htmlfile.write('</style>\n')
-                htmlfile.write('</head>\n<body>\n')
-
-                htmlfile.write('<table>\n')
-
-                large_clusters_count = 0
-
-                # Write clusters to the HTML file
-                for cluster_id in sorted_cluster_ids:
-                    indices = cluster_indices[cluster_id]
-
-                    if len(indices) > 1:
-                        # Write the cluster header row
-                        htmlfile.write(f'<tr class="cluster-header"><td colspan="{len(header)}">Cluster items distance: {coherences[cluster_id]:.4f}</td></tr>\n')
-
-                        # Write the header row
-                        htmlfile.write('<tr>')
-                        for col_name in header:
-                            htmlfile.write(f'<th>{html.escape(col_name)}</th>')
-                        htmlfile.write('</tr>\n')
-
-                        # Write the data rows
-                        for idx in indices:
-                            htmlfile.write('<tr>')
-                            cell_id = -1
-                            for cell in rows[idx]:
-                                cell_id += 1
-                                if header[cell_id] == "Issue key":
-                                    htmlfile.write(f'<td><a href="https://issues.redhat.com/browse/{cell}">{html.escape(cell)}</a></td>')
-                                else:
-                                    htmlfile.write(f'<td>{html.escape(cell)}</td>')
-                            htmlfile.write('</tr>\n')
-
-                        # Write empty lines to separate clusters
-                        large_clusters_count += 1
-                        htmlfile.write(f'<tr><td colspan="{len(header)}">&nbsp;</td></tr>\n' * 2)
-
-                # Write miscellaneous cluster
-                htmlfile.write(f'<tr class="cluster-header"><td colspan="{len(header)}">Miscellaneous cluster</td></tr>\n')
-
-                # Write the header row
-                htmlfile.write('<tr>')
-                for col_name in header:
-                    htmlfile.write(f'<th>{html.escape(col_name)}</th>')
-                htmlfile.write('</tr>\n')
-
-                for cluster_id in sorted_cluster_ids:
-                    indices = cluster_indices[cluster_id]
-
-                    if len(indices) == 1:
-                        for idx in indices:
-                            htmlfile.write('<tr>')
-                            cell_id = -1
-                            for cell in rows[idx]:
-                                cell_id += 1
-                                if header[cell_id] == "Issue key":
-                                    htmlfile.write(f'<td><a href="https://issues.redhat.com/browse/{cell}">{html.escape(cell)}</a></td>')
-                                else:
-                                    htmlfile.write(f'<td>{html.escape(cell)}</td>')
-                            htmlfile.write('</tr>\n')
-
-                # Close the table and HTML tags
-                htmlfile.write('</table>\n</body>\n</html>\n')
-
-                success = True  # Writing succeeded, exit the loop
-        except Exception as e:
-            print("--------------------------------------------------------------------------------------------------------------")
-            print(f"Error: Writing to {html_output_file} threw an exception. Make sure you don't have your file opened and locked for writing. Please resolve the problem and press any key to write the file again.")
+            print(f"Error: Writing to {output_file} or {html_output_file} threw an exception. Make sure you don't have your files opened and locked for writing. Please resolve the problem and press any key to write the files again.")
             input()
 
-
-
     print('-------------------------------')
     print(f'Results written to {output_file} and {html_output_file}')
     print(f'Total number of clusters (including single item clusters) {len(sorted_cluster_ids)}')
     print(f'Number of clusters (excluding single item clusters): {large_clusters_count}')
+    if cluster_model_dir:
+        # clusters of the last threshold are the model new issues are assigned to
+        cluster_model = ClusterModel.from_clustering(
+            model_name, distance_threshold, header, columns, issue_keys(header, rows, columns), rows, embeddings,
+            cluster_assignment, previous=cluster_model, prepare=prepare_settings
+        )
+        cluster_model.save(cluster_model_dir)
+        print(f'Cluster model saved to {cluster_model_dir}')
+    if columnar_output:
+        write_columnar(
+            cluster_model.keys if cluster_model_dir else issue_keys(header, rows, columns),
+            cluster_model.cluster_ids if cluster_model_dir else cluster_assignment,
+            coherences[cluster_assignment], embeddings
+        )
+    if comparison:
+        print(comparison.report(distance_threshold))
+    if precision_comparison:
+        print(precision_comparison.report(distance_threshold))
     print()
     print('Results are delimited by several empty lines. Last cluster is miscelaneous cluster - anything that does not belong to any cluster is mixed here.')
     print()
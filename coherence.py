@@ -0,0 +1,49 @@
+import numpy as np
+from scipy import sparse
+
+# Cluster coherence = mean pairwise cosine distance between the members of a cluster.
+#
+# For normalized vectors u_1..u_m with sum S:
+#   sum_{i<j} cos(u_i, u_j) = (|S|^2 - m) / 2
+# so the mean pairwise distance is 1 - (|S|^2 - m) / (m * (m - 1)).
+# Only per-cluster sums are needed, the pairwise distance matrix is never built.
+
+# rows normalized and summed at once, bounds the float64 copy of the embeddings
+BLOCK_SIZE = 65536
+
+
+def coherence_from_sums(sq_norms, sizes):
+    # sq_norms[c] = |S_c|^2, sizes[c] = m_c. Single item clusters have coherence 0.
+    sizes = np.asarray(sizes, dtype=np.float64)
+    pairs = np.maximum(sizes * (sizes - 1), 1)
+    coherences = np.where(sizes > 1, 1.0 - (np.asarray(sq_norms) - sizes) / pairs, 0.0)
+    # rounding can push identical vectors slightly below zero
+    return np.maximum(coherences, 0.0)
+
+
+def cluster_sums(embeddings, labels, n_clusters=None):
+    # Sums of normalized vectors per label, in one pass over the label array
+    labels = np.asarray(labels)
+    n = len(labels)
+    if n_clusters is None:
+        n_clusters = int(labels.max()) + 1 if n else 0
+    sums = np.zeros((n_clusters, embeddings.shape[1]), dtype=np.float64)
+    for start in range(0, n, BLOCK_SIZE):
+        end = min(start + BLOCK_SIZE, n)
+        block = np.array(embeddings[start:end], dtype=np.float64)
+        block /= np.maximum(np.linalg.norm(block, axis=1, keepdims=True), 1e-12)
+        indicator = sparse.csr_matrix(
+            (np.ones(end - start), (labels[start:end], np.arange(end - start))),
+            shape=(n_clusters, end - start),
+        )
+        sums += indicator @ block
+    return sums
+
+
+def cluster_coherences(embeddings, labels, n_clusters=None):
+    # Returns coherence per label (array indexed by label), same numbers as
+    # pairwise_distances(..., metric='cosine') upper triangle mean
+    labels = np.asarray(labels)
+    sums = cluster_sums(embeddings, labels, n_clusters)
+    sizes = np.bincount(labels, minlength=len(sums))
+    return coherence_from_sums(np.einsum('ij,ij->i', sums, sums), sizes)
@@ -0,0 +1,93 @@
+import csv
+
+import numpy as np
+
+# Parquet and Arrow input and output.
+#
+# Input files with a .parquet, .arrow or .feather extension are read with pyarrow instead
+# of csv.reader. Only the projected columns are read: parquet skips the column chunks of
+# other columns, Arrow IPC files are memory-mapped and other columns are never touched.
+# Cells are converted to strings, so rows look like csv rows to the rest of the pipeline.
+#
+# The clusters output has one row per issue: Issue key, Cluster (id), Coherence of its
+# cluster and optionally Embedding (fixed size list of float32). Numeric columns wrap the
+# NumPy arrays without copying, an .arrow/.feather output writes their buffers as they
+# are, a .parquet output encodes and compresses them.
+#
+# pyarrow is imported only when such a file is read or written.
+
+COLUMNAR_EXTENSIONS = ['.parquet', '.arrow', '.feather']
+BATCH_SIZE = 4096
+
+
+def is_columnar(filename):
+    return any(filename.lower().endswith(extension) for extension in COLUMNAR_EXTENSIONS)
+
+
+def _open(source, filename):
+    # (schema names, function(columns) -> record batches) of a parquet or Arrow IPC file.
+    # source is a path or a binary file object, filename decides the format.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if not isinstance(source, str):
+        source = pa.BufferReader(source.read())
+    if filename.lower().endswith('.parquet'):
+        parquet_file = pq.ParquetFile(source)
+        return parquet_file.schema_arrow.names, \
+            lambda columns: parquet_file.iter_batches(batch_size=BATCH_SIZE, columns=columns)
+    if isinstance(source, str):
+        source = pa.memory_map(source)
+    ipc_file = pa.ipc.open_file(source)
+    return ipc_file.schema.names, \
+        lambda columns: (ipc_file.get_batch(i).select(columns) for i in range(ipc_file.num_record_batches))
+
+
+def _cell(value):
+    return '' if value is None else value if isinstance(value, str) else str(value)
+
+
+def table_rows(source, filename, columns=None):
+    # Yields the header, then rows of string cells, like csv.reader. Only columns present in
+    # the file are read, in file order, all of them if columns is None.
+    names, batches = _open(source, filename)
+    header = names if columns is None else [name for name in names if name in columns]
+    yield header
+    for batch in batches(header):
+        cells = [[_cell(value) for value in column.to_pylist()] for column in batch.columns]
+        for row in zip(*cells):
+            yield list(row)
+
+
+def input_rows(filename, columns=None):
+    # Header and rows of the input file: a semicolon separated csv file (always read whole,
+    # columns is ignored) or the projected columns of a parquet or Arrow file
+    if is_columnar(filename):
+        yield from table_rows(filename, filename, columns)
+        return
+    with open(filename, 'r', encoding='utf-8') as file:
+        yield from csv.reader(file, delimiter=';')
+
+
+def write_clusters(filename, keys, cluster_ids, coherences, embeddings=None, metadata=None):
+    # One row per issue, coherences are per issue (the coherence of its cluster)
+    import pyarrow as pa
+
+    columns = {
+        'Issue key': pa.array(keys, type=pa.string()),
+        'Cluster': pa.array(np.ascontiguousarray(cluster_ids, dtype=np.int64)),
+        'Coherence': pa.array(np.ascontiguousarray(coherences, dtype=np.float32)),
+    }
+    if embeddings is not None:
+        # a float32 matrix (or its memory map) is wrapped as it is
+        matrix = np.ascontiguousarray(embeddings, dtype=np.float32)
+        columns['Embedding'] = pa.FixedSizeListArray.from_arrays(pa.array(matrix.reshape(-1)), matrix.shape[1])
+    table = pa.table(columns, metadata={name: str(value) for name, value in (metadata or {}).items()})
+
+    if filename.lower().endswith('.parquet'):
+        import pyarrow.parquet as pq
+        pq.write_table(table, filename)
+    else:
+        with pa.OSFile(filename, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    return table.num_rows
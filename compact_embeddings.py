@@ -0,0 +1,130 @@
+import time
+
+import numpy as np
+
+from cluster_tree import ClusterTree
+from knn_clustering import normalize
+
+# Reduced precision embeddings for large exports.
+#
+# Normalized embeddings are optionally projected to fewer dimensions (PCA without
+# centering, so dot products and cosine distances are preserved as well as possible)
+# and stored as float16 or as int8 with one scale per row:
+#   u ~ scale * q,  u . v ~ scale_u * scale_v * (q_u . q_v)
+# The int8 dot product of up to 1024 dimensions is exact in float32, so similarities are
+# computed on the integer codes block by block and scaled afterwards. Blocks are small,
+# the compact matrix is never expanded to float32 as a whole.
+#
+# CompactEmbeddings can be used in place of the embedding matrix by KnnClusterGraph and
+# coherence: indexing returns decoded float32 rows, similarities() runs on the codes.
+
+PRECISIONS = ['float32', 'float16', 'int8']
+# rows decoded at once by similarities() and __getitem__ slices
+BLOCK_ROWS = 65536
+
+
+class CompactEmbeddings:
+    def __init__(self, embeddings, precision='float16', dims=None, sample_size=20000, seed=0):
+        if precision not in PRECISIONS:
+            raise ValueError(f"Precision must be one of {', '.join(PRECISIONS)}")
+        start_time = time.perf_counter()
+        n = len(embeddings)
+        self.precision = precision
+        self.original_shape = (n, embeddings.shape[1] if n else 0)
+        self.components = None
+        self.explained = 1.0
+
+        if dims and n and dims < embeddings.shape[1]:
+            # principal directions of a sample of the corpus
+            rng = np.random.default_rng(seed)
+            sample = normalize(embeddings[np.sort(rng.choice(n, size=min(n, sample_size), replace=False))])
+            _, singular_values, vt = np.linalg.svd(sample, full_matrices=False)
+            self.components = vt[:dims].astype(np.float32)
+            energy = singular_values ** 2
+            self.explained = float(energy[:dims].sum() / energy.sum())
+        dim = len(self.components) if self.components is not None else self.original_shape[1]
+
+        dtype = {'float32': np.float32, 'float16': np.float16, 'int8': np.int8}[precision]
+        self.codes = np.empty((n, dim), dtype=dtype)
+        self.scales = np.ones(n, dtype=np.float32) if precision == 'int8' else None
+        for start in range(0, n, BLOCK_ROWS):
+            end = min(start + BLOCK_ROWS, n)
+            block = normalize(embeddings[start:end])
+            if self.components is not None:
+                block = normalize(block @ self.components.T)
+            if precision == 'int8':
+                scales = np.maximum(np.abs(block).max(axis=1), 1e-12) / 127.0
+                self.codes[start:end] = np.rint(block / scales[:, None])
+                self.scales[start:end] = scales
+            else:
+                self.codes[start:end] = block
+        self.seconds = time.perf_counter() - start_time
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, rows):
+        # decoded float32 rows, unit length up to quantization error
+        block = self.codes[rows].astype(np.float32)
+        if self.scales is not None:
+            block *= self.scales[rows][..., None]
+        return block
+
+    def similarities(self, rows, columns=slice(None)):
+        # Cosine similarities of rows x columns, computed on the codes
+        left = self.codes[rows].astype(np.float32)
+        if isinstance(columns, slice):
+            column_ids = np.arange(*columns.indices(len(self.codes)))
+        else:
+            column_ids = np.asarray(columns)
+        result = np.empty((len(left), len(column_ids)), dtype=np.float32)
+        for start in range(0, len(column_ids), BLOCK_ROWS):
+            block_ids = column_ids[start:start + BLOCK_ROWS]
+            result[:, start:start + len(block_ids)] = left @ self.codes[block_ids].astype(np.float32).T
+        if self.scales is not None:
+            result *= self.scales[rows][:, None]
+            result *= self.scales[column_ids][None, :]
+        return result
+
+    def summary(self):
+        n, dim = self.original_shape
+        full_bytes = n * dim * 4
+        projection = f', PCA {dim} -> {self.shape[1]} dims ({self.explained * 100:.1f}% of variance)' \
+            if self.components is not None else ''
+        return (f'Compact embeddings: {self.precision}{projection}, {self.nbytes / 2 ** 20:.1f} MB instead of '
+                f'{full_bytes / 2 ** 20:.1f} MB ({full_bytes / max(self.nbytes, 1):.1f}x smaller), '
+                f'built in {self.seconds:.2f}s')
+
+
+class PrecisionComparison:
+    # Clusters a random sample at full and at reduced precision and reports agreement
+    def __init__(self, embeddings, compact, sample_size=2000, seed=0):
+        n = len(embeddings)
+        rng = np.random.default_rng(seed)
+        self.sample = np.sort(rng.choice(n, size=min(n, sample_size), replace=False))
+        full = normalize(embeddings[self.sample])
+        reduced = compact[self.sample]
+        self.full = ClusterTree(full)
+        self.reduced = ClusterTree(reduced)
+        pairs = rng.integers(0, len(self.sample), size=(min(100000, len(self.sample) ** 2), 2))
+        full_distances = 1.0 - np.einsum('ij,ij->i', full[pairs[:, 0]], full[pairs[:, 1]])
+        reduced_distances = 1.0 - np.einsum('ij,ij->i', reduced[pairs[:, 0]], reduced[pairs[:, 1]])
+        self.distance_error = float(np.abs(full_distances - reduced_distances).mean()) if len(pairs) else 0.0
+
+    def report(self, distance_threshold):
+        from sklearn.metrics import adjusted_rand_score
+
+        full_labels, _ = self.full.cut(distance_threshold)
+        reduced_labels, _ = self.reduced.cut(distance_threshold)
+        ari = adjusted_rand_score(full_labels, reduced_labels)
+        return (f'Reduced vs full precision on {len(self.sample)} sampled issues: adjusted rand index {ari:.4f}, '
+                f'{full_labels.max() + 1} full vs {reduced_labels.max() + 1} reduced precision clusters, '
+                f'mean cosine distance error {self.distance_error:.5f}')
@@ -0,0 +1,297 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:     # Windows, the cache is then safe only within one process
+    fcntl = None
+
+# On-disk embedding store shared by clustering.py and app.py.
+#
+# Layout of the cache directory:
+#   vectors.f32  - float32 matrix (capacity x dim), opened as numpy memmap
+#   index.json   - {"dim": ..., "slots": ..., "entries": [[key, slot], ...], "free": [...]},
+#                  entries from least to most recently used
+#   index.log    - "key slot" lines of vectors stored since index.json was written
+#
+# Key is a hash of the model name and the line text, so the same issue text
+# encoded by a different model never collides. Only lines that are not in the
+# cache are sent to the model, everything else is read from the memmap.
+#
+# clustering.py, app.py and backend_issues.py may use the same directory at once. Every
+# process holds an flock on the lock file while it reads or writes slots and first reads
+# what other processes appended to index.log since (or index.json, if one of them replaced
+# it), so two processes never hand out the same slot. Storing new vectors only appends to
+# index.log, index.json is rewritten (and the log emptied) by save().
+#
+# Entries are kept in least recently used order, eviction takes them from the front.
+
+VECTORS_FILE = 'vectors.f32'
+INDEX_FILE = 'index.json'
+LOG_FILE = 'index.log'
+LOCK_FILE = 'lock'
+
+
+def cache_key(model_name, line):
+    return hashlib.blake2b(f'{model_name}\n{line}'.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, cache_dir, model_name, max_entries=100000):
+        self.cache_dir = cache_dir
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.vectors_path = os.path.join(cache_dir, VECTORS_FILE)
+        self.index_path = os.path.join(cache_dir, INDEX_FILE)
+        self.log_path = os.path.join(cache_dir, LOG_FILE)
+        self.lock_path = os.path.join(cache_dir, LOCK_FILE)
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.dim = None
+        self.entries = OrderedDict()    # key -> slot, least recently used first
+        self.slot_keys = {}             # slot -> key
+        self.slots = 0                  # slots handed out so far
+        self.free = set()
+        self.used = OrderedDict()       # keys used by this process since the last save()
+        self.vectors = None
+        self.capacity = 0
+        self.index_signature = None     # index.json this process has seen last
+        self.log_offset = 0             # bytes of index.log this process has applied
+
+        os.makedirs(cache_dir, exist_ok=True)
+        with self._file_lock(shared=True):
+            self._refresh()
+
+    @contextmanager
+    def _file_lock(self, shared=False):
+        # Lock between processes, taken inside self.lock
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_path, 'a') as file:
+            fcntl.flock(file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+    def _refresh(self):
+        # Applies what other processes stored since the last call: reloads index.json if one
+        # of them replaced it, then reads only the new lines of index.log
+        try:
+            stat = os.stat(self.index_path)
+        except FileNotFoundError:
+            return
+        signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if signature != self.index_signature:
+            self._load(signature)
+        try:
+            log_size = os.path.getsize(self.log_path)
+        except FileNotFoundError:
+            log_size = 0
+        if log_size > self.log_offset:
+            with open(self.log_path, 'rb') as file:
+                file.seek(self.log_offset)
+                records = file.read(log_size - self.log_offset).decode('ascii').split()
+            self.log_offset = log_size
+            for key, slot in zip(records[::2], records[1::2]):
+                self._store(key, int(slot))
+        if self.dim and os.path.getsize(self.vectors_path) != self.capacity * self.dim * 4:
+            self._open()
+
+    def _load(self, signature):
+        with open(self.index_path, 'r', encoding='utf-8') as file:
+            index = json.load(file)
+        entries = index['entries']
+        if isinstance(entries, dict):
+            # index.json written before index.log existed: {key: [slot, last_used]}
+            entries = [(key, entry[0]) for key, entry in sorted(entries.items(), key=lambda item: item[1][1])]
+            index['slots'] = max((slot for _, slot in entries), default=-1) + 1 + len(index['free'])
+        self.dim = index['dim']
+        self.entries = OrderedDict(entries)
+        # recent uses of this process are not in the file yet
+        for key in self.used:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+        self.slot_keys = {slot: key for key, slot in self.entries.items()}
+        self.slots = index['slots']
+        self.free = set(index['free'])
+        self.index_signature = signature
+        self.log_offset = 0
+        self._open()
+
+    def _store(self, key, slot):
+        # key now has the vector in slot, the previous key of the slot was evicted
+        previous = self.slot_keys.get(slot)
+        if previous is not None and previous != key:
+            del self.entries[previous]
+        self.entries[key] = slot
+        self.entries.move_to_end(key)
+        self.slot_keys[slot] = key
+        self.slots = max(self.slots, slot + 1)
+        self.free.discard(slot)
+
+    def _write_index(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump({
+                'dim': self.dim,
+                'slots': self.slots,
+                'entries': list(self.entries.items()),
+                'free': sorted(self.free),
+            }, file)
+        os.replace(tmp_path, self.index_path)
+        stat = os.stat(self.index_path)
+        self.index_signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        # index.json now has everything of the log
+        with open(self.log_path, 'wb'):
+            pass
+        self.log_offset = 0
+        self.used.clear()
+
+    def _open(self):
+        # capacity is derived from the file size, the file only ever grows
+        size = os.path.getsize(self.vectors_path)
+        self.capacity = size // (self.dim * 4)
+        if self.capacity > 0:
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r+', shape=(self.capacity, self.dim))
+        else:
+            self.vectors = None
+
+    def _grow(self, needed):
+        if self.vectors is not None:
+            self.vectors.flush()
+            self.vectors = None
+        new_capacity = min(self.max_entries, max(needed, self.capacity * 2, 1024))
+        with open(self.vectors_path, 'ab') as file:
+            file.truncate(new_capacity * self.dim * 4)
+        self._open()
+
+    def _reset(self, dim):
+        # model dimension changed, old vectors are useless
+        self.dim = dim
+        self.entries = OrderedDict()
+        self.slot_keys = {}
+        self.slots = 0
+        self.free = set()
+        self.vectors = None
+        self.capacity = 0
+        with open(self.vectors_path, 'wb'):
+            pass
+        self._write_index()
+
+    def _allocate(self, count, protected):
+        # Returns up to `count` free slots. Grows the file first, then evicts least recently
+        # used entries. Entries in `protected` (used by the current call) are never evicted.
+        slots = []
+        while self.free and len(slots) < count:
+            slots.append(self.free.pop())
+
+        if len(slots) < count and self.slots < self.max_entries:
+            extra = min(count - len(slots), self.max_entries - self.slots)
+            if self.slots + extra > self.capacity:
+                self._grow(self.slots + extra)
+            slots.extend(range(self.slots, self.slots + extra))
+            self.slots += extra
+
+        if len(slots) < count:
+            # protected entries were just used, so they are at the end
+            victims = []
+            for key in self.entries:
+                if len(slots) + len(victims) == count:
+                    break
+                if key not in protected:
+                    victims.append(key)
+            for key in victims:
+                slot = self.entries.pop(key)
+                del self.slot_keys[slot]
+                slots.append(slot)
+                self.evictions += 1
+        return slots
+
+    def encode(self, model, lines, **encode_kwargs):
+        # Returns float32 matrix with one embedding per line, encoding only cache misses
+        keys = [cache_key(self.model_name, line) for line in lines]
+        result = None
+        missing = {}    # key -> indices of lines with this key
+
+        with self.lock, self._file_lock(shared=True):
+            self._refresh()
+            hit_rows = []
+            hit_slots = []
+            for i, key in enumerate(keys):
+                slot = self.entries.get(key)
+                if slot is None:
+                    missing.setdefault(key, []).append(i)
+                else:
+                    self.entries.move_to_end(key)
+                    self.used[key] = None
+                    hit_rows.append(i)
+                    hit_slots.append(slot)
+            self.hits += len(hit_rows)
+            self.misses += len(lines) - len(hit_rows)
+            if hit_rows:
+                result = np.empty((len(lines), self.dim), dtype=np.float32)
+                result[hit_rows] = self.vectors[hit_slots]
+
+        if not missing:
+            if result is None:
+                return np.empty((0, self.dim or 0), dtype=np.float32)
+            return result
+
+        missing_keys = list(missing.keys())
+        new_embeddings = model.encode([lines[missing[key][0]] for key in missing_keys], **encode_kwargs)
+        new_embeddings = np.asarray(new_embeddings, dtype=np.float32)
+
+        if result is None:
+            result = np.empty((len(lines), new_embeddings.shape[1]), dtype=np.float32)
+        for row, key in enumerate(missing_keys):
+            result[missing[key]] = new_embeddings[row]
+
+        with self.lock, self._file_lock():
+            # slots allocated by other processes since the last call are not handed out again
+            self._refresh()
+            if self.dim != new_embeddings.shape[1]:
+                self._reset(new_embeddings.shape[1])
+            # keys stored by a concurrent call in the meantime don't need a slot
+            missing_rows = [row for row, key in enumerate(missing_keys) if key not in self.entries]
+            slots = self._allocate(len(missing_rows), set(keys))
+            if slots:
+                # vectors first, a process that reads the log lines finds them in the shared mapping
+                self.vectors[slots] = new_embeddings[missing_rows[:len(slots)]]
+                records = ''.join(f'{missing_keys[row]} {slot}\n' for slot, row in zip(slots, missing_rows))
+                with open(self.log_path, 'a', encoding='ascii') as file:
+                    file.write(records)
+                self.log_offset += len(records)
+                for slot, row in zip(slots, missing_rows):
+                    self._store(missing_keys[row], slot)
+                    self.used[missing_keys[row]] = None
+
+        return result
+
+    def save(self):
+        # New vectors are already stored by encode(), this writes them to disk and folds
+        # index.log and the use order of this process into index.json
+        with self.lock, self._file_lock():
+            self._refresh()
+            if self.vectors is not None:
+                self.vectors.flush()
+            if self.dim is None:
+                return
+            self._write_index()
+
+    def summary(self):
+        total = self.hits + self.misses
+        hit_rate = (self.hits / total * 100) if total else 0.0
+        return (f'Embedding cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate), '
+                f'{self.evictions} evictions, {len(self.entries)}/{self.max_entries} entries in {self.cache_dir}')
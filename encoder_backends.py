@@ -0,0 +1,261 @@
+import argparse
+import csv
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from model_artifacts import resolve_model
+
+# Sentence encoder backends.
+#
+#   torch      the sentence transformer model as it is (default)
+#   onnx       the same transformer exported to ONNX, run by ONNX Runtime with all graph
+#              optimizations (operator fusion, constant folding)
+#   onnx_int8  the exported model with int8 weights (dynamic quantization of MatMul)
+#
+# The exported model only computes token embeddings. Tokenization, mean or CLS pooling and
+# normalization are done here the way the sentence transformer does them, so the onnx
+# backend gives the same embeddings up to rounding. The int8 model is faster but deviates,
+# `compare` reports by how much on real rows.
+#
+# Every backend has the encode() interface of SentenceTransformer. The torch model is
+# loaded from its local artifact (model_artifacts.py) when there is one.
+#
+# Example:
+#   python encoder_backends.py export --model all-mpnet-base-v2
+#   python encoder_backends.py compare -f data/input.csv --rows 512
+
+BACKENDS = ['torch', 'onnx', 'onnx_int8']
+MODEL_FILE = 'model.onnx'
+INT8_MODEL_FILE = 'model_int8.onnx'
+META_FILE = 'encoder.json'
+ONNX_OPSET = 17
+
+EXPORT_SENTENCES = [
+    'Orders table have broken sorting for column date;',
+    'Customer form validation for birth date;',
+]
+
+
+def default_onnx_dir(model_name):
+    return os.path.join('data', 'onnx', model_name.replace('/', '_'))
+
+
+def encoder_id(model_name, backend):
+    # Name of the embeddings of a backend, embedding caches do not mix backends
+    return model_name if backend == 'torch' else f'{model_name}:{backend}'
+
+
+def load_encoder(model_name, backend='torch', onnx_dir=None, threads=None):
+    if backend == 'torch':
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(resolve_model(model_name))
+    if backend in ['onnx', 'onnx_int8']:
+        return OnnxEncoder(onnx_dir or default_onnx_dir(model_name), int8=backend == 'onnx_int8', threads=threads)
+    raise ValueError(f"Encoder backend must be one of {', '.join(BACKENDS)}")
+
+
+class LazyEncoder:
+    # Calls load() on the first encode(), a run whose lines are all cached never loads the model
+    def __init__(self, load):
+        self.load = load
+        self.encoder = None
+        self.lock = threading.Lock()
+
+    def encode(self, sentences, **kwargs):
+        if self.encoder is None:
+            with self.lock:
+                if self.encoder is None:
+                    self.encoder = self.load()
+        return self.encoder.encode(sentences, **kwargs)
+
+
+def pooling_mode(model):
+    # 'mean' or 'cls', from the pooling module of a sentence transformer
+    for module in model:
+        if type(module).__name__ == 'Pooling':
+            config = module.get_config_dict()
+            mode = config.get('pooling_mode')
+            if mode is None:
+                mode = 'cls' if config.get('pooling_mode_cls_token') else \
+                    'mean' if config.get('pooling_mode_mean_tokens') else None
+            if mode not in ['mean', 'cls']:
+                raise ValueError(f'Pooling {mode} is not supported by the onnx backend')
+            return mode
+    raise ValueError('Model has no pooling module')
+
+
+def export(model_name, output_dir, quantize=True):
+    # Writes the transformer as model.onnx (and model_int8.onnx), its tokenizer and encoder.json
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(resolve_model(model_name), device='cpu')
+    transformer = model[0].auto_model.eval()
+    features = model.tokenizer(EXPORT_SENTENCES, padding=True, return_tensors='pt')
+    input_names = [name for name in ['input_ids', 'attention_mask', 'token_type_ids'] if name in features]
+
+    class TokenEmbeddings(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.transformer = transformer
+
+        def forward(self, *inputs):
+            return self.transformer(**dict(zip(input_names, inputs)), return_dict=True).last_hidden_state
+
+    os.makedirs(output_dir, exist_ok=True)
+    model_path = os.path.join(output_dir, MODEL_FILE)
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names + ['token_embeddings']}
+    with torch.no_grad():
+        torch.onnx.export(TokenEmbeddings(), tuple(features[name] for name in input_names), model_path,
+                          input_names=input_names, output_names=['token_embeddings'], dynamic_axes=dynamic_axes,
+                          opset_version=ONNX_OPSET, dynamo=False)
+    model.tokenizer.save_pretrained(output_dir)
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(model_path, os.path.join(output_dir, INT8_MODEL_FILE), weight_type=QuantType.QInt8)
+
+    normalize = any(type(module).__name__ == 'Normalize' for module in model)
+    with open(os.path.join(output_dir, META_FILE), 'w', encoding='utf-8') as file:
+        json.dump({
+            'model_name': model_name,
+            'max_seq_length': model.max_seq_length,
+            'pooling': pooling_mode(model),
+            'normalize': normalize,
+            'dimension': model.get_sentence_embedding_dimension(),
+        }, file, indent=2)
+    return model
+
+
+class OnnxEncoder:
+    def __init__(self, model_dir, int8=False, threads=None):
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        meta_path = os.path.join(model_dir, META_FILE)
+        if not os.path.exists(meta_path):
+            raise FileNotFoundError(f'No exported model in {model_dir}, run: python encoder_backends.py export -o {model_dir}')
+        with open(meta_path, 'r', encoding='utf-8') as file:
+            self.meta = json.load(file)
+        self.model_path = os.path.join(model_dir, INT8_MODEL_FILE if int8 else MODEL_FILE)
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(self.model_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+
+    def encode(self, sentences, batch_size=32, normalize_embeddings=False, **kwargs):
+        if isinstance(sentences, str):
+            return self.encode([sentences], batch_size, normalize_embeddings)[0]
+        n = len(sentences)
+        embeddings = np.empty((n, self.meta['dimension']), dtype=np.float32)
+        # batches of similar length, like SentenceTransformer.encode
+        order = np.argsort([-len(sentence) for sentence in sentences], kind='stable')
+        for start in range(0, n, batch_size):
+            batch = order[start:start + batch_size]
+            features = self.tokenizer([str(sentences[i]).strip() for i in batch], padding=True, truncation=True,
+                                      max_length=self.meta['max_seq_length'], return_tensors='np')
+            token_embeddings = self.session.run(None, {name: features[name].astype(np.int64) for name in self.input_names})[0]
+            if self.meta['pooling'] == 'cls':
+                pooled = token_embeddings[:, 0]
+            else:
+                mask = features['attention_mask'][..., None].astype(np.float32)
+                pooled = (token_embeddings * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+            if self.meta['normalize'] or normalize_embeddings:
+                pooled /= np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+            embeddings[batch] = pooled
+        return embeddings
+
+
+def parity(reference, candidate):
+    # (max, mean) cosine distance between embeddings of the same sentences by two backends
+    reference = reference / np.maximum(np.linalg.norm(reference, axis=1, keepdims=True), 1e-12)
+    candidate = candidate / np.maximum(np.linalg.norm(candidate, axis=1, keepdims=True), 1e-12)
+    deviations = np.maximum(1.0 - np.einsum('ij,ij->i', reference, candidate), 0.0)
+    return float(deviations.max()), float(deviations.mean())
+
+
+def read_lines(input_file, columns, rows):
+    # First rows of a semicolon separated export as clustering.py lines
+    from streaming import line_column_indices
+    with open(input_file, 'r', encoding='utf-8') as file:
+        reader = csv.reader(file, delimiter=';')
+        header = next(reader)
+        col_nums = line_column_indices(header, columns)
+        lines = []
+        for row in reader:
+            lines.append(''.join(row[col_num] + ';' for col_num in col_nums if col_num < len(row)))
+            if len(lines) == rows:
+                break
+    return lines
+
+
+def compare(model_name, onnx_dir, lines, backends, threads=None, batch_size=32):
+    # Load time, throughput and deviation from the torch backend of every backend
+    if threads:
+        import torch
+        torch.set_num_threads(threads)
+    results = []
+    reference = None
+    for backend in backends:
+        start = time.perf_counter()
+        encoder = load_encoder(model_name, backend, onnx_dir, threads=threads)
+        load_seconds = time.perf_counter() - start
+        encoder.encode(EXPORT_SENTENCES)     # warm-up
+        start = time.perf_counter()
+        embeddings = np.asarray(encoder.encode(lines, batch_size=batch_size), dtype=np.float32)
+        seconds = time.perf_counter() - start
+        if backend == 'torch':
+            reference = embeddings
+        results.append({
+            'backend': backend,
+            'load_seconds': load_seconds,
+            'lines_per_second': len(lines) / seconds if seconds > 0 else 0.0,
+            'deviation': parity(reference, embeddings) if reference is not None else None,
+        })
+    return results
+
+
+def compare_table(results):
+    base = results[0]['lines_per_second']
+    lines = [f"{'backend':<10} {'load (s)':>9} {'lines/s':>9} {'speedup':>8} {'max cos dev':>12} {'mean cos dev':>13}"]
+    for result in results:
+        max_dev, mean_dev = result['deviation'] or (float('nan'), float('nan'))
+        speedup = result['lines_per_second'] / base if base else 0.0
+        lines.append(f"{result['backend']:<10} {result['load_seconds']:>9.2f} {result['lines_per_second']:>9.1f} "
+                     f"{speedup:>7.2f}x {max_dev:>12.6f} {mean_dev:>13.6f}")
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the sentence encoder to ONNX and compare encoder backends.')
+    parser.add_argument('command', choices=['export', 'compare'])
+    parser.add_argument('--model', type=str, default='all-mpnet-base-v2', help='Sentence transformer model name or directory.')
+    parser.add_argument('-o', '--onnx_dir', type=str, default='', help='Directory of the exported model. Default is data/onnx/<model>.')
+    parser.add_argument('--no_int8', action='store_true', help='Export only the float32 model.')
+    parser.add_argument('-f', '--input_file', type=str, default='data/example.csv', help='Export whose rows are encoded by compare.')
+    parser.add_argument('-c', '--columns', type=str, default='Summary', help='Columns of the encoded lines, separated by semicolon.')
+    parser.add_argument('--rows', type=int, default=512, help='Number of rows encoded by compare.')
+    parser.add_argument('--backends', type=str, default=','.join(BACKENDS), help='Backends compared, the first one is the baseline.')
+    parser.add_argument('--threads', type=int, default=0, help='Threads per backend, 0 uses all cores.')
+    args = parser.parse_args()
+    onnx_dir = args.onnx_dir or default_onnx_dir(args.model)
+
+    if args.command == 'export':
+        start = time.perf_counter()
+        model = export(args.model, onnx_dir, quantize=not args.no_int8)
+        print(f'Exported {args.model} to {onnx_dir} in {time.perf_counter() - start:.1f}s')
+        reference = model.encode(EXPORT_SENTENCES)
+        for backend in ['onnx'] + ([] if args.no_int8 else ['onnx_int8']):
+            max_dev, _ = parity(reference, load_encoder(args.model, backend, onnx_dir).encode(EXPORT_SENTENCES))
+            print(f'{backend}: max cosine deviation from torch {max_dev:.6f}')
+    else:
+        lines = read_lines(args.input_file, args.columns.split(';'), args.rows)
+        print(f'Encoding {len(lines)} lines of {args.input_file}')
+        print(compare_table(compare(args.model, onnx_dir, lines, args.backends.split(','), threads=args.threads or None)))
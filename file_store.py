@@ -0,0 +1,226 @@
+import hashlib
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# Columnar in-memory store of csv files uploaded to app.py.
+#
+# Every column is dictionary encoded: a pool of its distinct values and an int32 code
+# per row, so repeated values (Issue Type, Priority, Status, ...) are stored once and
+# column names are not repeated per row. Column names are interned.
+#
+# When the files in memory exceed max_bytes, least recently used files are spilled to
+# a temporary directory and loaded again on their next read.
+#
+# Sorting and filtering work on the pools: distinct values are sorted or matched once
+# and the result is spread to the rows through their codes.
+
+# number of (sort, filter) results kept per file, so paging through them is cheap
+QUERY_CACHE_SIZE = 8
+
+
+def natural_key(value):
+    # AAP-9 sorts before AAP-10
+    return [int(part) if part.isdigit() else part.casefold() for part in re.split(r'(\d+)', value)]
+
+
+def _column_codes(values):
+    pool = {}
+    codes = np.fromiter((pool.setdefault(value, len(pool)) for value in values), dtype=np.int32, count=len(values))
+    return list(pool), codes
+
+
+class ColumnarFile:
+    def __init__(self, name, column_names, pools, codes, uploaded_at=None):
+        self.name = name
+        self.column_names = [sys.intern(col_name) for col_name in column_names]
+        self.pools = pools          # distinct values per column
+        self.codes = codes          # int32 array per column, index into its pool
+        self.uploaded_at = uploaded_at or time.time()
+        self.n_rows = len(codes[0]) if codes else 0
+        self.size_bytes = sum(code.nbytes for code in codes) + \
+            sum(sys.getsizeof(value) for pool in pools for value in pool)
+        self.sort_orders = {}
+        self.queries = OrderedDict()
+        # requests of several threads share the query cache
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_rows(cls, name, column_names, rows):
+        # Missing cells are empty strings, cells beyond the header are dropped
+        n_columns = len(column_names)
+        rows = [row if len(row) == n_columns else (row + [''] * n_columns)[:n_columns] for row in rows]
+        pools = []
+        codes = []
+        for col in range(n_columns):
+            pool, code = _column_codes([row[col] for row in rows])
+            pools.append(pool)
+            codes.append(code)
+        return cls(name, column_names, pools, codes)
+
+    def column_indices(self, columns=None):
+        # Indices of the projected columns, all columns if columns is None
+        if columns is None:
+            return list(range(len(self.column_names)))
+        missing = [col for col in columns if col not in self.column_names]
+        if missing:
+            raise KeyError(f"Columns not in file: {', '.join(missing)}")
+        return [self.column_names.index(col) for col in columns]
+
+    def rows_at(self, indices, columns=None):
+        # Rows with the given row numbers as lists, only with the given columns
+        cols = self.column_indices(columns)
+        indices = np.asarray(indices, dtype=np.int64)
+        return [list(row) for row in zip(*(
+            [self.pools[col][code] for code in self.codes[col][indices].tolist()] for col in cols
+        ))]
+
+    def sort_order(self, col):
+        # Row numbers ordered by the values of column col, computed once per column
+        order = self.sort_orders.get(col)
+        if order is None:
+            pool = self.pools[col]
+            ranks = np.empty(len(pool), dtype=np.int64)
+            ranks[sorted(range(len(pool)), key=lambda code: natural_key(pool[code]))] = np.arange(len(pool))
+            order = np.argsort(ranks[self.codes[col]], kind='stable')
+            self.sort_orders[col] = order
+        return order
+
+    def matching_rows(self, text, columns=None):
+        # Mask of rows containing text (case insensitive) in any of the columns
+        text = text.casefold()
+        mask = np.zeros(self.n_rows, dtype=bool)
+        for col in self.column_indices(columns):
+            pool = self.pools[col]
+            pool_mask = np.fromiter((text in value.casefold() for value in pool), dtype=bool, count=len(pool))
+            mask |= pool_mask[self.codes[col]]
+        return mask
+
+    def query(self, sort=None, descending=False, text=None, filter_columns=None):
+        # Row numbers of rows matching text, in the order of the sort column
+        key = (sort, descending, text, tuple(filter_columns) if filter_columns else None)
+        with self.lock:
+            order = self.queries.get(key)
+            if order is not None:
+                self.queries.move_to_end(key)
+                return order
+        if sort is not None:
+            order = self.sort_order(self.column_indices([sort])[0])
+            if descending:
+                order = order[::-1]
+        else:
+            order = np.arange(self.n_rows)
+        if text:
+            order = order[self.matching_rows(text, filter_columns)[order]]
+        with self.lock:
+            self.queries[key] = order
+            if len(self.queries) > QUERY_CACHE_SIZE:
+                self.queries.popitem(last=False)
+        return order
+
+    def metadata(self):
+        return {
+            'column_names': self.column_names,
+            'rows': self.n_rows,
+            'size_bytes': self.size_bytes,
+            'uploaded_at': self.uploaded_at,
+        }
+
+    def save(self, path):
+        np.savez(path + '.npz', *self.codes)
+        with open(path + '.json', 'w', encoding='utf-8') as file:
+            json.dump({
+                'name': self.name,
+                'column_names': self.column_names,
+                'pools': self.pools,
+                'uploaded_at': self.uploaded_at,
+            }, file, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path):
+        with open(path + '.json', 'r', encoding='utf-8') as file:
+            meta = json.load(file)
+        with np.load(path + '.npz') as arrays:
+            codes = [arrays[f'arr_{i}'] for i in range(len(arrays.files))]
+        return cls(meta['name'], meta['column_names'], meta['pools'], codes, meta['uploaded_at'])
+
+
+class FileStore:
+    def __init__(self, max_bytes=None, spill_dir=None):
+        self.max_bytes = max_bytes
+        if spill_dir is None:
+            self.spill_tmp = tempfile.TemporaryDirectory(prefix='uploads_')
+            spill_dir = self.spill_tmp.name
+        self.spill_dir = spill_dir
+        self.loaded = OrderedDict()     # name -> ColumnarFile, least recently used first
+        self.spilled = {}               # name -> metadata of files on disk
+        self.memory_bytes = 0
+        self.lock = threading.Lock()
+
+    def _path(self, name):
+        return os.path.join(self.spill_dir, hashlib.blake2b(name.encode('utf-8'), digest_size=16).hexdigest())
+
+    def _evict(self):
+        # the most recently used file always stays in memory
+        while self.max_bytes is not None and self.memory_bytes > self.max_bytes and len(self.loaded) > 1:
+            name, file = self.loaded.popitem(last=False)
+            file.save(self._path(name))
+            self.spilled[name] = file.metadata()
+            self.memory_bytes -= file.size_bytes
+
+    def put(self, name, column_names, rows):
+        file = ColumnarFile.from_rows(name, column_names, rows)
+        with self.lock:
+            self._remove(name)
+            self.loaded[name] = file
+            self.memory_bytes += file.size_bytes
+            self._evict()
+        return file
+
+    def _remove(self, name):
+        old = self.loaded.pop(name, None)
+        if old is not None:
+            self.memory_bytes -= old.size_bytes
+        if self.spilled.pop(name, None) is not None:
+            for ext in ['.npz', '.json']:
+                os.remove(self._path(name) + ext)
+
+    def get(self, name):
+        # Returns ColumnarFile or None, spilled files are loaded back into memory
+        with self.lock:
+            file = self.loaded.get(name)
+            if file is not None:
+                self.loaded.move_to_end(name)
+                return file
+            if name not in self.spilled:
+                return None
+            path = self._path(name)
+            file = ColumnarFile.load(path)
+            del self.spilled[name]
+            for ext in ['.npz', '.json']:
+                os.remove(path + ext)
+            self.loaded[name] = file
+            self.memory_bytes += file.size_bytes
+            self._evict()
+            return file
+
+    def __contains__(self, name):
+        return name in self.loaded or name in self.spilled
+
+    def names(self):
+        # in upload order
+        files = self.metadata()
+        return sorted(files, key=lambda name: files[name]['uploaded_at'])
+
+    def metadata(self):
+        with self.lock:
+            files = {name: dict(file.metadata(), in_memory=True) for name, file in self.loaded.items()}
+            files.update({name: dict(meta, in_memory=False) for name, meta in self.spilled.items()})
+        return files
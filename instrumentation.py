@@ -0,0 +1,206 @@
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Stage level timing and memory instrumentation shared by clustering.py and app.py.
+#
+# Code wraps every pipeline stage (model loading, parsing, encoding, clustering,
+# coherence, report writing) in `with metrics.stage('name', rows=n):`. Per stage the
+# number of runs, total and last duration, rows per second and peak RSS are kept, and
+# sizes of embedding batches are counted in a histogram. clustering.py prints them as
+# a table, app.py exposes them in Prometheus text format on /metrics.
+#
+# Peak RSS per stage uses /proc/self/clear_refs to reset the high-water mark of the
+# process (Linux) when a stage starts while no other stage runs. Stages nested in it or
+# running concurrently report the peak since that outermost stage started, resetting
+# for them would lose the peak of the stages already running. Without /proc it is the
+# process peak.
+#
+# Startup milestones (imports done, model loaded, first row encoded, ...) are measured
+# from the start of the process, so interpreter startup and imports are included.
+
+BATCH_SIZE_BUCKETS = [1, 8, 32, 128, 512, 1024, 4096, 16384]
+
+verbosity = 0
+# fallback start of the process where /proc is not available
+import_time = time.time()
+
+
+def set_verbosity(level):
+    global verbosity
+    verbosity = level
+
+
+def vprint(level, *args, **kwargs):
+    # print only at the given verbosity level or above (1 = details, 2 = per row debugging)
+    if verbosity >= level:
+        print(*args, **kwargs)
+
+
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_bytes():
+    try:
+        with open('/proc/self/status', 'r') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        # not available on Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def process_seconds():
+    # Seconds since the process started
+    try:
+        with open('/proc/self/stat', 'r') as file:
+            # the command name in parentheses can contain spaces, fields are counted after it
+            start_ticks = int(file.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime', 'r') as file:
+            uptime = float(file.read().split()[0])
+        return max(uptime - start_ticks / os.sysconf('SC_CLK_TCK'), 0.0)
+    except (OSError, ValueError, IndexError, AttributeError):
+        return time.time() - import_time
+
+
+class StageMetrics:
+    def __init__(self):
+        self.runs = 0
+        self.seconds_total = 0.0
+        self.rows_total = 0
+        self.last_seconds = 0.0
+        self.last_rows = None
+        self.last_peak_rss = None
+
+
+class Instrumentation:
+    def __init__(self):
+        self.stages = {}
+        self.batch_counts = [0] * (len(BATCH_SIZE_BUCKETS) + 1)
+        self.batch_rows_total = 0
+        self.milestones = {}    # name -> seconds since process start, first occurrence only
+        self.running = 0        # stages running in any thread
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        # rows can also be set later through the yielded dict: `info['rows'] = n`
+        info = {'rows': rows}
+        with self.lock:
+            if self.running == 0:
+                reset_peak_rss()
+            self.running += 1
+        start = time.perf_counter()
+        try:
+            yield info
+        finally:
+            elapsed = time.perf_counter() - start
+            peak = peak_rss_bytes()
+            with self.lock:
+                self.running -= 1
+                metrics = self.stages.setdefault(name, StageMetrics())
+                metrics.runs += 1
+                metrics.seconds_total += elapsed
+                metrics.last_seconds = elapsed
+                metrics.last_rows = info['rows']
+                metrics.rows_total += info['rows'] or 0
+                metrics.last_peak_rss = peak
+            vprint(1, f'{name}: {elapsed:.3f}s')
+
+    def milestone(self, name):
+        with self.lock:
+            if name in self.milestones:
+                return
+            self.milestones[name] = process_seconds()
+        vprint(1, f'{name}: {self.milestones[name]:.3f}s after process start')
+
+    def observe_batch(self, size):
+        with self.lock:
+            self.batch_rows_total += size
+            for i, bound in enumerate(BATCH_SIZE_BUCKETS):
+                if size <= bound:
+                    self.batch_counts[i] += 1
+                    break
+            else:
+                self.batch_counts[-1] += 1
+
+    def summary_table(self):
+        lines = [
+            f'{"stage":<14} {"runs":>5} {"last (s)":>10} {"total (s)":>10} {"rows/s":>12} {"peak RSS (MB)":>14}',
+        ]
+        with self.lock:
+            for name, metrics in self.stages.items():
+                rows_per_second = f'{metrics.last_rows / metrics.last_seconds:.1f}' \
+                    if metrics.last_rows and metrics.last_seconds > 0 else '-'
+                peak = f'{metrics.last_peak_rss / 2 ** 20:.1f}' if metrics.last_peak_rss else '-'
+                lines.append(f'{name:<14} {metrics.runs:>5} {metrics.last_seconds:>10.3f} '
+                             f'{metrics.seconds_total:>10.3f} {rows_per_second:>12} {peak:>14}')
+            batches = sum(self.batch_counts)
+            if batches:
+                lines.append(f'embedding batches: {batches}, mean size {self.batch_rows_total / batches:.1f} rows')
+            if self.milestones:
+                lines.append('startup: ' + ', '.join(f'{name} {seconds:.2f}s' for name, seconds in self.milestones.items()) +
+                             ' after process start')
+        return '\n'.join(lines)
+
+    def prometheus(self, prefix='jira_clustering'):
+        # Prometheus text exposition format
+        out = []
+
+        def metric(name, kind, help_text, samples):
+            out.append(f'# HELP {prefix}_{name} {help_text}')
+            out.append(f'# TYPE {prefix}_{name} {kind}')
+            for labels, value in samples:
+                out.append(f'{prefix}_{name}{labels} {value}')
+
+        with self.lock:
+            stages = list(self.stages.items())
+            label = lambda name: f'{{stage="{name}"}}'
+            metric('stage_runs_total', 'counter', 'Number of runs of a pipeline stage.',
+                   [(label(name), m.runs) for name, m in stages])
+            metric('stage_duration_seconds_total', 'counter', 'Total time spent in a pipeline stage.',
+                   [(label(name), f'{m.seconds_total:.6f}') for name, m in stages])
+            metric('stage_rows_total', 'counter', 'Rows processed by a pipeline stage.',
+                   [(label(name), m.rows_total) for name, m in stages])
+            metric('stage_last_duration_seconds', 'gauge', 'Duration of the last run of a pipeline stage.',
+                   [(label(name), f'{m.last_seconds:.6f}') for name, m in stages])
+            metric('stage_last_rows_per_second', 'gauge', 'Throughput of the last run of a pipeline stage.',
+                   [(label(name), f'{m.last_rows / m.last_seconds:.3f}')
+                    for name, m in stages if m.last_rows and m.last_seconds > 0])
+            metric('stage_last_peak_rss_bytes', 'gauge', 'Peak resident memory during the last run of a pipeline stage.',
+                   [(label(name), m.last_peak_rss) for name, m in stages if m.last_peak_rss])
+            metric('startup_milestone_seconds', 'gauge', 'Seconds from process start to a startup milestone.',
+                   [(f'{{milestone="{name}"}}', f'{seconds:.3f}') for name, seconds in self.milestones.items()])
+
+            cumulative = 0
+            buckets = []
+            for bound, count in zip(BATCH_SIZE_BUCKETS + ['+Inf'], self.batch_counts):
+                cumulative += count
+                buckets.append((f'{{le="{bound}"}}', cumulative))
+            out.append(f'# HELP {prefix}_embedding_batch_size Number of rows per encode call.')
+            out.append(f'# TYPE {prefix}_embedding_batch_size histogram')
+            for labels, value in buckets:
+                out.append(f'{prefix}_embedding_batch_size_bucket{labels} {value}')
+            out.append(f'{prefix}_embedding_batch_size_sum {self.batch_rows_total}')
+            out.append(f'{prefix}_embedding_batch_size_count {cumulative}')
+        return '\n'.join(out) + '\n'
+
+
+# process-wide instance
+metrics = Instrumentation()
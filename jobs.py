@@ -0,0 +1,206 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# Background jobs for the Flask app.
+#
+# Long running work (clustering of a large export) is submitted as a job and runs on a
+# local worker pool, the HTTP request only stores the upload and returns the job id.
+# Job state lives in a sqlite database under the jobs directory, so status and results
+# survive a restart of the app. Every job gets its own directory for input and output files.
+#
+# Job status: queued -> running -> done | failed | cancelled
+# While running, the job reports its phase (e.g. encoding, clustering, writing) and
+# the number of rows encoded so far.
+#
+# Several app processes (gunicorn workers) may share the jobs directory. Every process
+# writes a heartbeat for its queued and running jobs, jobs without a heartbeat for
+# STALE_SECONDS belong to a process that stopped and are failed. Cancellation is stored
+# in the database, so it reaches the job in whichever process runs it.
+
+FINISHED = ('done', 'failed', 'cancelled')
+HEARTBEAT_SECONDS = 10
+STALE_SECONDS = 60
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobStore:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        with self._connect() as db:
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    phase TEXT,
+                    rows_encoded INTEGER NOT NULL DEFAULT 0,
+                    params TEXT,
+                    result TEXT,
+                    error TEXT,
+                    cancel_requested INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    heartbeat REAL
+                )
+            ''')
+            if 'heartbeat' not in [row['name'] for row in db.execute('PRAGMA table_info(jobs)')]:
+                db.execute('ALTER TABLE jobs ADD COLUMN heartbeat REAL')
+
+    def _connect(self):
+        # one connection per call, so the store can be used from any worker thread
+        db = sqlite3.connect(self.db_path, timeout=30)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def create(self, job_id, params):
+        now = time.time()
+        with self._connect() as db:
+            db.execute(
+                'INSERT INTO jobs (id, status, params, created_at, updated_at, heartbeat) VALUES (?, ?, ?, ?, ?, ?)',
+                (job_id, 'queued', json.dumps(params), now, now, now),
+            )
+
+    def update(self, job_id, **fields):
+        if 'result' in fields:
+            fields['result'] = json.dumps(fields['result'])
+        fields['updated_at'] = time.time()
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        with self._connect() as db:
+            db.execute(f'UPDATE jobs SET {assignments} WHERE id = ?', (*fields.values(), job_id))
+
+    def get(self, job_id):
+        with self._connect() as db:
+            row = db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['params'] = json.loads(job['params']) if job['params'] else {}
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        job['cancel_requested'] = bool(job['cancel_requested'])
+        return job
+
+    def list(self, limit=100):
+        with self._connect() as db:
+            rows = db.execute('SELECT id FROM jobs ORDER BY created_at DESC LIMIT ?', (limit,)).fetchall()
+        return [self.get(row['id']) for row in rows]
+
+    def cancel_requested(self, job_id):
+        with self._connect() as db:
+            row = db.execute('SELECT cancel_requested FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return row is not None and bool(row['cancel_requested'])
+
+    def heartbeat(self, job_ids):
+        if not job_ids:
+            return
+        with self._connect() as db:
+            db.execute(
+                f"UPDATE jobs SET heartbeat = ? WHERE id IN ({', '.join('?' * len(job_ids))})",
+                (time.time(), *job_ids),
+            )
+
+    def fail_stale(self):
+        # queued or running jobs of a process that stopped will never finish
+        with self._connect() as db:
+            db.execute(
+                "UPDATE jobs SET status = 'failed', error = 'Interrupted, the app process running it stopped', "
+                "updated_at = ? WHERE status IN ('queued', 'running') AND (heartbeat IS NULL OR heartbeat < ?)",
+                (time.time(), time.time() - STALE_SECONDS),
+            )
+
+
+class Job:
+    # Handle passed to the job function
+    def __init__(self, manager, job_id, directory, params):
+        self.manager = manager
+        self.id = job_id
+        self.directory = directory
+        self.params = params
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def progress(self, phase, rows_encoded=None):
+        # Records progress, raises JobCancelled when cancellation was requested
+        fields = {'phase': phase}
+        if rows_encoded is not None:
+            fields['rows_encoded'] = rows_encoded
+        self.manager.store.update(self.id, **fields)
+        if self.id in self.manager.cancelled or self.manager.store.cancel_requested(self.id):
+            raise JobCancelled()
+
+
+class JobManager:
+    def __init__(self, jobs_dir, max_workers=None):
+        if max_workers is None:
+            max_workers = int(os.environ.get('JOB_WORKERS', '2'))
+        self.jobs_dir = os.path.abspath(jobs_dir)
+        os.makedirs(jobs_dir, exist_ok=True)
+        self.store = JobStore(os.path.join(jobs_dir, 'jobs.db'))
+        self.store.fail_stale()
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self.cancelled = set()
+        self.active = set()     # ids of queued and running jobs of this process
+        self.lock = threading.Lock()
+        threading.Thread(target=self._heartbeat, name='job-heartbeat', daemon=True).start()
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(HEARTBEAT_SECONDS)
+            with self.lock:
+                job_ids = list(self.active)
+            try:
+                self.store.heartbeat(job_ids)
+                self.store.fail_stale()
+            except sqlite3.Error as e:
+                print(f'Job heartbeat failed: {e}')
+
+    def create(self, params):
+        job_id = uuid.uuid4().hex
+        directory = os.path.join(self.jobs_dir, job_id)
+        os.makedirs(directory)
+        self.store.create(job_id, params)
+        return Job(self, job_id, directory, params)
+
+    def submit(self, job, func):
+        # func(job) runs on the worker pool, its return value is stored as the job result
+        with self.lock:
+            self.active.add(job.id)
+        self.pool.submit(self._run, job, func)
+
+    def _run(self, job, func):
+        if job.id in self.cancelled or self.store.cancel_requested(job.id):
+            self.store.update(job.id, status='cancelled')
+            return
+        self.store.update(job.id, status='running')
+        try:
+            result = func(job)
+        except JobCancelled:
+            self.store.update(job.id, status='cancelled')
+        except Exception as e:
+            self.store.update(job.id, status='failed', error=str(e))
+        else:
+            self.store.update(job.id, status='done', phase='done', result=result)
+        finally:
+            with self.lock:
+                self.cancelled.discard(job.id)
+                self.active.discard(job.id)
+
+    def cancel(self, job_id):
+        # Returns job state after the request, None for unknown job
+        job = self.store.get(job_id)
+        if job is None or job['status'] in FINISHED:
+            return job
+        with self.lock:
+            self.cancelled.add(job_id)
+        self.store.update(job_id, cancel_requested=1)
+        return self.store.get(job_id)
+
+    def get(self, job_id):
+        return self.store.get(job_id)
@@ -0,0 +1,148 @@
+import numpy as np
+
+from cluster_tree import ClusterTree
+from coherence import cluster_coherences
+
+# Clustering engine for 100k+ issues.
+#
+# Instead of the dense n x n distance matrix used by AgglomerativeClustering, a sparse
+# k-nearest-neighbour graph is built over the normalized embeddings (O(n*k) memory).
+# Clusters are then merged along graph edges in order of distance, and a merge is
+# accepted only if every pair of issues in the two clusters is closer than the
+# threshold. So the threshold means the same as --distance_threshold with complete
+# linkage, the difference to the exact method is that only clusters connected by a
+# kNN edge are ever compared.
+
+# upper bound of similarity block entries (batch x n) computed at once
+BLOCK_ENTRIES = 2 ** 25
+
+
+def normalize(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+def similarities(vectors, rows, columns=slice(None)):
+    # vectors is a normalized float32 matrix or compact_embeddings.CompactEmbeddings
+    if hasattr(vectors, 'similarities'):
+        return vectors.similarities(rows, columns)
+    return vectors[rows] @ vectors[columns].T
+
+
+def knn_graph(normalized, k):
+    # Returns (neighbors, distances), both n x k, cosine distance to the k nearest other rows
+    n = len(normalized)
+    k = min(k, n - 1)
+    neighbors = np.empty((n, k), dtype=np.int32)
+    distances = np.empty((n, k), dtype=np.float32)
+    if k <= 0:
+        return neighbors, distances
+
+    batch_size = max(1, BLOCK_ENTRIES // n)
+    for start in range(0, n, batch_size):
+        end = min(start + batch_size, n)
+        sims = similarities(normalized, slice(start, end))
+        sims[np.arange(end - start), np.arange(start, end)] = -np.inf
+        idx = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        neighbors[start:end] = idx
+        distances[start:end] = 1.0 - np.take_along_axis(sims, idx, axis=1)
+    return neighbors, distances
+
+
+class KnnClusterGraph:
+    # Same interface as ClusterTree: built once, cut at any threshold
+    def __init__(self, embeddings, k=30):
+        # reduced precision embeddings are used as they are, without expanding them
+        self.normalized = embeddings if hasattr(embeddings, 'similarities') else normalize(embeddings)
+        self.k = k
+        neighbors, distances = knn_graph(self.normalized, k)
+
+        # undirected edge list sorted by distance, each pair once
+        n = len(neighbors)
+        sources = np.repeat(np.arange(n, dtype=np.int64), neighbors.shape[1])
+        targets = neighbors.ravel().astype(np.int64)
+        low = np.minimum(sources, targets)
+        high = np.maximum(sources, targets)
+        _, first = np.unique(low * n + high, return_index=True)
+        order = first[np.argsort(distances.ravel()[first], kind='stable')]
+        self.edge_sources = low[order]
+        self.edge_targets = high[order]
+        self.edge_distances = distances.ravel()[order]
+
+    def cut(self, distance_threshold):
+        # Returns labels per row and coherence per label
+        n = len(self.normalized)
+        parent = list(range(n))
+        members = {}
+        # root -> roots of clusters a merge with was rejected. Complete linkage distance only
+        # grows with merges, so a rejected pair stays rejected and is not compared again.
+        rejected = {}
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        edges = int(np.searchsorted(self.edge_distances, distance_threshold, side='left'))
+        for i, j in zip(self.edge_sources[:edges].tolist(), self.edge_targets[:edges].tolist()):
+            a, b = find(i), find(j)
+            if a == b:
+                continue
+            if b in rejected.get(a, ()):
+                continue
+            members_a = members.get(a, [a])
+            members_b = members.get(b, [b])
+            if (len(members_a) > 1 or len(members_b) > 1) and \
+                    not self._within(members_a, members_b, distance_threshold):
+                rejected.setdefault(a, set()).add(b)
+                rejected.setdefault(b, set()).add(a)
+                continue
+            if len(members_a) < len(members_b):
+                a, b, members_a, members_b = b, a, members_b, members_a
+            parent[b] = a
+            members_a.extend(members_b)
+            members[a] = members_a
+            members.pop(b, None)
+            # clusters that rejected b reject the merged cluster too
+            for other in rejected.pop(b, ()):
+                rejected[other].discard(b)
+                rejected[other].add(a)
+                rejected.setdefault(a, set()).add(other)
+
+        roots = np.array([find(i) for i in range(n)], dtype=np.int64)
+        _, labels = np.unique(roots, return_inverse=True)
+
+        return labels, cluster_coherences(self.normalized, labels)
+
+    def _within(self, members_a, members_b, distance_threshold):
+        # complete linkage: the farthest pair across both clusters must be under threshold.
+        # Compared in blocks of at most BLOCK_ENTRIES, stops at the first block with a pair too far apart.
+        if len(members_a) > len(members_b):
+            members_a, members_b = members_b, members_a
+        batch_size = max(1, BLOCK_ENTRIES // len(members_a))
+        for start in range(0, len(members_b), batch_size):
+            sims = similarities(self.normalized, members_a, members_b[start:start + batch_size])
+            if 1.0 - sims.min() >= distance_threshold:
+                return False
+        return True
+
+class SampleComparison:
+    # Clusters a random sample with both the exact tree and the kNN engine and reports agreement
+    def __init__(self, embeddings, k, sample_size=2000, seed=0):
+        n = len(embeddings)
+        rng = np.random.default_rng(seed)
+        self.sample = np.sort(rng.choice(n, size=min(n, sample_size), replace=False))
+        sample_embeddings = np.asarray(embeddings[self.sample], dtype=np.float32)
+        self.exact = ClusterTree(sample_embeddings)
+        self.approx = KnnClusterGraph(sample_embeddings, k=k)
+
+    def report(self, distance_threshold):
+        from sklearn.metrics import adjusted_rand_score
+
+        exact_labels, _ = self.exact.cut(distance_threshold)
+        approx_labels, _ = self.approx.cut(distance_threshold)
+        ari = adjusted_rand_score(exact_labels, approx_labels)
+        return (f'kNN engine vs exact clustering on {len(self.sample)} sampled issues: '
+                f'adjusted rand index {ari:.4f}, {exact_labels.max() + 1} exact vs {approx_labels.max() + 1} kNN clusters')
@@ -0,0 +1,140 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Concurrent LLM classification of jira issues used by backend_issues.py.
+#
+# Every issue goes through two chat stages: 'reasoning' asks the model to reason about
+# the issue, 'verdict' asks it to answer Yes/No based on that reasoning. Issues are
+# classified by a pool of threads, so several requests are in flight at once.
+# Failed calls are retried with exponential backoff and every issue has a deadline.
+# Every worker thread has its own client from connect(), an ollama.Client, so its
+# connection is kept alive between requests. Every request gets the time left until the
+# deadline as its timeout, so a hung request can not outlive the deadline.
+
+REASONING_QUESTION = "issue:\n {line}\n \n Is this jira issues describe UI issue that can be potentialy backend issue? Use reasoning and chain of thoughts."
+VERDICT_QUESTION = "{reasoning}\n Is this describing rather backend issue than frontend issue? Start with Yes, if you think so."
+
+STAGES = ['reasoning', 'verdict']
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class ThroughputStats:
+    def __init__(self):
+        self.start = None       # time of the first request, setup before it is not counted
+        self.latencies = {stage: [] for stage in STAGES}
+        self.completed = 0
+        self.failed = 0
+        self.retries = 0
+        self.lock = threading.Lock()
+
+    def begin(self):
+        with self.lock:
+            if self.start is None:
+                self.start = time.time()
+
+    def summary(self):
+        elapsed = time.time() - self.start if self.start is not None else 0.0
+        issues_per_minute = self.completed / elapsed * 60 if elapsed > 0 else 0.0
+        lines = [f'Classified {self.completed} issues ({self.failed} failed, {self.retries} retries) '
+                 f'in {elapsed:.1f}s: {issues_per_minute:.1f} issues/min']
+        for stage in STAGES:
+            latencies = self.latencies[stage]
+            lines.append(f'  {stage:<10} p50 {percentile(latencies, 50):.2f}s  p95 {percentile(latencies, 95):.2f}s  ({len(latencies)} calls)')
+        return '\n'.join(lines)
+
+
+class IssueClassifier:
+    def __init__(self, connect, model, retries=3, backoff=1.0, timeout=300.0):
+        self.connect = connect
+        self.model = model
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.stats = ThroughputStats()
+        self.local = threading.local()
+        self.clients = []
+        self.clients_lock = threading.Lock()
+
+    def client(self, timeout):
+        # Client of the current thread with the timeout of its next request
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.connect()
+            with self.clients_lock:
+                self.clients.append(client)
+        # ollama.Client has no timeout per request, it is set on its httpx client
+        client._client.timeout = timeout
+        return client
+
+    def close(self):
+        with self.clients_lock:
+            for client in self.clients:
+                client.close()
+            self.clients = []
+
+    def chat(self, stage, question, deadline):
+        attempt = 0
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise TimeoutError(f'Issue timed out after {self.timeout}s in stage {stage}')
+            self.stats.begin()
+            start = time.time()
+            try:
+                response = self.client(min(self.timeout, remaining)).chat(
+                    model=self.model,
+                    messages=[
+                        {'role': 'user', 'content': question}
+                    ]
+                )
+            except Exception:
+                if attempt >= self.retries:
+                    raise
+                with self.stats.lock:
+                    self.stats.retries += 1
+                time.sleep(min(self.backoff * 2 ** attempt, max(0.0, deadline - time.time())))
+                attempt += 1
+                continue
+            self.stats.latencies[stage].append(time.time() - start)
+            return response['message']['content']
+
+    def classify(self, line):
+        deadline = time.time() + self.timeout
+        question = REASONING_QUESTION.format(line=line)
+        reasoning = self.chat('reasoning', question, deadline)
+        verdict_question = VERDICT_QUESTION.format(reasoning=reasoning)
+        response = self.chat('verdict', verdict_question, deadline)
+        return {
+            'line': line,
+            'question': question,
+            'reasoning': reasoning,
+            'verdict_question': verdict_question,
+            'response': response,
+            'backend': response.startswith(' Yes') or response.startswith('Yes'),
+        }
+
+    def classify_all(self, lines, concurrency=4):
+        # Yields (index, result, error) in completion order, error is None on success.
+        # Clients of the worker threads are closed with the pool.
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='llm') as pool:
+                futures = {pool.submit(self.classify, line): i for i, line in enumerate(lines)}
+                for future in as_completed(futures):
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        self.stats.failed += 1
+                        yield futures[future], None, e
+                    else:
+                        self.stats.completed += 1
+                        yield futures[future], result, None
+        finally:
+            self.close()
+            self.local = threading.local()
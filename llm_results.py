@@ -0,0 +1,57 @@
+import hashlib
+import sqlite3
+import time
+
+# Result store of backend_issues.py, so interrupted runs can be resumed.
+#
+# One row per classified issue, keyed by issue key and a hash of the prompts and model
+# name. Changing a prompt or the model changes the hash, so only entries classified
+# with the old prompt/model are asked again. The hash of the issue text is stored too,
+# an edited issue is classified again as well.
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def prompt_hash(model, *prompts):
+    return text_hash('\n\0'.join([model, *prompts]))
+
+
+class ResultStore:
+    def __init__(self, db_path):
+        self.db = sqlite3.connect(db_path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS results (
+                issue_key TEXT NOT NULL,
+                prompt_hash TEXT NOT NULL,
+                model TEXT NOT NULL,
+                line_hash TEXT NOT NULL,
+                backend INTEGER NOT NULL,
+                reasoning TEXT NOT NULL,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (issue_key, prompt_hash)
+            )
+        ''')
+        self.db.commit()
+
+    def completed(self, prompt_hash):
+        # issue_key -> (line_hash, backend) for everything classified with this prompt/model
+        rows = self.db.execute(
+            'SELECT issue_key, line_hash, backend FROM results WHERE prompt_hash = ?', (prompt_hash,)
+        )
+        return {row['issue_key']: (row['line_hash'], bool(row['backend'])) for row in rows}
+
+    def save(self, issue_key, prompt_hash, model, line, result):
+        # committed right away, a crash loses at most the issues in flight
+        self.db.execute(
+            'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (issue_key, prompt_hash, model, text_hash(line), int(result['backend']),
+             result['reasoning'], result['response'], time.time()),
+        )
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,100 @@
+import numpy as np
+
+from knn_clustering import normalize
+
+# Cluster level LLM triage for backend_issues.py.
+#
+# Near duplicate issues get the same answer, so not all of them need to be asked. Issues
+# are clustered on their embeddings like in clustering.py. In every tight cluster only a
+# few representatives are classified: the medoid (the member closest to the centroid),
+# then the member least similar to the representatives chosen so far, so sub-groups of
+# the cluster are covered too. Every other member takes the verdict of its most similar
+# representative if their cosine similarity reaches the cutoff.
+#
+# Members below the cutoff, all members of loose clusters (coherence, the mean pairwise
+# cosine distance, above max_coherence) and singletons are classified one by one.
+
+KINDS = ['singleton', 'representative', 'propagated', 'below_cutoff', 'loose_cluster']
+
+
+class TriagePlan:
+    def __init__(self, embeddings, labels, coherences, representatives=2, similarity_cutoff=0.85, max_coherence=0.25):
+        normalized = normalize(embeddings)
+        labels = np.asarray(labels)
+        n = len(labels)
+        self.similarity_cutoff = similarity_cutoff
+        # index of the representative whose verdict an issue takes, -1 if it is classified itself
+        self.representative_of = np.full(n, -1, dtype=np.int64)
+        self.similarity = np.ones(n, dtype=np.float32)
+        self.kinds = ['singleton'] * n
+
+        order = np.argsort(labels, kind='stable')
+        boundaries = np.flatnonzero(np.diff(labels[order])) + 1
+        for members in np.split(order, boundaries):
+            if len(members) < 2:
+                continue
+            if coherences[labels[members[0]]] > max_coherence:
+                for member in members:
+                    self.kinds[member] = 'loose_cluster'
+                continue
+
+            vectors = normalized[members]
+            centroid = vectors.sum(axis=0)
+            reps = [int(np.argmax(vectors @ centroid))]
+            best = vectors @ vectors[reps[0]]       # similarity to the most similar representative
+            nearest = np.zeros(len(members), dtype=np.int64)
+            while len(reps) < min(representatives, len(members)):
+                candidate = int(np.argmin(best))
+                if best[candidate] >= similarity_cutoff:
+                    # every member is already covered
+                    break
+                sims = vectors @ vectors[candidate]
+                nearest[sims > best] = len(reps)
+                best = np.maximum(best, sims)
+                reps.append(candidate)
+
+            for i, member in enumerate(members):
+                if i in reps:
+                    self.kinds[member] = 'representative'
+                elif best[i] >= similarity_cutoff:
+                    self.kinds[member] = 'propagated'
+                    self.representative_of[member] = members[reps[nearest[i]]]
+                    self.similarity[member] = best[i]
+                else:
+                    self.kinds[member] = 'below_cutoff'
+
+    def direct(self):
+        # Issues classified by the LLM themselves
+        return [i for i, rep in enumerate(self.representative_of.tolist()) if rep < 0]
+
+    def propagated(self):
+        return [i for i, rep in enumerate(self.representative_of.tolist()) if rep >= 0]
+
+    def counts(self):
+        return {kind: self.kinds.count(kind) for kind in KINDS}
+
+    def summary(self):
+        counts = self.counts()
+        n = len(self.kinds)
+        direct = n - counts['propagated']
+        return (f'Triage: {n} issues, {direct} classified by the LLM ({n / max(direct, 1):.1f}x fewer calls), '
+                f'{counts["propagated"]} take the verdict of one of {counts["representative"]} representatives. '
+                f'Classified one by one: {counts["singleton"]} singletons, {counts["loose_cluster"]} in loose clusters, '
+                f'{counts["below_cutoff"]} below similarity {self.similarity_cutoff}')
+
+
+def agreement_sample(propagated, size, seed=0):
+    # Random propagated issues to be classified directly as well
+    rng = np.random.default_rng(seed)
+    return sorted(rng.choice(propagated, size=min(size, len(propagated)), replace=False).tolist()) if propagated else []
+
+
+def agreement_report(pairs):
+    # pairs of (propagated verdict, direct verdict)
+    if not pairs:
+        return 'Agreement: no propagated issues were checked'
+    agree = sum(1 for propagated, direct in pairs if propagated == direct)
+    false_yes = sum(1 for propagated, direct in pairs if propagated and not direct)
+    false_no = sum(1 for propagated, direct in pairs if direct and not propagated)
+    return (f'Agreement with per-issue classification on {len(pairs)} sampled propagated issues: '
+            f'{agree / len(pairs) * 100:.1f}% ({false_yes} propagated Yes were No, {false_no} propagated No were Yes)')
@@ -0,0 +1,65 @@
+import argparse
+import json
+import os
+import time
+
+# Versioned local copies of the sentence transformer model.
+#
+# run.sh starts every run in a fresh container with an empty model cache, so loading the
+# model by name downloads it again. An artifact is a SentenceTransformer.save() directory
+# at <root>/<model>/<version>/ with an artifact.json. data/models (mounted by run.sh) is
+# searched before /opt/models (baked into the image by the Dockerfile), so a mounted
+# artifact replaces the baked one without rebuilding. MODEL_ARTIFACTS overrides the list
+# of roots. Without an artifact the model is loaded by name as before.
+#
+# Example:
+#   python model_artifacts.py --model all-mpnet-base-v2 --root data/models
+
+ARTIFACT_VERSION = '1'
+ARTIFACT_ROOTS = ['data/models', '/opt/models']
+ARTIFACT_FILE = 'artifact.json'
+
+
+def artifact_dir(root, model_name, version=ARTIFACT_VERSION):
+    return os.path.join(root, model_name.replace('/', '_'), version)
+
+
+def resolve_model(model_name, version=ARTIFACT_VERSION):
+    # Directory of the first artifact of the model found, or the model name to download it
+    roots = os.environ.get('MODEL_ARTIFACTS', os.pathsep.join(ARTIFACT_ROOTS)).split(os.pathsep)
+    for root in roots:
+        path = artifact_dir(root, model_name, version)
+        if os.path.exists(os.path.join(path, ARTIFACT_FILE)):
+            return path
+    return model_name
+
+
+def save_artifact(model_name, root, version=ARTIFACT_VERSION):
+    import sentence_transformers
+    from sentence_transformers import SentenceTransformer
+
+    path = artifact_dir(root, model_name, version)
+    model = SentenceTransformer(model_name, device='cpu')
+    model.save(path)
+    # written last, a directory without it is an interrupted save and is not used
+    with open(os.path.join(path, ARTIFACT_FILE), 'w', encoding='utf-8') as file:
+        json.dump({
+            'model_name': model_name,
+            'version': version,
+            'sentence_transformers': sentence_transformers.__version__,
+            'dimension': model.get_sentence_embedding_dimension(),
+            'created_at': time.time(),
+        }, file, indent=2)
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Save the sentence transformer model as a versioned local artifact.')
+    parser.add_argument('--model', type=str, default='all-mpnet-base-v2', help='Model name or directory.')
+    parser.add_argument('--root', type=str, default=ARTIFACT_ROOTS[0], help='Directory the artifact is saved under.')
+    parser.add_argument('--version', type=str, default=ARTIFACT_VERSION, help='Artifact version.')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    path = save_artifact(args.model, args.root, args.version)
+    print(f'Saved {args.model} to {path} in {time.perf_counter() - start:.1f}s')
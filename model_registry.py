@@ -0,0 +1,62 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from encoder_backends import load_encoder
+from instrumentation import metrics
+
+# Process-wide registry of sentence transformer models for the Flask app.
+#
+# Models are loaded once (normally at startup), warmed up with a small batch and
+# then shared by all requests. Encode calls are executed by a bounded worker pool,
+# so concurrent clustering requests queue for the same model copy instead of each
+# loading its own. ENCODER_BACKEND selects torch, onnx or onnx_int8 (see encoder_backends.py).
+
+WARMUP_SENTENCES = [
+    'Orders table have broken sorting for column date;',
+    'Customer form validation for birth date;',
+]
+
+
+class PooledModel:
+    # Drop-in replacement for SentenceTransformer.encode that runs on the registry pool
+    def __init__(self, model, pool):
+        self.model = model
+        self.pool = pool
+
+    def encode(self, sentences, **kwargs):
+        return self.pool.submit(self.model.encode, sentences, **kwargs).result()
+
+
+class ModelRegistry:
+    def __init__(self, max_workers=None, backend=None, onnx_dir=None):
+        if max_workers is None:
+            max_workers = int(os.environ.get('ENCODE_WORKERS', '2'))
+        self.max_workers = max_workers
+        self.backend = backend or os.environ.get('ENCODER_BACKEND', 'torch')
+        self.onnx_dir = onnx_dir or os.environ.get('ONNX_DIR') or None
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='encode')
+        self.models = {}
+        self.lock = threading.Lock()
+
+    def load(self, model_name, warmup=True):
+        with self.lock:
+            if model_name not in self.models:
+                start = time.time()
+                with metrics.stage('model_load'):
+                    model = load_encoder(model_name, self.backend, self.onnx_dir)
+                loaded = time.time()
+                if warmup:
+                    model.encode(WARMUP_SENTENCES)
+                metrics.milestone('model_loaded')
+                print(f'Model {model_name} ({self.backend}) loaded in {loaded - start:.2f}s, warm-up took {time.time() - loaded:.2f}s')
+                self.models[model_name] = PooledModel(model, self.pool)
+            return self.models[model_name]
+
+    def get(self, model_name):
+        # Loads lazily if the model was not preloaded at startup
+        model = self.models.get(model_name)
+        if model is None:
+            model = self.load(model_name)
+        return model
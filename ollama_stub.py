@@ -0,0 +1,76 @@
+import argparse
+import hashlib
+import json
+import random
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Minimal stand-in for the ollama server, to run backend_issues.py without a real model.
+# Answers POST /api/chat after a configurable delay with a deterministic Yes/No answer
+# and fails a configurable share of requests, so retries and timeouts can be exercised.
+#
+# Example:
+#   python ollama_stub.py --port 11435 --delay 0.5 --fail_rate 0.1
+#   python backend_issues.py --host http://localhost:11435
+
+parser = argparse.ArgumentParser(description='Local stub of the ollama /api/chat endpoint.')
+parser.add_argument('--port', type=int, default=11435, help='Port to listen on.')
+parser.add_argument('--delay', type=float, default=0.2, help='Seconds to wait before answering.')
+parser.add_argument('--jitter', type=float, default=0.1, help='Random extra delay in seconds.')
+parser.add_argument('--fail_rate', type=float, default=0.0, help='Share of requests answered with HTTP 500.')
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    delay = 0.2
+    jitter = 0.1
+    fail_rate = 0.0
+
+    def do_GET(self):
+        self.send_text(200, 'Ollama is running')
+
+    def do_POST(self):
+        if self.path != '/api/chat':
+            self.send_text(404, 'not found')
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        time.sleep(self.delay + random.random() * self.jitter)
+        if random.random() < self.fail_rate:
+            self.send_text(500, json.dumps({'error': 'stub failure'}))
+            return
+
+        question = request['messages'][-1]['content']
+        digest = hashlib.sha256(question.encode('utf-8')).digest()
+        if 'Start with Yes' in question:
+            content = 'Yes, this looks like a backend issue.' if digest[0] % 2 else 'No, this is a frontend issue.'
+        else:
+            content = f'Reasoning about the issue ({digest.hex()[:8]}).'
+        body = json.dumps({
+            'model': request.get('model', ''),
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'message': {'role': 'assistant', 'content': content},
+            'done': True,
+            'done_reason': 'stop',
+        })
+        self.send_text(200, body, 'application/json')
+
+    def send_text(self, status, body, content_type='text/plain'):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    StubHandler.delay = args.delay
+    StubHandler.jitter = args.jitter
+    StubHandler.fail_rate = args.fail_rate
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), StubHandler)
+    print(f'Ollama stub listening on http://127.0.0.1:{args.port}')
+    server.serve_forever()
@@ -0,0 +1,171 @@
+import csv
+import html
+import io
+
+# Writes the clustered csv and html reports.
+#
+# Both files are produced in one traversal of the sorted clusters. Rows are formatted
+# into in-memory buffers that are written out in large chunks, and the per column html
+# formatting (Issue key link or plain escaped cell) is decided once per column, not per cell.
+# The output is the same as the original per-row writers in clustering.py.
+
+BUFFER_SIZE = 1 << 20
+MISC_CHUNK_SIZE = 4096
+ISSUE_LINK = 'https://issues.redhat.com/browse/'
+# joins cells of a row for escaping, html.escape leaves it untouched
+SEPARATOR = '\x1f'
+
+
+class BufferedCsvWriter:
+    def __init__(self, file):
+        self.file = file
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, delimiter=';')
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+
+    def writerows(self, rows):
+        # Rows without delimiter, quote or line breaks are joined directly, like csv.writer
+        # would write them. The rest goes through csv.writer for quoting.
+        write = self.buffer.write
+        writerow = self.writer.writerow
+        for row in rows:
+            joined = ';'.join(row)
+            if (joined.count(';') == len(row) - 1 and '"' not in joined and '\n' not in joined
+                    and '\r' not in joined and joined):
+                write(joined + '\r\n')
+            else:
+                writerow(row)
+        if self.buffer.tell() >= BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.file.write(self.buffer.getvalue())
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+
+class BufferedHtmlWriter:
+    def __init__(self, file, header):
+        self.file = file
+        self.parts = []
+        self.size = 0
+
+        # formatting of each column is decided once
+        escape = html.escape
+        self.formatters = [
+            (lambda cell: f'<td><a href="{ISSUE_LINK}{cell}">{escape(cell)}</a></td>')
+            if col_name == "Issue key" else
+            (lambda cell: f'<td>{escape(cell)}</td>')
+            for col_name in header
+        ]
+        self.key_columns = [col for col, col_name in enumerate(header) if col_name == "Issue key"]
+        self.header_row = '<tr>' + ''.join(f'<th>{escape(col_name)}</th>' for col_name in header) + '</tr>\n'
+
+    def write(self, text):
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= BUFFER_SIZE:
+            self.flush()
+
+    def write_rows(self, rows):
+        # A row is escaped with one html.escape call on its cells joined by SEPARATOR,
+        # rows containing SEPARATOR themselves fall back to per cell formatting.
+        formatters = self.formatters
+        key_columns = self.key_columns
+        n_columns = len(formatters)
+        escape = html.escape
+        for row in rows:
+            if len(row) > n_columns:
+                row = row[:n_columns]
+            if not row:
+                self.write('<tr></tr>\n')
+                continue
+            joined = SEPARATOR.join(row)
+            if joined.count(SEPARATOR) != len(row) - 1:
+                self.write('<tr>' + ''.join([format_cell(cell) for format_cell, cell in zip(formatters, row)]) + '</tr>\n')
+                continue
+            cells = escape(joined).split(SEPARATOR)
+            for col in key_columns:
+                if col < len(cells):
+                    cells[col] = f'<a href="{ISSUE_LINK}{row[col]}">{cells[col]}</a>'
+            self.write('<tr><td>' + '</td><td>'.join(cells) + '</td></tr>\n')
+
+    def flush(self):
+        self.file.write(''.join(self.parts))
+        self.parts = []
+        self.size = 0
+
+
+def html_prologue():
+    return (
+        '<html>\n<head>\n<meta charset="UTF-8">\n<title>Clusters</title>\n'
+        '<style>\n'
+        'table {border-collapse: collapse; width: 100%; }\n'
+        'th, td {border: 1px solid black; padding: 8px; text-align: left;}\n'
+        '.cluster-header {background-color: #f2f2f2; font-weight: bold;}\n'
+        '</style>\n'
+        '</head>\n<body>\n'
+        '<table>\n'
+    )
+
+
+def write_reports(csv_filename, html_filename, header, rows, cluster_indices, sorted_cluster_ids, coherences):
+    # Writes csv (and html unless html_filename is None) reports, returns number of clusters with more than one item.
+    # rows is anything indexable by row number (list or streaming.RowStore).
+    csvfile = open(csv_filename, 'w', newline='', encoding='utf-8')
+    htmlfile = open(html_filename, 'w', encoding='utf-8') if html_filename else None
+    try:
+        csv_out = BufferedCsvWriter(csvfile)
+        html_out = BufferedHtmlWriter(htmlfile, header) if htmlfile else None
+        colspan = len(header)
+
+        csv_out.writerow(header)
+        if html_out:
+            html_out.write(html_prologue())
+
+        large_clusters_count = 0
+        misc_indices = []
+        for cluster_id in sorted_cluster_ids:
+            indices = cluster_indices[cluster_id]
+            if len(indices) == 1:
+                misc_indices.append(indices[0])
+                continue
+
+            large_clusters_count += 1
+            cluster_rows = [rows[idx] for idx in indices]
+            title = f'Cluster items distance: {coherences[cluster_id]:.4f}'
+
+            csv_out.writerow([title])
+            csv_out.writerows(cluster_rows)
+            # Write empty lines to separate clusters
+            csv_out.writerows([[], [], [], []])
+
+            if html_out:
+                html_out.write(f'<tr class="cluster-header"><td colspan="{colspan}">{title}</td></tr>\n')
+                html_out.write(html_out.header_row)
+                html_out.write_rows(cluster_rows)
+                html_out.write(f'<tr><td colspan="{colspan}">&nbsp;</td></tr>\n' * 2)
+
+        # miscellaneous cluster with all single item clusters, fetched in chunks
+        csv_out.writerow([f'Miscelaneous cluster'])
+        if html_out:
+            html_out.write(f'<tr class="cluster-header"><td colspan="{colspan}">Miscellaneous cluster</td></tr>\n')
+            html_out.write(html_out.header_row)
+        for start in range(0, len(misc_indices), MISC_CHUNK_SIZE):
+            misc_rows = [rows[idx] for idx in misc_indices[start:start + MISC_CHUNK_SIZE]]
+            csv_out.writerows(misc_rows)
+            if html_out:
+                html_out.write_rows(misc_rows)
+        csv_out.flush()
+
+        if html_out:
+            html_out.write('</table>\n</body>\n</html>\n')
+            html_out.flush()
+    finally:
+        csvfile.close()
+        if htmlfile:
+            htmlfile.close()
+
+    return large_clusters_count
@@ -0,0 +1,86 @@
+import os
+import time
+from multiprocessing import get_all_start_methods, get_context
+
+import numpy as np
+
+# Sentence embeddings computed by a pool of worker processes, for CPU-only hosts.
+#
+# Every worker loads its own copy of the model and limits torch to a fixed number of
+# threads, so N workers x T threads use the cores without oversubscription. Lines are
+# sorted by length and cut into shards of consecutive lines, so a shard of short
+# summaries is not padded to the length of the longest description. Shards are handed
+# out to whichever worker is free and the embeddings are put back in the input order.
+#
+# ShardedEncoder.encode has the same interface as SentenceTransformer.encode and can be
+# passed to EmbeddingCache.encode in its place.
+
+worker_model = None
+
+
+def _init_worker(model_name, threads, backend, onnx_dir):
+    global worker_model
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    os.environ['MKL_NUM_THREADS'] = str(threads)
+    if backend == 'torch':
+        import torch
+        torch.set_num_threads(threads)
+    from encoder_backends import load_encoder
+    worker_model = load_encoder(model_name, backend, onnx_dir, threads=threads)
+
+
+def _encode_shard(shard_id, lines, encode_kwargs):
+    start = time.perf_counter()
+    embeddings = np.asarray(worker_model.encode(lines, **encode_kwargs), dtype=np.float32)
+    return shard_id, embeddings, os.getpid(), time.perf_counter() - start
+
+
+class ShardedEncoder:
+    def __init__(self, model_name, workers, threads_per_worker=None, shard_size=256, backend='torch', onnx_dir=None):
+        if threads_per_worker is None:
+            threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+        self.model_name = model_name
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker
+        self.shard_size = shard_size
+        # Workers are forked before the parent runs any torch operation, so no OpenMP thread
+        # pool is inherited. Spawned workers would import clustering.py, a script, again.
+        method = 'fork' if 'fork' in get_all_start_methods() else 'spawn'
+        self.pool = get_context(method).Pool(workers, initializer=_init_worker,
+                                             initargs=(model_name, threads_per_worker, backend, onnx_dir))
+        self.worker_stats = {}  # pid -> [rows, seconds]
+
+    def encode(self, sentences, **encode_kwargs):
+        if isinstance(sentences, str):
+            return self.encode([sentences], **encode_kwargs)[0]
+        encode_kwargs.pop('show_progress_bar', None)
+        n = len(sentences)
+        if n == 0:
+            return np.empty((0, 0), dtype=np.float32)
+
+        # length buckets: shards of lines with similar length
+        order = sorted(range(n), key=lambda i: len(sentences[i]))
+        shards = [order[start:start + self.shard_size] for start in range(0, n, self.shard_size)]
+        tasks = [(shard_id, [sentences[i] for i in shard], encode_kwargs) for shard_id, shard in enumerate(shards)]
+
+        result = None
+        # longest shards first, so the last shards to finish are short ones
+        for shard_id, embeddings, pid, seconds in self.pool.starmap_async(_encode_shard, tasks[::-1], chunksize=1).get():
+            if result is None:
+                result = np.empty((n, embeddings.shape[1]), dtype=np.float32)
+            result[shards[shard_id]] = embeddings
+            stats = self.worker_stats.setdefault(pid, [0, 0.0])
+            stats[0] += len(shards[shard_id])
+            stats[1] += seconds
+        return result
+
+    def summary(self):
+        lines = [f'Encoding workers: {self.workers} x {self.threads_per_worker} threads, shards of {self.shard_size} lines']
+        for pid, (rows, seconds) in sorted(self.worker_stats.items()):
+            rate = rows / seconds if seconds > 0 else 0.0
+            lines.append(f'  worker {pid}: {rows} lines in {seconds:.2f}s ({rate:.1f} lines/s)')
+        return '\n'.join(lines)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
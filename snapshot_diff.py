@@ -0,0 +1,141 @@
+from collections import Counter
+
+from cluster_model import line_hash, row_hash
+from report import BufferedCsvWriter, BufferedHtmlWriter, html_prologue
+from streaming import line_column_indices
+
+# Snapshot diff of successive exports of the same project, for clustering.py --diff.
+#
+# The previous run is its saved cluster model. Rows of the new export are matched to it
+# by Issue key (see cluster_model.issue_keys) and compared by the hashes of their
+# clustered columns and of the whole row saved with the model, saved rows are not read.
+# Added and modified issues are encoded and assigned to clusters like in --assign,
+# removed issues are dropped, unchanged issues keep their vectors and clusters. Changes
+# in other columns only update the stored row. After reading the csv, the work is
+# proportional to the number of changed issues.
+#
+# The report lists only what changed: new clusters with all their issues, existing
+# clusters that got added issues, issues that moved to another existing cluster (after
+# their text changed or a reconsolidation) and removed issues.
+
+CHANGE_COLUMNS = ['Change', 'Cluster', 'Old cluster', 'Cluster size']
+
+
+class SnapshotDiff:
+    def __init__(self, model, keys, rows):
+        col_nums = line_column_indices(model.header, model.columns)
+        # lines are encoded prepared like the lines of the model
+        encoded_line = model.line_function()
+        self.header = model.header
+        self.old_ids = dict(zip(model.keys, model.cluster_ids.tolist()))
+        self.old_sizes = Counter(model.cluster_ids.tolist())
+
+        self.added = []
+        self.modified = []
+        self.updated = 0
+        self.unchanged = 0
+        self.changed_rows = {}      # key -> row of added and modified issues
+        seen = set()
+        for key, row in zip(keys, rows):
+            if key in seen:
+                continue
+            seen.add(key)
+            index = model.key_index.get(key)
+            if index is None:
+                self.added.append(key)
+            elif int(model.hashes[index, 0]) != line_hash(col_nums, row):
+                self.modified.append(key)
+            else:
+                if int(model.hashes[index, 1]) != row_hash(row):
+                    model.rows[index] = row
+                    self.updated += 1
+                else:
+                    self.unchanged += 1
+                continue
+            self.changed_rows[key] = row
+        self.changed_keys = self.added + self.modified
+        # clustered lines of the issues to encode, in the order of changed_keys
+        self.lines = [encoded_line(self.changed_rows[key]) for key in self.changed_keys]
+        self.removed = [key for key in model.keys if key not in seen]
+        self.removed_rows = {key: model.rows[model.key_index[key]] for key in self.removed}
+
+    def apply(self, model, embeddings):
+        # Drops removed and modified issues from the model and assigns added and modified ones again
+        model.remove(self.removed + self.modified)
+        return model.assign(self.changed_keys, [self.changed_rows[key] for key in self.changed_keys], embeddings)
+
+    def summary(self):
+        return (f'Snapshot diff: {len(self.added)} added, {len(self.modified)} modified, {len(self.removed)} removed, '
+                f'{self.unchanged + self.updated} unchanged issues ({self.updated} with changes in other columns only)')
+
+    def changes(self, model):
+        # Changes of the model after apply, every issue is in one of them at most:
+        # new clusters (cluster id -> all its keys), grown clusters (existing cluster id -> keys
+        # of added issues), moved keys (issues of the previous run now in another existing cluster)
+        new_clusters = {}
+        grown_clusters = {}
+        moved = []
+        for key, cluster_id in zip(model.keys, model.cluster_ids.tolist()):
+            if cluster_id not in self.old_sizes:
+                new_clusters.setdefault(cluster_id, []).append(key)
+            elif key not in self.old_ids:
+                grown_clusters.setdefault(cluster_id, []).append(key)
+            elif self.old_ids[key] != cluster_id:
+                moved.append(key)
+        return new_clusters, grown_clusters, moved
+
+    def write_report(self, csv_filename, html_filename, model):
+        # Compact csv (one line per changed issue) and html report of the changes
+        new_clusters, grown_clusters, moved = self.changes(model)
+        sizes = Counter(model.cluster_ids.tolist())
+        new_ids = dict(zip(model.keys, model.cluster_ids.tolist()))
+        row_of = lambda key: model.rows[model.key_index[key]]
+        colspan = len(self.header) + len(CHANGE_COLUMNS)
+
+        csvfile = open(csv_filename, 'w', newline='', encoding='utf-8')
+        htmlfile = open(html_filename, 'w', encoding='utf-8')
+        try:
+            csv_out = BufferedCsvWriter(csvfile)
+            html_out = BufferedHtmlWriter(htmlfile, CHANGE_COLUMNS + self.header)
+            csv_out.writerow(CHANGE_COLUMNS + self.header)
+            html_out.write(html_prologue())
+
+            def section(title, groups):
+                # groups: list of (group title, rows with change columns)
+                html_out.write(f'<tr class="cluster-header"><td colspan="{colspan}">{title}</td></tr>\n')
+                for group_title, rows in groups:
+                    if not rows:
+                        continue
+                    if group_title:
+                        html_out.write(f'<tr><td colspan="{colspan}"><b>{group_title}</b></td></tr>\n')
+                    html_out.write(html_out.header_row)
+                    html_out.write_rows(rows)
+                    csv_out.writerows(rows)
+                html_out.write(f'<tr><td colspan="{colspan}">&nbsp;</td></tr>\n')
+
+            change_row = lambda change, key, row: \
+                [change, str(new_ids.get(key, '')), str(self.old_ids.get(key, '')), str(sizes.get(new_ids.get(key), ''))] + row
+
+            section(f'New clusters: {len(new_clusters)}', [
+                (f'Cluster {cluster_id}: {len(keys)} issues', [change_row('new cluster', key, row_of(key)) for key in keys])
+                for cluster_id, keys in sorted(new_clusters.items(), key=lambda item: -len(item[1]))
+            ])
+            section(f'Grown clusters: {len(grown_clusters)}', [
+                (f'Cluster {cluster_id}: {self.old_sizes[cluster_id]} -> {sizes[cluster_id]} issues',
+                 [change_row('added', key, row_of(key)) for key in keys])
+                for cluster_id, keys in sorted(grown_clusters.items(), key=lambda item: -len(item[1]))
+            ])
+            section(f'Moved issues: {len(moved)}', [
+                (None, [change_row('moved', key, row_of(key)) for key in moved])
+            ])
+            section(f'Removed issues: {len(self.removed)}', [
+                (None, [change_row('removed', key, self.removed_rows[key]) for key in self.removed])
+            ])
+
+            csv_out.flush()
+            html_out.write('</table>\n</body>\n</html>\n')
+            html_out.flush()
+        finally:
+            csvfile.close()
+            htmlfile.close()
+        return new_clusters, grown_clusters, moved
@@ -0,0 +1,144 @@
+import json
+import os
+import threading
+from itertools import islice
+
+import numpy as np
+
+import instrumentation
+
+# Streaming ingestion for exports larger than RAM.
+#
+# The semicolon CSV is read in chunks, every chunk is encoded as soon as it is read
+# and its vectors are appended to a float32 file that is memory-mapped at the end.
+# Raw rows are spilled to disk as JSON lines with an int64 offset index, so report
+# writers fetch row N with a single seek instead of keeping all rows in a list.
+
+ROWS_FILE = 'rows.jsonl'
+ROWS_INDEX_FILE = 'rows.idx'
+VECTORS_FILE = 'embeddings.f32'
+
+
+class RowStore:
+    def __init__(self, directory, existing=False):
+        self.data_path = os.path.join(directory, ROWS_FILE)
+        self.index_path = os.path.join(directory, ROWS_INDEX_FILE)
+        if existing:
+            # rows written and finished before (e.g. saved with a cluster model) are only read
+            self.offsets = np.fromfile(self.index_path, dtype=np.int64)
+            self.count = len(self.offsets) - 1
+            self.position = int(self.offsets[-1])
+            self.index_file = None
+            self.data_file = open(self.data_path, 'rb')
+            self.lock = threading.Lock()
+            return
+        self.data_file = open(self.data_path, 'wb')
+        self.index_file = open(self.index_path, 'wb')
+        self.position = 0
+        self.count = 0
+        self.offsets = None
+        self.lock = threading.Lock()
+
+    def append(self, row):
+        data = json.dumps(row, ensure_ascii=False).encode('utf-8') + b'\n'
+        self.index_file.write(np.int64(self.position).tobytes())
+        self.data_file.write(data)
+        self.position += len(data)
+        self.count += 1
+
+    def finish(self):
+        # Closes the writer and switches the store to read mode
+        self.index_file.write(np.int64(self.position).tobytes())
+        self.index_file.close()
+        self.data_file.close()
+        self.offsets = np.fromfile(self.index_path, dtype=np.int64)
+        self.data_file = open(self.data_path, 'rb')
+
+    def extend(self, rows):
+        # Appends rows to a finished store, rows.idx keeps ending with the end of the data.
+        # Data of an interrupted extend after the last offset is overwritten.
+        ends = []
+        with self.lock, open(self.data_path, 'r+b') as data_file, open(self.index_path, 'ab') as index_file:
+            data_file.truncate(self.position)
+            data_file.seek(self.position)
+            for row in rows:
+                data = json.dumps(row, ensure_ascii=False).encode('utf-8') + b'\n'
+                data_file.write(data)
+                self.position += len(data)
+                ends.append(self.position)
+            data_file.flush()
+            index_file.write(np.array(ends, dtype=np.int64).tobytes())
+        self.offsets = np.concatenate([self.offsets, np.array(ends, dtype=np.int64)])
+        self.count += len(ends)
+
+    def reopen(self):
+        # Own read handle, for a forked process
+        self.data_file = open(self.data_path, 'rb')
+        self.lock = threading.Lock()
+
+    def close(self):
+        self.data_file.close()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self.count
+        if not 0 <= idx < self.count:
+            raise IndexError(idx)
+        start = int(self.offsets[idx])
+        with self.lock:
+            self.data_file.seek(start)
+            data = self.data_file.read(int(self.offsets[idx + 1]) - start)
+        return json.loads(data)
+
+    def __iter__(self):
+        with open(self.data_path, 'rb') as file:
+            for data in file:
+                yield json.loads(data)
+
+
+def line_column_indices(header, columns):
+    # Same column order as the row loop in clustering.py: header order, last duplicate wins
+    header_dict = {col_name: idx for idx, col_name in enumerate(header)}
+    return [col_num for header_item, col_num in header_dict.items() if header_item in columns]
+
+
+def stream_embeddings(reader, header, columns, encode, work_dir, chunk_size=1024, progress=None, make_line=None):
+    # reader yields CSV rows after the header, encode turns a list of lines into vectors.
+    # make_line(row) replaces the default "cell;cell;" line of the selected columns.
+    # Returns (RowStore, memory-mapped embeddings).
+    col_nums = line_column_indices(header, columns)
+    if make_line is None:
+        make_line = lambda row: ''.join(row[col_num] + ';' for col_num in col_nums)
+    rows = RowStore(work_dir)
+    vectors_path = os.path.join(work_dir, VECTORS_FILE)
+    dim = None
+    count = 0
+
+    with open(vectors_path, 'wb') as vectors_file:
+        while True:
+            raw_chunk = list(islice(reader, chunk_size))
+            if not raw_chunk:
+                break
+            chunk = [row for row in raw_chunk if len(row) > 0]
+            if not chunk:
+                continue
+            lines = [make_line(row) for row in chunk]
+            if instrumentation.verbosity >= 2:
+                for line in lines:
+                    print('line =', line)
+            embeddings = np.asarray(encode(lines), dtype=np.float32)
+            dim = embeddings.shape[1]
+            vectors_file.write(embeddings.tobytes())
+            for row in chunk:
+                rows.append(row)
+            count += len(chunk)
+            if progress:
+                progress(count)
+
+    rows.finish()
+    if count == 0:
+        return rows, np.empty((0, 0), dtype=np.float32)
+    return rows, np.memmap(vectors_path, dtype=np.float32, mode='r', shape=(count, dim))
@@ -0,0 +1,109 @@
+import csv
+import os
+from multiprocessing import get_all_start_methods, get_context
+
+import numpy as np
+
+from report import write_reports
+
+# Threshold sweep: embeddings are encoded and the cluster tree (or kNN graph) is built
+# once, then cut at every threshold. Cuts are cheap, so a sweep costs little more than
+# a single run and replaces guessing -d in the interactive loop.
+#
+# Every cut is summarized by its cluster counts, cluster sizes and coherences. Reports
+# of all thresholds can be written by forked worker processes, which inherit the rows
+# instead of receiving a pickled copy.
+
+SUMMARY_COLUMNS = ['threshold', 'clusters', 'large_clusters', 'clustered_issues', 'singletons',
+                   'largest', 'median_size', 'p90_size', 'mean_coherence', 'max_coherence']
+
+# (header, rows) of the reports, set before the report workers are forked
+report_data = None
+
+
+def parse_thresholds(s):
+    # "0.3,0.4,0.5" or "start:stop:step" with stop included, parts can be combined
+    thresholds = []
+    for part in s.split(','):
+        part = part.strip()
+        if ':' in part:
+            start, stop, step = (float(value) for value in part.split(':'))
+            if step <= 0:
+                raise ValueError(f'Step of threshold range {part} must be positive')
+            count = int(np.floor((stop - start) / step + 1e-9)) + 1
+            thresholds.extend(round(start + i * step, 6) for i in range(count))
+        elif part:
+            thresholds.append(float(part))
+    if not thresholds:
+        raise ValueError('No thresholds given')
+    return sorted(set(thresholds))
+
+
+def sweep_filename(output_file, threshold):
+    # data/out.csv -> data/out_d0.45.csv
+    base, ext = os.path.splitext(output_file)
+    return f'{base}_d{threshold:g}{ext or ".csv"}'
+
+
+def cut_statistics(threshold, labels, coherences):
+    # Summary of one cut, clusters of one issue are counted as singletons
+    sizes = np.bincount(labels)
+    coherences = np.asarray(coherences)[:len(sizes)]
+    large = sizes > 1
+    large_sizes = sizes[large]
+    return {
+        'threshold': threshold,
+        'clusters': len(sizes),
+        'large_clusters': int(large.sum()),
+        'clustered_issues': int(large_sizes.sum()),
+        'singletons': int((~large).sum()),
+        'largest': int(sizes.max()) if len(sizes) else 0,
+        'median_size': float(np.median(large_sizes)) if len(large_sizes) else 0.0,
+        'p90_size': float(np.percentile(large_sizes, 90)) if len(large_sizes) else 0.0,
+        # weighted by cluster size, so large loose clusters count more than small tight ones
+        'mean_coherence': float(np.average(coherences[large], weights=large_sizes)) if len(large_sizes) else 0.0,
+        'max_coherence': float(coherences[large].max()) if len(large_sizes) else 0.0,
+    }
+
+
+def summary_table(statistics):
+    lines = [f"{'threshold':>9} {'clusters':>9} {'large':>7} {'clustered':>10} {'singletons':>10} "
+             f"{'largest':>8} {'median':>7} {'p90':>7} {'mean coh':>9} {'max coh':>8}"]
+    for s in statistics:
+        lines.append(f"{s['threshold']:>9g} {s['clusters']:>9} {s['large_clusters']:>7} {s['clustered_issues']:>10} "
+                     f"{s['singletons']:>10} {s['largest']:>8} {s['median_size']:>7.1f} {s['p90_size']:>7.1f} "
+                     f"{s['mean_coherence']:>9.4f} {s['max_coherence']:>8.4f}")
+    return '\n'.join(lines)
+
+
+def write_summary(filename, statistics):
+    with open(filename, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file, delimiter=';')
+        writer.writerow(SUMMARY_COLUMNS)
+        for s in statistics:
+            writer.writerow([s[column] for column in SUMMARY_COLUMNS])
+
+
+def _init_report_worker():
+    # a streaming.RowStore file handle shared with the parent would share its file position
+    reopen = getattr(report_data[1], 'reopen', None)
+    if reopen:
+        reopen()
+
+
+def _write_report(job):
+    threshold, csv_filename, html_filename, cluster_indices, sorted_cluster_ids, coherences = job
+    header, rows = report_data
+    return threshold, write_reports(csv_filename, html_filename, header, rows, cluster_indices,
+                                    sorted_cluster_ids, coherences)
+
+
+def write_sweep_reports(header, rows, jobs, workers):
+    # jobs are (threshold, csv_filename, html_filename, cluster_indices, sorted_cluster_ids, coherences),
+    # returns (threshold, number of clusters with more than one item) per job
+    global report_data
+    report_data = (header, rows)
+    if workers <= 1 or len(jobs) <= 1 or 'fork' not in get_all_start_methods():
+        return [_write_report(job) for job in jobs]
+    with get_context('fork').Pool(min(workers, len(jobs)), initializer=_init_report_worker) as pool:
+        return pool.map(_write_report, jobs, chunksize=1)
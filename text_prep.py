@@ -0,0 +1,137 @@
+import re
+
+import numpy as np
+
+from streaming import line_column_indices
+
+# Text preparation before encoding.
+#
+# Jira cells are cleaned of markup ({code} and {noformat} blocks, html tags, link and
+# image syntax, urls) and of stack trace frames, which are long, tokenize badly and say
+# little about the issue. Whitespace is collapsed.
+#
+# Every line gets a token budget, shared by its columns by weight: a column with weight 2
+# may use twice the tokens of a column with weight 1, and budget a short column does not
+# use goes to the others. Cells over their budget are cut, so the encoder never tokenizes
+# text it would truncate anyway. Tokens are approximated by whitespace separated words.
+#
+# Lines keep the "cell;cell;" format of clustering.py.
+
+DEFAULT_TOKEN_BUDGET = 256
+
+MARKUP_PATTERNS = [
+    (re.compile(r'\{code(:[^}]*)?\}.*?\{code\}', re.DOTALL), ' '),
+    (re.compile(r'\{noformat\}.*?\{noformat\}', re.DOTALL), ' '),
+    (re.compile(r'\{(color|quote|panel)(:[^}]*)?\}'), ' '),
+    (re.compile(r'<[^>\n]+>'), ' '),
+    (re.compile(r'!\S+\.(png|jpe?g|gif|svg)(\|[^!\n]*)?!', re.IGNORECASE), ' '),
+    (re.compile(r'\[~[^\]\n]+\]'), ' '),
+    (re.compile(r'\[([^|\]\n]*)\|[^\]\n]*\]'), r'\1'),
+    (re.compile(r'https?://\S+'), ' '),
+    (re.compile(r'^h[1-6]\.\s', re.MULTILINE), ''),
+]
+
+STACK_TRACE_LINE = re.compile(
+    r'^\s*('
+    r'at [\w$.<>/]+\(.*\)'                  # java frame
+    r'|at .+:\d+(:\d+)?\)?'                 # javascript frame
+    r'|\.\.\. \d+ (more|common frames omitted)'
+    r'|File ".*", line \d+.*'               # python frame
+    r'|Traceback \(most recent call last\):'
+    r')\s*$',
+    re.MULTILINE,
+)
+
+WHITESPACE = re.compile(r'\s+')
+
+
+def parse_weights(s):
+    # "Summary=3;Description=1" -> {'Summary': 3.0, 'Description': 1.0}
+    weights = {}
+    for item in s.split(';') if s else []:
+        name, _, weight = item.rpartition('=')
+        weights[name] = float(weight)
+    return weights
+
+
+def clean_text(text):
+    for pattern, replacement in MARKUP_PATTERNS:
+        text = pattern.sub(replacement, text)
+    text = STACK_TRACE_LINE.sub('', text)
+    return WHITESPACE.sub(' ', text).strip()
+
+
+def split_budget(lengths, weights, budget):
+    # Budget per cell proportional to weights, budget not used by short cells is shared by the rest
+    budgets = [0] * len(lengths)
+    pending = [i for i, weight in enumerate(weights) if weight > 0]
+    remaining = budget
+    while pending:
+        total_weight = sum(weights[i] for i in pending)
+        shares = {i: remaining * weights[i] / total_weight for i in pending}
+        fitting = [i for i in pending if lengths[i] <= shares[i]]
+        if not fitting:
+            for i in pending:
+                budgets[i] = int(shares[i])
+            break
+        for i in fitting:
+            budgets[i] = lengths[i]
+            remaining -= lengths[i]
+            pending.remove(i)
+    return budgets
+
+
+class TextPreparer:
+    def __init__(self, header, columns, weights=None, token_budget=DEFAULT_TOKEN_BUDGET, clean=True):
+        weights = weights or {}
+        self.col_nums = line_column_indices(header, columns)
+        self.weights = [weights.get(header[col_num], 1.0) for col_num in self.col_nums]
+        self.token_budget = token_budget
+        self.clean = clean
+
+        self.lines = 0
+        self.chars_in = 0
+        self.chars_out = 0
+        self.words_in = 0
+        self.words_out = 0
+        self.truncated_cells = 0
+        self.distinct = set()   # hashes of prepared lines
+
+    def line(self, row):
+        cells = [row[col_num] for col_num in self.col_nums]
+        self.lines += 1
+        self.chars_in += sum(len(cell) + 1 for cell in cells)
+        words = []
+        for cell in cells:
+            cell_words = (clean_text(cell) if self.clean else cell).split()
+            self.words_in += len(cell.split())
+            words.append(cell_words)
+
+        budgets = split_budget([len(cell_words) for cell_words in words], self.weights, self.token_budget)
+        parts = []
+        for cell_words, budget in zip(words, budgets):
+            if len(cell_words) > budget:
+                self.truncated_cells += 1
+                cell_words = cell_words[:budget]
+            self.words_out += len(cell_words)
+            parts.append(' '.join(cell_words) + ';')
+        line = ''.join(parts)
+        self.chars_out += len(line)
+        self.distinct.add(hash(line))
+        return line
+
+    def summary(self):
+        saved = lambda before, after: (1 - after / before) * 100 if before else 0.0
+        return (f'Text preparation: {self.lines} lines ({len(self.distinct)} distinct), {self.words_in} -> {self.words_out} words '
+                f'({saved(self.words_in, self.words_out):.1f}% less), {self.chars_in} -> {self.chars_out} characters '
+                f'({saved(self.chars_in, self.chars_out):.1f}% less), {self.truncated_cells} cells cut to budget')
+
+
+def encode_unique(encode, lines):
+    # Encodes every distinct line once and fans the embeddings back out to all lines
+    positions = {}
+    inverse = [positions.setdefault(line, len(positions)) for line in lines]
+    if len(positions) == len(lines):
+        return encode(lines)
+    embeddings = np.asarray(encode(list(positions)))
+    return embeddings[np.asarray(inverse, dtype=np.intp)]
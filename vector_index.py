@@ -0,0 +1,246 @@
+import json
+import os
+import threading
+
+import numpy as np
+
+from knn_clustering import normalize
+
+# Persistent approximate nearest neighbour index of issue embeddings, used by /api/similar.
+#
+# Inverted file index: vectors are split into lists by their nearest k-means centroid.
+# A query is compared with the centroids first and then only with the vectors of the
+# n_probe nearest lists, so more probes give higher recall at the cost of speed. Until
+# there are enough vectors to train centroids, queries are answered exactly.
+#
+# Vectors are added incrementally to the list of their nearest centroid. Centroids are
+# trained again once the index has grown RETRAIN_FACTOR times since the last training.
+# Uploading a file again replaces its vectors. Removed vectors are dropped on training
+# and once they exceed COMPACT_RATIO of all vectors, trained or not.
+#
+# Layout of the index directory:
+#   index.json      - {"dim": ...}
+#   vectors.f32     - float32 rows of all vectors, removed ones included
+#   items.jsonl     - payload per vector, null once removed
+#   removed.jsonl   - lists of vector ids removed after they were saved
+#   centroids.npy   - trained centroids
+# save() appends the vectors, items and removals since the last save. The files are
+# written again only after compaction or training changed the vector ids.
+
+INDEX_FILE = 'index.json'
+VECTORS_FILE = 'vectors.f32'
+ITEMS_FILE = 'items.jsonl'
+REMOVED_FILE = 'removed.jsonl'
+CENTROIDS_FILE = 'centroids.npy'
+
+# vectors needed before the index is split into lists
+MIN_TRAIN_SIZE = 4096
+RETRAIN_FACTOR = 4
+# vectors sampled for k-means training
+TRAIN_SAMPLE_SIZE = 20000
+# share of removed vectors that triggers compaction
+COMPACT_RATIO = 0.25
+
+
+class VectorIndex:
+    def __init__(self, index_dir, n_probe=8):
+        self.index_dir = index_dir
+        self.n_probe = n_probe
+        self.lock = threading.Lock()
+
+        self.vectors = None         # normalized float32, n x dim, rows after `count` are spare capacity
+        self.count = 0
+        self.items = []             # payload per vector, None once removed
+        self.removed = 0
+        self.centroids = None
+        self.assignments = None     # list of every vector
+        self.lists = []             # vector ids per list
+        self.trained_size = 0
+        self.saved = 0              # vectors already in the files
+        self.saved_removals = []    # ids below `saved` removed since the last save
+        self.rewrite = True         # files are written again on the next save
+
+        self.index_path = os.path.join(index_dir, INDEX_FILE)
+        self.vectors_path = os.path.join(index_dir, VECTORS_FILE)
+        self.items_path = os.path.join(index_dir, ITEMS_FILE)
+        self.removed_path = os.path.join(index_dir, REMOVED_FILE)
+        self.centroids_path = os.path.join(index_dir, CENTROIDS_FILE)
+        os.makedirs(index_dir, exist_ok=True)
+        if os.path.exists(self.index_path):
+            self._load()
+
+    def _load(self):
+        with open(self.index_path, 'r', encoding='utf-8') as file:
+            dim = json.load(file)['dim']
+        with open(self.items_path, 'r', encoding='utf-8') as file:
+            # the last line is incomplete if a save was interrupted
+            items = [json.loads(line) for line in file.read().split('\n')[:-1]]
+        vectors = np.fromfile(self.vectors_path, dtype=np.float32)
+        self.count = min(len(items), len(vectors) // dim)
+        self.vectors = vectors[:self.count * dim].reshape(self.count, dim)
+        self.items = items[:self.count]
+        if os.path.exists(self.removed_path):
+            with open(self.removed_path, 'r', encoding='utf-8') as file:
+                for line in file.read().split('\n')[:-1]:
+                    for i in json.loads(line):
+                        if i < self.count:
+                            self.items[i] = None
+        self.removed = sum(1 for item in self.items if item is None)
+        self.saved = self.count
+        # files of an interrupted save don't line up and are written again
+        self.rewrite = len(items) != self.count or len(vectors) != self.count * dim
+        if os.path.exists(self.centroids_path):
+            self.centroids = np.load(self.centroids_path)
+            self.trained_size = self.count
+            self._assign_all()
+
+    def __len__(self):
+        return self.count - self.removed
+
+    def _assign_all(self):
+        self.assignments = self._nearest_centroids(self.vectors[:self.count])
+        self.lists = [[] for _ in range(len(self.centroids))]
+        for i, list_id in enumerate(self.assignments.tolist()):
+            if self.items[i] is not None:
+                self.lists[list_id].append(i)
+
+    def _nearest_centroids(self, vectors):
+        if len(vectors) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.argmax(vectors @ self.centroids.T, axis=1)
+
+    def _compact(self):
+        # Drops removed vectors, the lists keep the centroid of every remaining vector
+        keep = np.array([item is not None for item in self.items], dtype=bool)
+        self.vectors = self.vectors[:self.count][keep]
+        self.items = [item for item in self.items if item is not None]
+        self.count = len(self.items)
+        self.removed = 0
+        self.rewrite = True
+        self.saved_removals = []
+        if self.centroids is not None:
+            self.assignments = self.assignments[keep]
+            self.lists = [[] for _ in range(len(self.centroids))]
+            for i, list_id in enumerate(self.assignments.tolist()):
+                self.lists[list_id].append(i)
+
+    def _train(self):
+        # Drops removed vectors, trains spherical k-means centroids on a sample and rebuilds the lists
+        from sklearn.cluster import MiniBatchKMeans
+
+        self._compact()
+
+        n_lists = max(1, int(4 * np.sqrt(self.count)))
+        rng = np.random.default_rng(0)
+        sample = self.vectors[rng.choice(self.count, min(self.count, TRAIN_SAMPLE_SIZE), replace=False)]
+        kmeans = MiniBatchKMeans(n_clusters=min(n_lists, len(sample)), random_state=0, n_init=1)
+        kmeans.fit(sample)
+        self.centroids = normalize(kmeans.cluster_centers_)
+        self.trained_size = self.count
+        self._assign_all()
+
+    def add(self, vectors, items):
+        vectors = normalize(vectors)
+        with self.lock:
+            if self.vectors is None:
+                self.vectors = np.empty((0, vectors.shape[1]), dtype=np.float32)
+            if self.count + len(vectors) > len(self.vectors):
+                # capacity doubles, appends are amortized O(1)
+                capacity = max(self.count + len(vectors), 2 * len(self.vectors))
+                grown = np.empty((capacity, self.vectors.shape[1]), dtype=np.float32)
+                grown[:self.count] = self.vectors[:self.count]
+                self.vectors = grown
+            start = self.count
+            self.vectors[start:start + len(vectors)] = vectors
+            self.items.extend(items)
+            self.count += len(vectors)
+
+            size = len(self)
+            if (self.centroids is None and size >= MIN_TRAIN_SIZE) or \
+                    (self.centroids is not None and size >= RETRAIN_FACTOR * self.trained_size):
+                self._train()
+            elif self.centroids is not None:
+                list_ids = self._nearest_centroids(vectors)
+                self.assignments = np.concatenate([self.assignments, list_ids])
+                for i, list_id in enumerate(list_ids.tolist()):
+                    self.lists[list_id].append(start + i)
+
+    def remove(self, predicate):
+        # Removes vectors whose item matches predicate(item), returns number removed
+        removed = 0
+        with self.lock:
+            for i, item in enumerate(self.items):
+                if item is not None and predicate(item):
+                    self.items[i] = None
+                    removed += 1
+                    if i < self.saved:
+                        self.saved_removals.append(i)
+            self.removed += removed
+            if self.removed > COMPACT_RATIO * self.count:
+                self._compact()
+            elif removed and self.centroids is not None:
+                self.lists = [[i for i in ids if self.items[i] is not None] for ids in self.lists]
+        return removed
+
+    def search(self, query, k=10, n_probe=None):
+        # Returns up to k (cosine distance, item) pairs, nearest first
+        query = normalize(np.atleast_2d(query))[0]
+        n_probe = n_probe or self.n_probe
+        with self.lock:
+            k = min(k, len(self))
+            if k < 1:
+                return []
+            if self.centroids is None:
+                ids = np.array([i for i in range(self.count) if self.items[i] is not None], dtype=np.int64)
+            else:
+                centroid_similarities = self.centroids @ query
+                probes = np.argsort(-centroid_similarities)[:n_probe]
+                ids = np.fromiter((i for list_id in probes for i in self.lists[list_id]), dtype=np.int64)
+            if len(ids) == 0:
+                return []
+            distances = 1.0 - self.vectors[ids] @ query
+            if len(ids) > k:
+                top = np.argpartition(distances, k)[:k]
+            else:
+                top = np.arange(len(ids))
+            top = top[np.argsort(distances[top])]
+            return [(float(distances[i]), self.items[ids[i]]) for i in top]
+
+    def save(self):
+        # Appends what changed since the last save, or writes all files after compaction
+        with self.lock:
+            if self.vectors is None:
+                return
+            if self.rewrite:
+                self._write_all()
+            else:
+                with open(self.vectors_path, 'ab') as file:
+                    self.vectors[self.saved:self.count].tofile(file)
+                with open(self.items_path, 'a', encoding='utf-8') as file:
+                    file.write(self._item_lines(self.saved, self.count))
+                if self.saved_removals:
+                    with open(self.removed_path, 'a', encoding='utf-8') as file:
+                        file.write(json.dumps(self.saved_removals) + '\n')
+            self.saved = self.count
+            self.saved_removals = []
+
+    def _item_lines(self, start, end):
+        return ''.join(json.dumps(item, ensure_ascii=False) + '\n' for item in self.items[start:end])
+
+    def _write_all(self):
+        # removals are in items.jsonl, the old ids in removed.jsonl would hit other vectors
+        with open(self.removed_path, 'w', encoding='utf-8'):
+            pass
+        with open(self.vectors_path + '.tmp', 'wb') as file:
+            self.vectors[:self.count].tofile(file)
+        os.replace(self.vectors_path + '.tmp', self.vectors_path)
+        with open(self.items_path + '.tmp', 'w', encoding='utf-8') as file:
+            file.write(self._item_lines(0, self.count))
+        os.replace(self.items_path + '.tmp', self.items_path)
+        if self.centroids is not None:
+            np.save(self.centroids_path + '.tmp.npy', self.centroids)
+            os.replace(self.centroids_path + '.tmp.npy', self.centroids_path)
+        with open(self.index_path + '.tmp', 'w', encoding='utf-8') as file:
+            json.dump({'dim': self.vectors.shape[1]}, file)
+        os.replace(self.index_path + '.tmp', self.index_path)
+        self.rewrite = False